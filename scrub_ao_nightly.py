@@ -2,6 +2,8 @@ import logging
 from os import path, mkdir, rmdir, walk
 from datetime import datetime, timedelta
 import scrub_ao_utils as utils
+import scrubber_profile
+import scrubber_ssh
 
 """
 Currently needs to be run as aobld@k1aoserver-new.  The HQ directories/files
@@ -19,11 +21,14 @@ class ScrubAO:
         self.utd = datetime.strptime(args.utd, '%Y%m%d')
         self.copy_start = self.utd - timedelta(days=(args.ncopy-1))
         self.scrub_start = self.copy_start - timedelta(days=args.nscrub)
+        self.bwlimit = args.bwlimit
 
         log.info(f"Copy/Sync from: {self.copy_start.strftime('%Y%m%d')}"
                  f" to {args.utd}")
         log.info(f"Scrubbing from: {self.scrub_start.strftime('%Y%m%d')}"
                  f" to {self.copy_start.strftime('%Y%m%d')}")
+        if self.bwlimit:
+            log.info(f"rsync bandwidth limit: {self.bwlimit} KB/s")
 
     def cp_ao_nightly(self):
         """
@@ -103,6 +108,9 @@ class ScrubAO:
         else:
             rsync_cmd = ["rsync", "-avz", paths['summit'], paths['hq']]
 
+        if self.bwlimit:
+            rsync_cmd.insert(1, f"--bwlimit={self.bwlimit}")
+
         ret_val = utils.run_cmd(rsync_cmd, log)
         if ret_val != 0:
             log.warning('Error syncing files,  check paths!')
@@ -146,9 +154,8 @@ class ScrubAO:
             utils.run_cmd(cln_cmd, log)
 
             # clean the date directory,  otherwise above cmd gets permission denied.
-            cln_cmd = ['ssh', f'{self.ao_user}@{self.ao_server}', 'rmdir',
-                       paths['summit']]
-            utils.run_cmd(cln_cmd, log)
+            utils.run_remote_cmd(self.ao_user, self.ao_server,
+                                 ['rmdir', paths['summit']], log)
 
         # clean the month directory if empty
         summit_month_path = paths['summit'].rsplit('/', 1)[0]
@@ -189,6 +196,7 @@ if __name__ == '__main__':
     log_dir = '/home/aobld/log/'
 
     args = utils.parse_args()
+    profiler = scrubber_profile.start(args.profile)
 
     log_name, log_stream = utils.create_logger('ao_nightly_dir', log_dir,
                                                args.tel)
@@ -196,6 +204,8 @@ if __name__ == '__main__':
         print("Error while starting logging,  could not create logger.")
 
     log = logging.getLogger(log_name)
+    if profiler:
+        profiler.set_log(log)
     log.info(f"AO nightly directory sync/scrub.\n"
              f"\t\tUT date to end: {args.utd},\n"
              f"\t\tNumber of days to copy: {args.ncopy},\n"
@@ -205,6 +215,7 @@ if __name__ == '__main__':
     scrub_obj.cp_ao_nightly()
     scrub_obj.scrub_ao_nightly()
 
+    scrubber_ssh.close_pool()
     utils.write_emails(log_stream, mailto, 'AO')
 
     log.info("DONE")
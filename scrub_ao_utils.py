@@ -5,6 +5,8 @@ import subprocess
 from datetime import datetime, timedelta
 from io import StringIO
 
+import scrubber_ssh
+
 
 def parse_args():
     now = datetime.now().strftime('%Y%m%d')
@@ -18,8 +20,13 @@ def parse_args():
                         default=90)
     parser.add_argument("--utd", type=str, default=now,
                         help="Start date to process YYYY-MM-DD.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the run,  the profile is written next "
+                             "to the log.")
     parser.add_argument("--dev", action="store_true",
                         help="Only log the commands,  do not execute")
+    parser.add_argument("--bwlimit", type=int, default=0,
+                        help="Limit the rsync bandwidth (KB/s),  0 no limit.")
 
     return parser.parse_args()
 
@@ -42,6 +49,27 @@ def run_cmd(cmd, log):
     return 0
 
 
+def run_remote_cmd(user, server, cmd, log):
+    """
+    Run a command on a remote server,  over the ssh connection to the
+    server kept for the run.
+
+    :param user: <str> the remote user.
+    :param server: <str> the remote server.
+    :param cmd: <list> the remote command.
+    :param log: <log> the log file pointer.
+    :return: <int> 0 on success,  -1 on error.
+    """
+    log.info(f"cmd ({user}@{server}): {cmd}")
+    try:
+        scrubber_ssh.ssh_pool().run(user, server, cmd).check_returncode()
+    except (OSError, subprocess.SubprocessError):
+        log.warning(f"cmd failed ({user}@{server}): {cmd}")
+        return -1
+
+    return 0
+
+
 def next_date(start_date):
     """
     Iterator to provide the next date as a datetime.
@@ -1,30 +1,57 @@
 import os
+import sys
+import json
+import time
 import configparser
 import logging
-import json
 import glob
-import subprocess
+import bisect
+import tempfile
+import threading
+
+from datetime import datetime, timedelta
 
 import scrubber_utils as utils
+import scrubber_catalog
+import scrubber_helper
+import scrubber_journal
+import scrubber_metrics
+import scrubber_profile
+import scrubber_rules
 
 APP_PATH = os.path.abspath(os.path.dirname(__file__))
 CONFIG_FILE = f'{APP_PATH}/scrubber_config.live.ini'
 
 
 class ToDelete:
-    def __init__(self, inst):
+    def __init__(self, inst, store_dirs=None):
+        """
+        :param inst: <str> the instrument name
+        :param store_dirs: <StorageDirCache> the storage directory cache of
+                           an orchestrator run,  the directories known to
+                           exist are shared by the instruments.
+        """
         self.inst = inst
         self.utd = args.utd
         self.utd2 = args.utd2
         self.log = logging.getLogger(log_name)
         self.db_obj = ChkArchive(inst)
-        self.to_move = self.db_obj.get_files_to_move()
-        self.dirs_made = []
+        if store_dirs:
+            self.store_dirs = store_dirs.bind(self._make_dirs)
+        else:
+            self.store_dirs = utils.StorageDirCache(self._make_dirs,
+                                                    storage_mount)
         self.lev1_moved = []
         self.lev2_moved = []
         self.dir2store = set()
-        self.metrics = {'staged': [0, 0], 'koaid': [0, 0],
+        self.plan = None
+        self.lock = threading.Lock()
+        self.updates = utils.BulkUpdater(self._send_update, self._log_update,
+                                         update_batch, log,
+                                         done_func=self._update_done)
+        self.metrics = {'staged': [0, 0], 'koaid': [0, 0], 'removed': [0, 0],
                         'inst': [0, 0], 'nresults': self.db_obj.get_nresults(),
+                        'rejected': self.db_obj.get_rejected(),
                         'warnings': self.db_obj.get_warnings()}
 
         self.koaadmin_uid = 175
@@ -38,37 +65,583 @@ class ToDelete:
     def get_metrics(self):
         return self.metrics
 
-    def del_mv(self, file_type, func):
+    def run_moves(self):
+        """
+        Move the files for the MODE set in the config file.  When self.plan
+        is set,  the transfers are added to the plan and not run.
+        """
+        if move and batch:
+            self.metrics['koaid'] = self.del_mv_batch(
+                None, self.lev0_batch_key, self.store_lev0_batch)
+            self.metrics['staged'] = self.del_mv_batch(
+                None, self.stage_batch_key, self.store_stage_batch, stage=True)
+        elif move:
+            self.metrics['koaid'] = self.del_mv(None, self.store_lev0_func)
+            # if args.inst == 'KPF':
+            #     self.store_kpf_components()
+            self.metrics['staged'] = self.del_mv(None, self.store_stage_func,
+                                                 stage=True)
+
+        if lev1:
+            self.metrics['lev1'] = self.del_mv('lev1', self.store_lev1_func)
+
+        if lev2:
+            self.metrics['lev2'] = self.del_mv('lev2', self.store_lev2_func)
+
+    def apply_plan(self, run_plan):
+        """
+        Run the transfers of a saved plan with the executor.  The storage
+        directories of the plan are made first in one batch.
+
+        :param run_plan: <RunPlan> the plan.
+        """
+        self.store_dirs.ensure({task['storage_dir']
+                                for section in run_plan.sections
+                                for task in section['tasks']
+                                if task.get('storage_dir')})
+
+        for section in run_plan.sections:
+            func = getattr(self, section['func'])
+            tasks = ((task['source'], task['storage'], tuple(task['args']))
+                     for task in section['tasks'])
+
+            log.info(f"applying {len(section['tasks'])} {section['func']} "
+                     f"tasks from the plan")
+
+            n_not_found = 0
+            n_files_touched = 0
+            for ret_vals in executor.map(self.journaled(func), tasks):
+                if not isinstance(ret_vals, dict):
+                    ret_vals = {None: ret_vals or 0}
+                for ret_val in ret_vals.values():
+                    if ret_val < 0:
+                        n_not_found += ret_val
+                    else:
+                        n_files_touched += ret_val
+
+            self.updates.flush()
+
+            nrows = section['rows'] - section['completed']
+            metric = RunPlan.METRICS[section['func']]
+            self.metrics[metric] = [nrows + n_not_found, n_files_touched] \
+                if section['rows'] else [0, 0]
+
+    def del_mv(self, file_type, func, stage=False):
         """
         Skeleton function to delete or move a file list,  file by file.
+        The files are moved by the executor as the query results are read,
+        the results are collected per file so the totals match a serial run.
 
+        :param file_type: <str> the file type to move (None, lev1, lev2).
+        :param func: <func> moves the files for a db row.
+        :param stage: <bool> True if moving the stage files.
         :return: <list<int>,<int>> number moved/deleted, number in list.
         """
-        file_list = self.db_obj.get_files_to_move(file_type=file_type)
+        file_list = self.prepare_dirs(
+            self.db_obj.get_files_to_move(file_type=file_type), file_type,
+            stage)
+        nfiles = [0, 0]
+
+        def plan_tasks():
+            files_funked = set()
+            for result in file_list:
+                nfiles[0] += 1
+                if self.is_completed(result, file_type):
+                    nfiles[1] += 1
+                    continue
+                if 'process_dir' in result and result['process_dir'] in files_funked:
+                    continue
+
+                # the key is the path moved,  on the mount of the telescope
+                src_key = 'stage_file' if stage else 'process_dir'
+                src_dir = (result.get(src_key) or '').strip('/')
+                src_path = f"{koa_mount}/{args.tel}{src_dir}"
+                yield (utils.source_mount(src_path, koa_mount),
+                       utils.storage_disk_num(result.get('koaid'), config),
+                       (result,))
+
+                if 'process_dir' in result:
+                    files_funked.add(result['process_dir'])
+
+        if self.plan is not None:
+            self.plan.add_section(func.__name__, plan_tasks(), self.task_files,
+                                  nfiles)
+            return [0, 0]
+
+        # rsync will return 1 per file,  when it succeeds, 0 fails,
+        # -1 if file not found
+        n_not_found = 0
+        n_files_touched = 0
+        for ret_val in executor.map(self.journaled(func), plan_tasks()):
+            if ret_val < 0:
+                n_not_found += ret_val
+            else:
+                n_files_touched += ret_val
+
+        self.updates.flush()
 
-        if not file_list:
+        if not nfiles[0]:
             return [0, 0]
 
-        nfiles_found = len(file_list)
+        return [nfiles[0] - nfiles[1] + n_not_found, n_files_touched]
 
-        files_funked = []
+    def del_mv_batch(self, file_type, key_func, batch_func, stage=False):
+        """
+        Skeleton function to move a file list,  grouped by the source
+        directory so that each group is moved with a single transfer.
+
+        The query results are ordered by koaid,  so the groups for a UT date
+        are sent to the executor when the date changes,  or when a group
+        reaches the batch_size.
+
+        :param file_type: <str> the file type to move (None, lev1, lev2).
+        :param key_func: <func> returns the (source dir, storage dir) for a
+                                db row,  or None if it can not be moved.
+        :param batch_func: <func> moves a group of db rows,  returns a dict
+                                  of koaid: the same return values as func
+                                  in del_mv.
+        :param stage: <bool> True if moving the stage files.
+        :return: <list<int>,<int>> number moved/deleted, number in list.
+        """
+        file_list = self.prepare_dirs(
+            self.db_obj.get_files_to_move(file_type=file_type), file_type,
+            stage)
+        nfiles = [0, 0]
+
+        def group_task(group_key, results):
+            src_dir, storage_dir = group_key
+            return (utils.source_mount(src_dir, koa_mount),
+                    utils.storage_disk_num(results[0]['koaid'], config),
+                    (src_dir, storage_dir, results))
+
+        def plan_tasks():
+            groups = {}
+            last_utd = None
+            for result in file_list:
+                nfiles[0] += 1
+                koaid_parts = result['koaid'].split('.')
+                utd = koaid_parts[1] if len(koaid_parts) > 1 else None
+                if utd != last_utd:
+                    for group_key, results in groups.items():
+                        yield group_task(group_key, results)
+                    groups = {}
+                    last_utd = utd
+
+                if self.is_completed(result, file_type):
+                    nfiles[1] += 1
+                    continue
+
+                group_key = key_func(result)
+                if not group_key:
+                    continue
+
+                group = groups.setdefault(group_key, [])
+                group.append(result)
+                if len(group) >= batch_size:
+                    yield group_task(group_key, groups.pop(group_key))
+
+            for group_key, results in groups.items():
+                yield group_task(group_key, results)
+
+        if self.plan is not None:
+            self.plan.add_section(batch_func.__name__, plan_tasks(),
+                                  self.task_files, nfiles)
+            return [0, 0]
+
+        n_not_found = 0
         n_files_touched = 0
+        for ret_vals in executor.map(self.journaled(batch_func), plan_tasks()):
+            # a failed task returns 0,  none of its files were moved
+            for ret_val in (ret_vals or {}).values():
+                if ret_val < 0:
+                    n_not_found += ret_val
+                else:
+                    n_files_touched += ret_val
+
+        self.updates.flush()
+
+        if not nfiles[0]:
+            return [0, 0]
+
+        return [nfiles[0] - nfiles[1] + n_not_found, n_files_touched]
+
+    def journaled(self, func):
+        """
+        Write the intent to run func to the journal before it runs,  and
+        the commit when it is done.
+
+        :param func: <func> a method of ToDelete that moves files.
+        :return: <func> func,  run with the journal records.
+        """
+        if not journal:
+            return func
+
+        def run_journaled(*func_args):
+            seq = journal.intent('transfer', func=func.__name__,
+                                 args=list(func_args))
+            ret_val = func(*func_args)
+            journal.commit([seq])
+
+            return ret_val
+
+        return run_journaled
+
+    def recover(self):
+        """
+        Roll forward the steps left incomplete in the journal by an
+        interrupted run:  the transfers are run again and the DB updates
+        are sent,  before the new work begins.
+        """
+        if not journal:
+            return
+
+        entries = journal.incomplete()
+        if not entries:
+            return
+
+        log.warning(f'recovering {len(entries)} incomplete steps from the '
+                    f'journal: {journal.path}')
+
+        for entry in entries:
+            if entry['step'] != 'transfer':
+                continue
+            func = getattr(self, entry['func'], None)
+            if not func:
+                log.error(f'unknown journal step: {entry}')
+                continue
+            try:
+                ret_val = func(*entry['args'])
+            except Exception as err:
+                log.error(f"Error recovering {entry['func']}: {err}")
+                continue
+            if ret_val == -1:
+                log.warning(f"recovered {entry['func']} found no files,  "
+                            f"check the archive_dir of: {entry['args']}")
+            journal.commit([entry['seq']])
+
+        for entry in entries:
+            if entry['step'] == 'update':
+                self.updates.add(tuple(entry['update']), entry['koaid'])
+
+        self.updates.flush()
+
+    def prepare_dirs(self, file_list, file_type, stage=False):
+        """
+        Read the db rows in chunks of batch_size,  and make the storage
+        directories for each chunk in one batch before its rows are moved.
+
+        :param file_list: <iterable<dict>> the db rows to move.
+        :param file_type: <str> the file type to move (None, lev1, lev2).
+        :param stage: <bool> True if moving the stage files.
+        :return: yields the db rows.
+        """
+        level = int(file_type[-1]) if file_type else 0
+
+        chunk = []
         for result in file_list:
-            if 'process_dir' in result and result['process_dir'] in files_funked:
+            chunk.append(result)
+            if len(chunk) < batch_size:
                 continue
+            self._prepare_chunk(chunk, level, stage)
+            yield from chunk
+            chunk = []
+
+        if chunk:
+            self._prepare_chunk(chunk, level, stage)
+            yield from chunk
+
+    def _prepare_chunk(self, results, level, stage):
+        storage_dirs = set()
+        for result in results:
+            koaid = result.get('koaid')
+            if not koaid:
+                continue
+            if stage:
+                storage_dir = utils.determine_storage(
+                    koaid, config, config_type, ofname=result.get('ofname') or '')
+            else:
+                storage_dir = utils.determine_storage(koaid, config,
+                                                      config_type, level=level)
+            storage_dirs.add(storage_dir)
 
-            # rsync will return 1 per file,  when it succeeds, 0 fails,
-            # -1 if file not found
-            ret_val = func(result)
-            if ret_val < 0:
-                nfiles_found += ret_val
+        storage_dirs.discard(None)
+
+        # a plan does not make the directories
+        if self.plan is None:
+            self.store_dirs.ensure(storage_dirs)
+
+    def _make_dirs(self, paths):
+        """
+        Make the directories at storage,  as koaadmin,  in one batch.
+
+        :param paths: <list<str>> the directories to make.
+        :return: <list<bool>> True for each directory made.
+        """
+        log.info(f'making {len(paths)} storage directories')
+
+        with scrubber_metrics.phase('mkdir', inst=self.inst):
+            return helpers.run_ops(self.koaadmin_uid, self.koaadmin_gid,
+                                   [['mkdir', path] for path in paths])
+
+    def is_completed(self, result, file_type):
+        """
+        Check the catalog for a koaid that was moved and had its archive_dir
+        set by an earlier run,  so it is skipped (including --force runs).
+
+        :param result: <dict> single db row,  the query result for the file.
+        :param file_type: <str> the file type to move (None, lev1, lev2).
+        :return: <bool> True if the koaid is complete.
+        """
+        if not catalog:
+            return False
+
+        level = int(file_type[-1]) if file_type else 0
+        if not catalog.is_complete(result['koaid'], level):
+            return False
+
+        log.info(f"skipping {result['koaid']} -- completed in catalog.")
+
+        return True
+
+    def _catalog_stored(self, koaid, level, mv_path, storage_dir):
+        """
+        Record a file or directory moved to storage in the catalog.
+
+        :param koaid: <str> the koaid
+        :param level: <int> the level moved.
+        :param mv_path: <str> the path moved.
+        :param storage_dir: <str> the storage directory.
+        """
+        if not catalog:
+            return
+
+        name = mv_path.rstrip('/').split('/')[-1]
+        catalog.record_stored([(koaid, level, mv_path, name, storage_dir,
+                                None, None)])
+
+    def lev0_batch_key(self, result):
+        """
+        The lev0 files for a koaid are grouped by the lev0 directory.
+
+        :param result: <dict> single db row,  the query result for the file.
+        :return: <tuple> the source directory and the storage directory.
+        """
+        mv_path = f"{koa_mount}/{args.tel}{result['process_dir'].strip('/')}"
+
+        storage_dir = self.get_storage_dir(result['koaid'], mv_path)
+        if not storage_dir:
+            return None
+
+        return mv_path, storage_dir
+
+    def stage_batch_key(self, result):
+        """
+        The stage files are grouped by the directory of the stage file.
+
+        :param result: <dict> single db row,  the query result for the file.
+        :return: <tuple> the source directory and the storage directory.
+        """
+        koaid = result['koaid']
+        mv_path = f"{koa_mount}/{args.tel}{result['stage_file'].strip('/')}"
+
+        storage_dir = self.get_storage_dir(koaid, mv_path,
+                                           ofname=result['ofname'])
+        if not storage_dir:
+            log.error(f'Could not get storage dir for: {koaid}')
+            return None
+
+        return os.path.dirname(mv_path), storage_dir
+
+    def store_lev0_batch(self, src_dir, storage_dir, results):
+        """
+        move the files matching each koaid in the group with one transfer.
+
+        :param src_dir: <str> the lev0 directory holding the files.
+        :param storage_dir: <str> the storage directory for the group.
+        :param results: <list/dict> the db rows in the group.
+        :return: <dict> koaid: 1 if moved, 0 if failed, -1 if not found.
+        """
+        src_files = utils.list_dir_files(src_dir)
+        names = sorted(src_files)
+
+        koaid_files = {}
+        for result in results:
+            koaid_files[result['koaid']] = self._koaid_files(
+                src_dir, names, result['koaid'])
+
+        log.info(f'running store lev0 batch, {len(results)} koaids from: '
+                 f'{src_dir},  storage dir {storage_dir}')
+
+        return self._store_batch(src_dir, storage_dir, src_files, koaid_files)
+
+    def store_stage_batch(self, src_dir, storage_dir, results):
+        """
+        move the stage files in the group with one transfer,  and add the
+        archive dir for each koaid that was moved.
+
+        :param src_dir: <str> the directory holding the stage files.
+        :param storage_dir: <str> the storage directory for the group.
+        :param results: <list/dict> the db rows in the group.
+        :return: <dict> koaid: 1 if moved, 0 if failed, -1 if not found.
+        """
+        src_files = utils.list_dir_files(src_dir)
+
+        koaid_files = {}
+        for result in results:
+            filename = self._stage_filename(result, src_files)
+            koaid_files[result['koaid']] = [filename] if filename else []
+
+        log.info(f'Storing Stage batch, {len(results)} koaids from: {src_dir}')
+
+        ret_vals = self._store_batch(src_dir, storage_dir, src_files,
+                                     koaid_files)
+
+        # if successfully moved,  add archive dir to DB entry
+        for koaid, ret_val in ret_vals.items():
+            if ret_val != 1:
+                continue
+            if not self.add_archived_dir(koaid, storage_dir, level=0):
+                self.log.warning(f"archive_dir not set for {koaid}")
+
+        return ret_vals
+
+    @staticmethod
+    def _koaid_files(src_dir, names, koaid):
+        """
+        The files of a koaid in a lev0 directory.
+
+        :param src_dir: <str> the lev0 directory holding the files.
+        :param names: <list> the sorted filenames in src_dir.
+        :param koaid: <str> the koaid.
+        :return: <list> the filenames starting with the koaid.
+        """
+        prefix = koaid
+        if 'lev0' in src_dir and 'KPF' not in src_dir and 'HIRES' not in src_dir:
+            prefix += "."
+
+        # the names are sorted,  so the matches are a contiguous block
+        matched = []
+        indx = bisect.bisect_left(names, prefix)
+        while indx < len(names) and names[indx].startswith(prefix):
+            matched.append(names[indx])
+            indx += 1
+
+        return matched
+
+    @staticmethod
+    def _stage_filename(result, src_files):
+        """
+        The stage file of a db row,  or its .gz.
+
+        :param result: <dict> single db row,  the query result for the file.
+        :param src_files: <dict> filename: os.stat_result,  the files in the
+                                 stage directory.
+        :return: <str> the filename,  None if it is not in src_files.
+        """
+        filename = result['stage_file'].rstrip('/').split('/')[-1]
+        if filename not in src_files and f'{filename}.gz' in src_files:
+            filename = f'{filename}.gz'
+
+        return filename if filename in src_files else None
+
+    def task_files(self, func_name, func_args, listings):
+        """
+        The files a planned task will move,  and its storage directory.
+
+        :param func_name: <str> the name of the function to run the task.
+        :param func_args: <tuple> the args of the function.
+        :param listings: <dict> directory: (files, sorted names),  the
+                                directories listed by the plan.
+        :return: <tuple> number of files, number of bytes, storage directory.
+        """
+        def listing(dir_path):
+            if dir_path not in listings:
+                dir_files = utils.list_dir_files(dir_path)
+                listings[dir_path] = (dir_files, sorted(dir_files))
+            return listings[dir_path]
+
+        if func_name in ('store_lev0_batch', 'store_stage_batch'):
+            src_dir, storage_dir, results = func_args
+            src_files, names = listing(src_dir)
+            if func_name == 'store_lev0_batch':
+                files = [fname for result in results
+                         for fname in self._koaid_files(src_dir, names,
+                                                        result['koaid'])]
             else:
-                n_files_touched += ret_val
+                files = [self._stage_filename(result, src_files)
+                         for result in results]
+                files = [fname for fname in files if fname]
+
+            return (len(files), sum(src_files[fname].st_size for fname in files),
+                    storage_dir)
 
-            if 'process_dir' in result:
-                files_funked.append(result['process_dir'])
+        result = func_args[0]
+        koaid = result['koaid']
+        if func_name == 'store_stage_func':
+            mv_path = f"{koa_mount}/{args.tel}{result['stage_file'].strip('/')}"
+            src_files, _ = listing(os.path.dirname(mv_path))
+            filename = self._stage_filename(result, src_files)
+            storage_dir = utils.determine_storage(koaid, config, config_type,
+                                                  ofname=result['ofname'])
+            if not filename:
+                return 0, 0, storage_dir
+            return 1, src_files[filename].st_size, storage_dir
+
+        mv_path = f"{koa_mount}/{args.tel}{result['process_dir'].strip('/')}"
+        if func_name == 'store_lev0_func':
+            src_files, names = listing(mv_path)
+            files = self._koaid_files(mv_path, names, koaid)
+            storage_dir = utils.determine_storage(koaid, config, config_type)
+            return (len(files), sum(src_files[fname].st_size for fname in files),
+                    storage_dir)
+
+        # lev1 and lev2 move the full directory
+        level = 1 if func_name == 'store_lev1_func' else 2
+        storage_dir = utils.determine_storage(koaid, config, config_type,
+                                              level=level)
+        nfiles, nbytes = utils.walk_file_count(mv_path) or [0, 0]
 
-        return [nfiles_found, n_files_touched]
+        return nfiles, nbytes, storage_dir
+
+    def _store_batch(self, src_dir, storage_dir, src_files, koaid_files):
+        """
+        Transfer the files for a group of koaids and determine the result
+        for each koaid.
+
+        :param src_dir: <str> the source directory of the files.
+        :param storage_dir: <str> the storage directory.
+        :param src_files: <dict> filename: os.stat_result,  the files in src_dir.
+        :param koaid_files: <dict> koaid: list of filenames to move.
+        :return: <dict> koaid: 1 if moved, 0 if failed, -1 if not found.
+        """
+        filenames = [fname for files in koaid_files.values() for fname in files]
+
+        stored = set()
+        if filenames:
+            stored = self._rsync_file_list(src_dir, storage_dir, filenames,
+                                           src_files)
+
+        ret_vals = {}
+        catalog_files = []
+        for koaid, files in koaid_files.items():
+            if not files:
+                log.info(f'skipping {koaid} in {src_dir} -- already moved'
+                         f' or does not exist.')
+                ret_vals[koaid] = -1
+            elif all(fname in stored for fname in files):
+                ret_vals[koaid] = 1
+                catalog_files += [(koaid, 0, f'{src_dir}/{fname}', fname,
+                                   storage_dir, src_files[fname].st_size,
+                                   src_files[fname].st_mtime)
+                                  for fname in files]
+            else:
+                log.warning(f'files for {koaid} not stored: {files}')
+                ret_vals[koaid] = 0
+
+        if catalog and catalog_files:
+            catalog.record_stored(catalog_files)
+
+        return ret_vals
 
     def store_lev0_func(self, result):
         """
@@ -79,7 +652,7 @@ class ToDelete:
         """
         koaid = result['koaid']
         # mv_path = result['process_dir']
-        mv_path = f"/{args.tel}{result['process_dir'].strip('/')}"
+        mv_path = f"{koa_mount}/{args.tel}{result['process_dir'].strip('/')}"
 
         storage_dir = self.get_storage_dir(koaid, mv_path)
         if not storage_dir:
@@ -99,27 +672,25 @@ class ToDelete:
         all_dirs = ['CaHK', 'CRED2', 'ExpMeter', 'FVC1', 'FVC2', 'FVC3',
                     'Green', 'L0', 'Red', 'script_logs']
         log.info(f'dir2store {self.dir2store}')
+
+        # make all the component directories in one batch
+        made = self.store_dirs.ensure(
+            [f'{dir_set[1]}/{comp_dir}/' for dir_set in self.dir2store
+             for comp_dir in all_dirs])
+
         for dir_set in self.dir2store:
             kpf_comp_root = dir_set[0]
             storage_dir = dir_set[1]
 
-            # make directory if it doesn't exist
-            cmd = ['mkdir', '-p', f'/net/storageserver/{storage_dir}']
-            if not utils.run_cmd_as_user(self.koaadmin_uid, self.koaadmin_gid, cmd, log):
-                continue
-
             # copy, don't remove the files
             orig_rm = self.rm
             self.rm = ''
             for comp_dir in all_dirs:
                 storage_now = f'{storage_dir}/{comp_dir}/'
-                nfs_store_now = f'/net/storageserver/{storage_now}'
                 mv_path = f'{kpf_comp_root}{comp_dir}'
                 log.info(f'component directory: {comp_dir}, {mv_path}, {storage_now}')
-                if not os.path.isdir(nfs_store_now):
-                    cmd = ['mkdir', '-p', nfs_store_now]
-                    if not utils.run_cmd_as_user(self.koaadmin_uid, self.koaadmin_gid, cmd, log):
-                        continue
+                if storage_now not in made:
+                    continue
                 log.info(f'component directories, from: {mv_path} to: {storage_now}')
                 self._rsync_files(mv_path, storage_now, sync_all=True)
 
@@ -137,7 +708,7 @@ class ToDelete:
         """
         return_val = 0
         koaid = result['koaid']
-        mv_path = f"/{args.tel}{result['process_dir'].strip('/')}"
+        mv_path = f"{koa_mount}/{args.tel}{result['process_dir'].strip('/')}"
 
         if 'lev1' not in mv_path:
             self.log.warning(f"lev1 path format is incorrect: {mv_path}")
@@ -152,13 +723,18 @@ class ToDelete:
 
         log.info(f'running store lev1,  storage dir {storage_dir}')
 
-        if mv_path not in self.lev1_moved:
-            return_val = self._rsync_files(mv_path, storage_dir)
+        with self.lock:
+            sync_path = mv_path not in self.lev1_moved
             self.lev1_moved.append(mv_path)
 
+        if sync_path:
+            return_val = self._rsync_files(mv_path, storage_dir)
+
         if return_val != 1:
             return return_val
 
+        self._catalog_stored(koaid, 1, mv_path, storage_dir)
+
         # if successfully moved,  add archive dir to DB entry
         if not self.add_archived_dir(koaid, storage_dir, level=1):
             self.log.warning(f"archive_dir not set for {koaid}")
@@ -174,7 +750,7 @@ class ToDelete:
         """
         return_val = 0
         koaid = result['koaid']
-        mv_path = f"/{args.tel}{result['process_dir'].strip('/')}"
+        mv_path = f"{koa_mount}/{args.tel}{result['process_dir'].strip('/')}"
 
         if 'lev2' not in mv_path:
             self.log.warning(f"lev2 path format is incorrect: {mv_path}")
@@ -189,14 +765,19 @@ class ToDelete:
 
         log.info(f'running store lev2, mv path {mv_path}, storage dir {storage_dir}')
 
-        if mv_path not in self.lev2_moved:
+        with self.lock:
+            sync_path = mv_path not in self.lev2_moved
+            self.lev2_moved.append(mv_path)
+
+        if sync_path:
             log.info(f'rsyncing {mv_path} to {storage_dir}')
             return_val = self._rsync_files(mv_path, storage_dir)
-            self.lev2_moved.append(mv_path)
 
         if return_val != 1:
             return return_val
 
+        self._catalog_stored(koaid, 2, mv_path, storage_dir)
+
         # if successfully moved,  add archive dir to DB entry
         if not self.add_archived_dir(koaid, storage_dir, level=2):
             self.log.warning(f"archive_dir not set for {koaid}")
@@ -212,7 +793,7 @@ class ToDelete:
         :return: <int> 1 if file removed successfully,  or 1
         """
         koaid = result['koaid']
-        mv_path = f"/{args.tel}{result['stage_file'].strip('/')}"
+        mv_path = f"{koa_mount}/{args.tel}{result['stage_file'].strip('/')}"
         ofname = result['ofname']
 
         log.info(f'Storing Stage for: {koaid}')
@@ -226,6 +807,8 @@ class ToDelete:
         if return_val != 1:
             return return_val
 
+        self._catalog_stored(koaid, 0, mv_path, storage_dir)
+
         # if successfully moved,  add archive dir to DB entry
         if not self.add_archived_dir(koaid, storage_dir, level=0):
             self.log.warning(f"archive_dir not set for {koaid}")
@@ -249,10 +832,9 @@ class ToDelete:
             self.log.warning(f"Files at: {mv_path} where not moved!")
             return None
 
-        if storage_dir not in self.dirs_made:
-            cmd = ['mkdir', '-p',  f'/net/storageserver/{storage_dir}']
-            if utils.run_cmd_as_user(self.koaadmin_uid, self.koaadmin_gid, cmd, log):
-                self.dirs_made.append(storage_dir)
+        # made in prepare_dirs,  unless not planned
+        if self.plan is None and not self.store_dirs.exists(storage_dir):
+            self.store_dirs.ensure([storage_dir])
 
         return storage_dir
 
@@ -263,39 +845,76 @@ class ToDelete:
 
         :param koaid: <str> koaid of file to mark as deleted
         """
-        results = utils.query_rti_api(site, 'update', 'MARKDELETED',
-                                      log=log, val=koaid)
-        self._log_update(koaid, results, 'SOURCE_DELETED')
+        if journal:
+            journal.update_intent(('SOURCE_DELETED',), koaid)
+
+        self.updates.add(('SOURCE_DELETED',), koaid)
 
     def add_archived_dir(self, koaid, archive_path, level=0):
         """
-        Add the path to the storage / archived files.
+        Add the path to the storage / archived files.  With update_batch
+        set,  the update is queued and sent with the other koaids moved to
+        the same path.
 
         :param koaid: <str> the koaid
         :param archive_path: <str> storage path where files were moved/archived.
         """
         self.log.info(f"setting archive_dir {archive_path} for: {koaid}")
-        archive_loc = utils.get_config_param(config, 'db_columns', 'archive_directory')
 
-        results = utils.query_rti_api(site, 'update', 'GENERAL', log=log,
-                                      columns=archive_loc, key='koaid',
-                                      update_val=archive_path, val=koaid,
-                                      add=f' LEVEL={level}')
-        return self._log_update(koaid, results, 'ARCHIVE_DIR')
+        if journal:
+            journal.update_intent(('ARCHIVE_DIR', archive_path, level), koaid)
+
+        return self.updates.add(('ARCHIVE_DIR', archive_path, level), koaid)
+
+    def _send_update(self, update, koaids):
+        """
+        Send one API update for a list of koaids.
+
+        :param update: <tuple> the column name,  and for ARCHIVE_DIR
+                               the archive path and level.
+        :param koaids: <list> the koaids to update.
+        :return: <dict> the decoded database results
+        """
+        val = ','.join(koaids)
+        with scrubber_metrics.phase('update', inst=self.inst):
+            if update[0] == 'SOURCE_DELETED':
+                return api.update('MARKDELETED', val=val)
+
+            archive_path, level = update[1:]
+            archive_loc = utils.get_config_param(config, 'db_columns',
+                                                 'archive_directory')
+
+            return api.update('GENERAL', columns=archive_loc, key='koaid',
+                              update_val=archive_path, val=val,
+                              add=f' LEVEL={level}')
+
+    def _update_done(self, koaids, update):
+        """
+        Record the updated koaids in the catalog.
+
+        :param koaids: <list> the koaids that were updated.
+        :param update: <tuple> the column name,  and for ARCHIVE_DIR
+                               the archive path and level.
+        """
+        if journal:
+            journal.commit_updates(update, koaids)
+
+        if not catalog:
+            return
+
+        if update[0] == 'ARCHIVE_DIR':
+            catalog.mark_archive_dir(koaids, level=update[2])
+        else:
+            catalog.mark_deleted(koaids)
 
     def _log_update(self, koaid, results, column):
         """
         Log the update
 
         :param koaid: <str> koaid of files to update
-        :param results: <str> the database results in json format
+        :param results: <dict> the decoded database results
         :param column: <str> the column name for logging
         """
-        try:
-            results = json.loads(results)
-        except Exception as err:
-            self.log.warning(f"Error: {err}")
-
         if results and type(results) == dict and results['success'] == 1:
             self.log.info(f"{column} set for koaid: {koaid}")
         else:
@@ -323,22 +942,26 @@ class ToDelete:
             return -1
 
         server_str = f"{mv_path}"
-        store_loc = f'/net/storageserver/{storage_dir}'
+        store_loc = f'{storage_mount}/{storage_dir}'
 
         log.info(f'rsync files from: {server_str} to: {store_loc}')
         log.info(f'koaid: {koaid}')
 
+        include = None
+
         if koaid:
             if 'lev0' in server_str and 'KPF' not in server_str and 'HIRES' not in server_str:
                 koaid += "."
 
+            include = f"{koaid}*"
             rsync_cmd = ["rsync", "-avz",
-                         "--include", f"{koaid}*",
+                         "--include", include,
                          "--exclude", "*", f"{server_str}/", store_loc]
             files_wild = f'{server_str}/{koaid}*'
         elif sync_all:
+            include = "*fits*"
             rsync_cmd = ["/usr/bin/rsync", "-avz",
-                         "--include", f"*fits*",
+                         "--include", include,
                          "--exclude", "*", f"{server_str}/", store_loc]
             files_wild = f'{server_str}/*fits'
         elif '.fits' in server_str:
@@ -349,20 +972,384 @@ class ToDelete:
             rsync_cmd = ["rsync", "-avz", server_str, store_loc]
             files_wild = f'{server_str}'
 
-        log.info(f"rsync command: {rsync_cmd}")
-        if not utils.run_cmd_as_user(self.koaadmin_uid, self.koaadmin_gid, rsync_cmd, log):
+        # list the files before the transfer,  files added after the
+        # transfer starts are not removed
+        pairs = self._transfer_pairs(server_str, store_loc, include)
+        self._add_task_bytes(pairs)
+
+        src_hashes = None
+        with scrubber_metrics.phase('transfer', inst=self.inst):
+            if self._backend(server_str) == 'native':
+                src_hashes = self._native_copy(pairs)
+                if len(src_hashes) != len(pairs):
+                    return 0
+            else:
+                rsync_cmd[2:2] = self._rsync_opts()
+                log.info(f"rsync command: {rsync_cmd}")
+                if not utils.run_cmd_as_user(self.koaadmin_uid,
+                                             self.koaadmin_gid, rsync_cmd, log,
+                                             setpriv=helpers.setpriv):
+                    return 0
+
+        # the removed files are only the ones sent by this transfer
+        if not self.rm:
+            return 1
+
+        stored = self._stored_pairs(pairs)
+        removed = self._remove_stored(stored, src_hashes)
+        if len(removed) != len(pairs):
+            log.error(f"Not all files removed from {files_wild},  "
+                      f"{len(removed)} of {len(pairs)} removed.")
             return 0
 
-        if self.rm:
+        return 1
+
+    @staticmethod
+    def _backend(src_path):
+        """
+        :param src_path: <str> the source of a transfer.
+        :return: <str> the [transfer_backend] of its source mount,  rsync or
+                       native.
+        """
+        return backends.get(utils.source_mount(src_path, koa_mount),
+                            backends.get('default', 'rsync'))
+
+    def _native_copy(self, pairs):
+        """
+        Copy the files with the native backend,  in the helper running as
+        koaadmin.  With verify the sources are hashed while copied.
+
+        :param pairs: <list<tuple>> (source path, storage path) of each file.
+        :return: <dict> source path: hash (or None) of each file copied.
+        """
+        copied = helpers.copy_files(self.koaadmin_uid, self.koaadmin_gid,
+                                    pairs, verify_hash if verify else None)
+        log.info(f'copied {len(copied)} of {len(pairs)} files (native)')
+
+        return copied
+
+    @staticmethod
+    def _rsync_opts():
+        """
+        :return: <list> the --bwlimit for a transfer,  its share of the
+                        [executor] bwlimit.
+        """
+        kbps = executor.task_bwlimit()
+
+        return [f'--bwlimit={kbps}'] if kbps else []
+
+    @staticmethod
+    def _add_task_bytes(pairs):
+        """
+        Add the size of the source files to the bytes of the running task.
+
+        :param pairs: <list<tuple>> (source path, storage path) of each file.
+        """
+        nbytes = 0
+        for src_path, _ in pairs:
             try:
-                cmd = f"rm -r {files_wild}"
-                subprocess.run(cmd, check=True, shell=True)
-                log.info(f"Removed: {files_wild}, cmd: {cmd}")
-            except subprocess.CalledProcessError as e:
-                log.error(f"Failed to remove {files_wild}: {e}")
-                return 0
+                nbytes += os.stat(src_path).st_size
+            except OSError:
+                continue
+        executor.add_bytes(nbytes)
+
+    def _transfer_pairs(self, src_path, store_loc, include=None):
+        """
+        The source and storage path of each file sent by an rsync of
+        src_path to store_loc.
+
+        :param src_path: <str> the file or directory transferred,  a trailing
+                               '/' sends the contents of the directory.
+        :param store_loc: <str> the storage directory.
+        :param include: <str> the pattern of the files sent from src_path.
+        :return: <list<tuple>> (source path, storage path) of each file.
+        """
+        store_loc = store_loc.rstrip('/')
+        if include:
+            return [(path, f'{store_loc}/{os.path.basename(path)}')
+                    for path in sorted(glob.glob(f"{src_path.rstrip('/')}/{include}"))
+                    if os.path.isfile(path)]
+
+        if os.path.isfile(src_path):
+            return [(src_path, f'{store_loc}/{os.path.basename(src_path)}')]
+
+        if not src_path.endswith('/'):
+            store_loc = f'{store_loc}/{os.path.basename(src_path)}'
+
+        pairs = []
+        for dir_path, _, filenames in os.walk(src_path):
+            rel_path = os.path.relpath(dir_path, src_path)
+            store_dir = store_loc if rel_path == '.' else f'{store_loc}/{rel_path}'
+            pairs += [(os.path.join(dir_path, fname), f'{store_dir}/{fname}')
+                      for fname in sorted(filenames)]
+
+        return pairs
+
+    def _rsync_file_list(self, src_dir, storage_dir, filenames, src_files):
+        """
+        Transfer a list of files from one directory with a single rsync,  or
+        with the native copy for a 'native' [transfer_backend].
+
+        :param src_dir: <str> the source directory of the files.
+        :param storage_dir: <str> the path to store the files.
+        :param filenames: <list> the filenames in src_dir to transfer.
+        :param src_files: <dict> filename: os.stat_result,  the files in src_dir.
+        :return: <set> the filenames verified at storage (and removed from
+                       the source when removing).
+        """
+        store_loc = f'{storage_mount}/{storage_dir}'
+        pairs = [(f'{src_dir}/{fname}', f'{store_loc}/{fname}')
+                 for fname in filenames]
+        src_sizes = {f'{src_dir}/{fname}': src_files[fname].st_size
+                     for fname in filenames}
+        executor.add_bytes(sum(src_sizes.values()))
+
+        src_hashes = None
+        with scrubber_metrics.phase('transfer', inst=self.inst):
+            if self._backend(src_dir) == 'native':
+                log.info(f'copy {len(filenames)} files from: {src_dir} '
+                         f'to: {store_loc}')
+                src_hashes = self._native_copy(pairs)
+            else:
+                self._rsync_list(src_dir, store_loc, filenames)
+
+        stored = self._stored_pairs(pairs, src_sizes)
+
+        if self.rm:
+            stored = self._remove_stored(stored, src_hashes)
+            log.info(f"Removed {len(stored)} files from: {src_dir}")
+
+        return {os.path.basename(pair[0]) for pair in stored}
+
+    def _rsync_list(self, src_dir, store_loc, filenames):
+        """
+        rsync a list of files from one directory with --files-from.
+
+        :param src_dir: <str> the source directory of the files.
+        :param store_loc: <str> the storage directory (over the mount).
+        :param filenames: <list> the filenames in src_dir to transfer.
+        """
+        # the list file must be readable by the user running rsync
+        with tempfile.NamedTemporaryFile('w', prefix='scrub_files_',
+                                         suffix='.txt', delete=False) as fp:
+            fp.write('\n'.join(filenames) + '\n')
+            files_from = fp.name
+        os.chmod(files_from, 0o644)
+
+        rsync_cmd = ["rsync", "-avz"] + self._rsync_opts() + \
+                    [f"--files-from={files_from}", f"{src_dir}/", store_loc]
+
+        log.info(f'rsync {len(filenames)} files from: {src_dir} to: {store_loc}')
+        log.info(f"rsync command: {rsync_cmd}")
+        if not utils.run_cmd_as_user(self.koaadmin_uid, self.koaadmin_gid,
+                                     rsync_cmd, log, setpriv=helpers.setpriv):
+            log.warning(f'rsync reported errors for: {src_dir},  '
+                        f'checking the files at storage.')
+        os.remove(files_from)
+
+    def _stored_pairs(self, pairs, src_sizes=None):
+        """
+        Find the files that are at storage with the same size as the source.
+        Each storage directory is listed once.
+
+        :param pairs: <list<tuple>> (source path, storage path) of each file.
+        :param src_sizes: <dict> source path: size,  the sizes listed before
+                                 the transfer,  the sources are stat'd if None.
+        :return: <list<tuple>> the pairs stored.
+        """
+        store_files = {}
+        stored = []
+        for src_path, store_path in pairs:
+            store_dir, fname = os.path.split(store_path)
+            if store_dir not in store_files:
+                store_files[store_dir] = utils.list_dir_files(store_dir)
+
+            if src_sizes:
+                src_size = src_sizes.get(src_path)
+            else:
+                try:
+                    src_size = os.stat(src_path).st_size
+                except OSError:
+                    continue
+
+            store_stat = store_files[store_dir].get(fname)
+            if store_stat and store_stat.st_size == src_size:
+                stored.append((src_path, store_path))
+
+        return stored
+
+    def _remove_stored(self, pairs, src_hashes=None):
+        """
+        Remove each source file stored,  after checking its hash matches the
+        storage copy when verify is set.  The files removed are added to the
+        'removed' metrics.
+
+        :param pairs: <list<tuple>> (source path, storage path) of each file.
+        :param src_hashes: <dict> source path: hash,  taken during the copy.
+        :return: <list<tuple>> the pairs with the source removed.
+        """
+        if verify:
+            with scrubber_metrics.phase('verify', inst=self.inst):
+                verified = utils.verify_transfers(pairs, log, verify_hash,
+                                                  verify_workers, src_hashes)
+            pairs = [pair for pair in pairs if pair[0] in verified]
+
+        removed = []
+        nbytes = 0
+        with scrubber_metrics.phase('remove', inst=self.inst):
+            for pair in pairs:
+                try:
+                    size = os.stat(pair[0]).st_size
+                    os.remove(pair[0])
+                except OSError as err:
+                    log.error(f"Failed to remove {pair[0]}: {err}")
+                    continue
+                removed.append(pair)
+                nbytes += size
+
+        with self.lock:
+            self.metrics['removed'][0] += len(removed)
+            self.metrics['removed'][1] += nbytes
+        scrubber_metrics.inc('scrubber_files_total', len(removed),
+                             kind='removed', inst=self.inst)
+        scrubber_metrics.inc('scrubber_bytes_total', nbytes, kind='removed',
+                             inst=self.inst)
+
+        return removed
+
+
+class RunPlan:
+    """
+    The transfers,  removals and DB updates of a run,  written by 'plan'
+    and run by 'apply'.
+    """
+    # the metric of each function and the level of its archive_dir update
+    METRICS = {'store_lev0_batch': 'koaid', 'store_lev0_func': 'koaid',
+               'store_stage_batch': 'staged', 'store_stage_func': 'staged',
+               'store_lev1_func': 'lev1', 'store_lev2_func': 'lev2'}
+    UPDATE_LEVEL = {'store_stage_batch': 0, 'store_stage_func': 0,
+                    'store_lev1_func': 1, 'store_lev2_func': 2}
+
+    def __init__(self, header, sections=None):
+        """
+        :param header: <dict> the inst, tel, utd, utd2 and settings of the run.
+        :param sections: <list<dict>> the tasks for each function.
+        """
+        self.header = header
+        self.sections = sections or []
+        self.listings = {}
+
+    def add_section(self, func_name, tasks, size_func, nfiles):
+        """
+        Add the tasks for a function to the plan.
+
+        :param func_name: <str> the ToDelete method to run the tasks.
+        :param tasks: <iterable<tuple>> source key, storage key, func args.
+        :param size_func: <func> returns the number of files, bytes and
+                                 storage directory of a task.
+        :param nfiles: <list<int>> the rows and completed rows,  counted as
+                                   the tasks are read.
+        """
+        section = {'func': func_name, 'tasks': []}
+        level = self.UPDATE_LEVEL.get(func_name)
+        for source_key, storage_key, func_args in tasks:
+            task_files, task_bytes, storage_dir = size_func(
+                func_name, func_args, self.listings)
+            if func_name.endswith('_batch'):
+                koaids = [result['koaid'] for result in func_args[2]]
+            else:
+                koaids = [func_args[0]['koaid']]
+
+            task = {'source': source_key, 'storage': storage_key,
+                    'args': list(func_args), 'files': task_files,
+                    'bytes': task_bytes, 'storage_dir': storage_dir,
+                    'koaids': koaids}
+            if level is not None and storage_dir:
+                task['update'] = ['ARCHIVE_DIR', storage_dir, level]
+            section['tasks'].append(task)
+
+        section['rows'], section['completed'] = nfiles
+        self.sections.append(section)
+
+    def totals(self):
+        """
+        :return: <dict> the files and bytes,  in total and per storage disk.
+        """
+        totals = {'files': 0, 'bytes': 0, 'tasks': 0, 'updates': 0,
+                  'storage_disk': {}}
+        for section in self.sections:
+            for task in section['tasks']:
+                totals['tasks'] += 1
+                totals['files'] += task['files']
+                totals['bytes'] += task['bytes']
+                if task.get('update'):
+                    totals['updates'] += len(task['koaids'])
+                disk = totals['storage_disk'].setdefault(str(task['storage']),
+                                                         [0, 0])
+                disk[0] += task['files']
+                disk[1] += task['bytes']
+
+        return totals
+
+    def estimate(self, throughput):
+        """
+        Estimate the runtime from the throughput of earlier runs.
+
+        :param throughput: <tuple> (bytes per second, files per second),
+                                   None if there is no history.
+        :return: <float> the estimated seconds,  None without history.
+        """
+        if not throughput:
+            self.header['estimate_seconds'] = None
+            return None
+
+        totals = self.totals()
+        bytes_sec, files_sec = throughput
+        seconds = max(totals['bytes'] / bytes_sec if bytes_sec else 0,
+                      totals['files'] / files_sec if files_sec else 0)
+        self.header['estimate_seconds'] = round(seconds, 1)
+
+        return seconds
+
+    def summary(self):
+        """
+        :return: <str> the totals of the plan for the log.
+        """
+        totals = self.totals()
+        summary = f"Plan for {self.header['inst']} {self.header['utd']} to " \
+                  f"{self.header['utd2']}:  {totals['tasks']} transfers, " \
+                  f"{totals['files']} files ({totals['bytes']} bytes), " \
+                  f"{totals['updates']} archive_dir updates."
+        if self.header.get('remove'):
+            summary += f"\n{totals['files']} source files removed."
+        for disk, cnt in sorted(totals['storage_disk'].items()):
+            summary += f"\nstorage disk {disk}: {cnt[0]} files ({cnt[1]} bytes)"
+
+        seconds = self.header.get('estimate_seconds')
+        if seconds is None:
+            summary += "\nestimated runtime: unknown (no throughput history)"
+        else:
+            summary += f"\nestimated runtime: {timedelta(seconds=int(seconds))}"
+
+        return summary
+
+    def write(self, plan_file):
+        plan = dict(self.header)
+        plan['totals'] = self.totals()
+        plan['sections'] = self.sections
+        with open(plan_file, 'w') as fp:
+            json.dump(plan, fp)
+
+    @classmethod
+    def read(cls, plan_file):
+        with open(plan_file) as fp:
+            plan = json.load(fp)
+
+        sections = plan.pop('sections')
+        plan.pop('totals', None)
+
+        return cls(plan, sections)
 
-        return 1
 
 class ChkArchive:
     def __init__(self, inst):
@@ -371,29 +1358,20 @@ class ChkArchive:
         self.deleted_column = utils.get_config_param(config, 'db_columns', 'deleted')
         self.status_col = utils.get_config_param(config, 'db_columns', 'status')
         self.nresults = {'del0': [0, 0], 'mv0': [0, 0], 'mv1': [0, 0], 'mv2': [0, 0]}
+        self.rejected = {}
 
         self.uniq_warn = []
         self.errors_dict = {}
 
-        self.to_move = []
-        self.move_lev1 = []
-        self.move_lev2 = []
+        self.inst = inst
+        self.levels_to_move = {0: move, 1: lev1, 2: lev2}
+        # the lev0 rows are read for the lev0 and the stage files
+        self.lev0_rows = None
 
         if not args.force:
-            add_str = "ARCHIVE_DIR IS NULL"
+            self.add_str = "ARCHIVE_DIR IS NULL"
         else:
-            add_str = None
-
-        if move:
-            self.to_move = self.file_list(args.utd, args.utd2, inst,
-                                          add_str, 'mv')
-        if lev1:
-            self.move_lev1 = self.file_list(
-                args.utd, args.utd2, inst, add_str, 'mv', level=1)
-
-        if lev2:
-            self.move_lev2 = self.file_list(
-                args.utd, args.utd2, inst, add_str, 'mv', level=2)
+            self.add_str = None
 
     def get_errors(self):
         return self.errors_dict
@@ -401,19 +1379,50 @@ class ChkArchive:
     def get_nresults(self):
         return self.nresults
 
+    def get_rejected(self):
+        return self.rejected
+
     def get_warnings(self):
         return self.uniq_warn
 
     def get_files_to_move(self, file_type=None):
         """
-        Access to the list of files to delete
+        Access to the files to move.  The query results are read as the
+        files are used.  The lev0 rows are kept as they are read,  so the
+        stage files are moved from the rows of the lev0 search,  without a
+        second search.
 
-        :return: <list/dict> the file list to of files to move
+        :param file_type: <str> the file type to move (None, lev1, lev2).
+        :return: <generator<dict>> the verified rows of the files to move
         """
-        if file_type:
-            return getattr(self, f'move_{file_type}')
+        level = int(file_type[-1]) if file_type else 0
+        if not self.levels_to_move[level]:
+            return []
 
-        return self.to_move
+        if level:
+            return self.file_list(args.utd, args.utd2, self.inst,
+                                  self.add_str, 'mv', level=level)
+
+        if self.lev0_rows is not None:
+            return iter(self.lev0_rows)
+
+        return self._keep_lev0_rows(
+            self.file_list(args.utd, args.utd2, self.inst, self.add_str, 'mv'))
+
+    def _keep_lev0_rows(self, rows):
+        """
+        Keep the lev0 rows as they are read,  the rows are only kept if the
+        search is read to the end.
+
+        :param rows: <generator<dict>> the verified rows of the lev0 search.
+        :return: <dict> yields each row.
+        """
+        kept = []
+        for result in rows:
+            kept.append(result)
+            yield result
+
+        self.lev0_rows = kept
 
     def num_all_files(self, utd, utd2):
         """
@@ -424,25 +1433,23 @@ class ChkArchive:
         :param utd2: <str> UT date at end of range.
         :return: <int> the number of files in the archive between the two dates.
         """
-        try:
-            results = utils.query_rti_api(site, 'search', 'GENERAL', log=log,
-                                          key=self.deleted_column, val='0',
-                                          columns='koaid', utd=utd, utd2=utd2)
-            archived_results = json.loads(results)
-            return len(archived_results['data'])
-        except:
-            return 0
+        rows = api.iter_search('GENERAL', page_size=page_size,
+                               key=self.deleted_column, val='0',
+                               columns='koaid', utd=utd, utd2=utd2)
+
+        return sum(1 for _ in rows)
 
     def file_list(self, utd, utd2, inst, add, cmd_type, level=0):
         """
         Query the database for the files to delete or move.  Verify
-        the results are valid
+        the results are valid.  The rows are read from the API as they are
+        used,  so the full results are not held in memory.
 
         :param utd: <str> YYYY-MM-DD initial date
         :param utd2: <str> YYYY-MM-DD the final date,  if None,  only one day
                            is searched.
         :param add: <str> the tail of the query string.
-        :return: <dict> the verified data results from the query
+        :return: <dict> yields the verified data results from the query
         """
         cmd_type = f'{cmd_type}{level}'
 
@@ -459,108 +1466,183 @@ class ChkArchive:
 
         search_type = 'GENERAL'
 
-        try:
-            results = utils.query_rti_api(site, 'search', search_type, log=log,
-                                          columns=columns, key=key, val=val,
-                                          add=add, utd=utd, utd2=utd2, inst=inst, level=level)
-            archived_results = json.loads(results)
-        except Exception as err:
-            self.log.info(f"NO RESULTS from query,  error: {err}")
-            return None
-
-        if archived_results.get('success') == 1:
-            self.log.info(f'{level} API Results = Success')
-
-            data = archived_results.get('data', [])
-            d_before = [dat['koaid'] for dat in data]
-            self.nresults[cmd_type][0] = len(data)
-
-            data = self.verify_db_results(data, columns)
-            if data:
-                self.nresults[cmd_type][1] = len(data)
-                d_after = [dat['koaid'] for dat in data]
-            else:
-                d_after = []
-
-            self.log.info(f"LEVEL {level} KOAIDs filtered from list: "
-                          f"{utils.diff_list(d_before, d_after)}")
-
-            return data
-
-        return None
-
-    def verify_db_results(self, data, column_str):
+        meta = {}
+        rows = api.iter_search(search_type, page_size=page_size, meta=meta,
+                               columns=columns, key=key, val=val, add=add,
+                               utd=utd, utd2=utd2, inst=inst, level=level)
+        rows = scrubber_metrics.timed_iter('scrubber_phase_seconds', rows,
+                                           phase='query', inst=inst)
+
+        # the counts are reset as the files for lev0 are read for each pass
+        self.nresults[cmd_type] = [0, 0]
+
+        def count_rows():
+            for result in rows:
+                if meta.get('success', 1) != 1:
+                    break
+                self.nresults[cmd_type][0] += 1
+                yield result
+
+        filtered = []
+        for result in self.verify_db_results(count_rows(), columns, filtered,
+                                             cmd_type):
+            self.nresults[cmd_type][1] += 1
+            yield result
+
+        for utd_range in meta.get('failed', []):
+            utd_ranges = self.errors_dict.setdefault(
+                'API search failed for the UT dates', [])
+            if utd_range not in utd_ranges:
+                utd_ranges.append(utd_range)
+
+        if meta.get('success') != 1:
+            self.log.info(f"NO RESULTS from query")
+            return
+
+        self.log.info(f'{level} API Results = Success')
+        self.log.info(f"LEVEL {level} KOAIDs filtered from list: {filtered}")
+
+    def verify_db_results(self, data, column_str, filtered=None,
+                          cmd_type=None):
         """
-        Verify the results.
-
-        :param data: <list / dict> the data portion of the json db results.
-        :return: data: <list / dict> cleaned db results.
+        Verify the results with the rules of scrubber_rules,  the cheapest
+        rules first over each batch of rows.
+
+        :param data: <iterable<dict>> the data portion of the json db results.
+        :param column_str: <str> the comma separated columns in the results.
+        :param filtered: <list> the koaids of the invalid results are added.
+        :param cmd_type: <str> the search,  the rows rejected by each rule
+                               are counted for it.
+        :return: data: <dict> yields the cleaned db results.
         """
-        if not data:
-            return None
+        engine = scrubber_rules.RuleEngine(
+            scrubber_rules.result_rules(column_str, self.archived_key,
+                                        optional=('status_code', 'archive_dir',
+                                                  'level')),
+            batch_size=batch_size)
+        if cmd_type:
+            self.rejected[cmd_type] = engine.rejected
 
-        columns = column_str.replace(' ', '').split(',')
+        def rejected(result, rule):
+            koaid = (result or {}).get('koaid', '')
+            if filtered is not None:
+                filtered.append(koaid)
 
-        filter_data = []
-        for result in data:
+            if rule.message not in self.uniq_warn:
+                self.uniq_warn.append(rule.message)
+            koaids = self.errors_dict.setdefault(rule.message, [])
+            if koaid not in koaids:
+                koaids.append(koaid)
 
-            err_msg = self._verify_result(result, columns)
-            if err_msg:
+            self.log.warning(f"ERROR: {rule.message}")
+            self.log.warning(f"ERROR with results for KOAID: {koaid}")
+            self.log.warning(f"{result}")
 
-                koaid = result.get('koaid', '')
-                if err_msg in self.errors_dict:
-                    if koaid not in self.errors_dict[err_msg]:
-                        self.errors_dict[err_msg].append(koaid)
-                else:
-                    self.errors_dict[err_msg] = [koaid]
+        yield from engine.verify(data, rejected)
 
-                self.log.warning(f"ERROR: {err_msg}")
-                self.log.warning(f"ERROR with results for KOAID: {result['koaid']}")
-                self.log.warning(f"{result}")
-                continue
 
-            filter_data.append(result)
+def write_metrics(metrics, nbytes_moved):
+    """
+    Add the totals of the run to the performance metrics and write them
+    to the [metrics] textfile and JSON summary.
 
-        return filter_data
+    :param metrics: <dict> the metrics of the run.
+    :param nbytes_moved: <int> the bytes moved from the KOA disk.
+    """
+    labels = {'scrubber': 'rti', 'inst': args.inst, 'tel': args.tel}
+    move_time = metrics.get('move_time', 0)
+    nfiles_moved = metrics.get('total_koa_mv', 0)
+
+    scrubber_metrics.inc('scrubber_files_total', nfiles_moved, kind='moved',
+                         inst=args.inst)
+    scrubber_metrics.inc('scrubber_bytes_total', nbytes_moved, kind='moved',
+                         inst=args.inst)
+    scrubber_metrics.set_gauge('scrubber_run_seconds', round(move_time, 3),
+                               inst=args.inst)
+    if move_time:
+        scrubber_metrics.set_gauge('scrubber_files_per_second',
+                                   round(nfiles_moved / move_time, 3),
+                                   inst=args.inst)
+        scrubber_metrics.set_gauge('scrubber_bytes_per_second',
+                                   round(nbytes_moved / move_time),
+                                   inst=args.inst)
+    scrubber_metrics.set_gauge('scrubber_last_run_timestamp_seconds',
+                               int(time.time()), inst=args.inst)
+
+    summary = {key: metrics.get(key) for key in
+               ('koaid', 'staged', 'lev1', 'lev2', 'removed', 'total_koa_mv',
+                'total_storage_mv', 'total_files', 'move_time')}
+    summary['bytes_moved'] = nbytes_moved
+    scrubber_metrics.write_run_metrics(config, f'rti_{args.tel}_{args.inst}',
+                                       labels, summary, log)
+
+
+def plan_space(capacity, run_plan):
+    """
+    :param capacity: <StorageCapacity> the storage preflight,  or None.
+    :param run_plan: <RunPlan> the plan.
+    :return: <list<str>> the storage disks without the space for the plan.
+    """
+    if not capacity:
+        return []
 
-    def _verify_result(self, result, columns):
-        """
-        Verify that the results make sense before sending them to be deleted.
+    return capacity.check({disk: cnt[1] for disk, cnt in
+                           run_plan.totals()['storage_disk'].items()})
 
-        :param result: <dict> a single row from the db query
-        :return: <bool, str> True if valid,  err_msg when invalid.
-        """
-        if not result:
-            return "No results found from query."
 
-        err = None
-        for col in columns:
-            if err:
-                break
-            val = result.get(col)
+def preflight(capacity, run_name, koa_before):
+    """
+    Place the run on a storage disk with the space for the KOA files
+    counted,  the UT date range is cut to the dates that fit.
 
-            if not val and col not in ['status_code', 'archive_dir', 'level']:
-                err = "INCOMPLETE RESULTS"
-            elif col == 'status' and val != self.archived_key:
-                err = f"INVALID STATUS, STATUS must be = {self.archived_key}"
-            elif col == 'process_dir' and 'lev' not in val.split('/')[-1]:
-                err = "INVALID ARCHIVE DIR"
+    :param capacity: <StorageCapacity> the storage preflight.
+    :param run_name: <str> the name of the run,  ie: k1_NIRES
+    :param koa_before: <dict> the counts of utils.count_koa_files.
+    :return: <dict> the counts of the dates placed,  None if none fits.
+    """
+    day_bytes = utils.utd_bytes(koa_before)
+    if not day_bytes:
+        return koa_before
 
-        if err and err not in self.uniq_warn:
-            self.uniq_warn.append(err)
+    with scrubber_metrics.phase('preflight', inst=args.inst):
+        store_num, last_utd = capacity.place(run_name, args.inst, day_bytes)
 
-        return err
+    if not last_utd:
+        return None
 
+    if last_utd < max(day_bytes):
+        args.utd2 = datetime.strptime(last_utd, '%Y%m%d').strftime('%Y-%m-%d')
+        log.warning(f'UT range cut to {args.utd} to {args.utd2},  the '
+                    f'storage disk {store_num} does not have the space')
+        return {count_dir: cnt for count_dir, cnt in koa_before.items()
+                if (utils.count_dir_utd(count_dir) or '') <= last_utd}
 
-if __name__ == '__main__':
+    return koa_before
+
+
+def run(run_config, run_args, shared=None, run_plan=None):
     """
-    to run:
-        python scrub_koa_rti.py --inst NIRC2 --tel k2 --utd 2021-02-11 --utd2 2021-02-12
+    Run the scrubber for one instrument and telescope.  The settings of the
+    run are the module globals used by ToDelete and ChkArchive.
+
+    :param run_config: <class 'configparser.ConfigParser'> the config file parser.
+    :param run_args: <obj> the arguments,  as from utils.parse_args.
+    :param shared: <dict> the executor,  helpers,  catalog,  storage
+                          preflight and storage directory cache shared by
+                          the runs of an orchestrator,  None to open them
+                          for this run.
+    :param run_plan: <RunPlan> the plan to apply.
+    :return: <dict> the metrics of the run.
     """
-    config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+    global config, args, config_type, move, lev1, lev2, batch, batch_size, \
+        verify, verify_hash, verify_workers, update_batch, page_size, user, \
+        log_name, log, api, catalog, helpers, journal, executor, backends, \
+        koa_mount, storage_mount
+
+    config = run_config
+    args = run_args
+    shared = shared if shared is not None else {}
 
-    args = utils.parse_args(config)
     print(f"UT Dates: {args.utd} to {args.utd2}")
     if args.dev:
         config_type = 'DEV'
@@ -570,13 +1652,27 @@ if __name__ == '__main__':
     move = int(utils.get_config_param(config, 'MODE', 'move'))
     lev1 = int(utils.get_config_param(config, 'MODE', 'lev1'))
     lev2 = int(utils.get_config_param(config, 'MODE', 'lev2'))
+    batch = int(utils.get_config_param(config, 'MODE', 'batch', default='0'))
+    batch_size = int(utils.get_config_param(config, 'MODE', 'batch_size',
+                                            default='1000'))
+    verify = int(utils.get_config_param(config, 'MODE', 'verify', default='0'))
+    verify_hash = utils.get_config_param(config, 'verify', 'hash',
+                                         default='blake2b')
+    verify_workers = int(utils.get_config_param(config, 'verify', 'workers',
+                                                default='4'))
+    update_batch = int(utils.get_config_param(config, 'api', 'update_batch',
+                                              default='1'))
+    page_size = int(utils.get_config_param(config, 'api', 'page_size',
+                                           default='0'))
 
     site = utils.get_config_param(config, config_type, f'site_{args.tel}')
     user = utils.get_config_param(config, config_type, 'user')
-    store_server = utils.get_config_param(config, config_type, 'store_server')
-    storage_root = utils.get_config_param(config, config_type, 'storage_root_rti')
-
-    storage_num = utils.get_config_param(config, 'storage_disk', args.inst)
+    # the mount of the /kNkoadata disks (empty for /) and of the storage
+    koa_mount = utils.get_config_param(config, config_type, 'koa_mount',
+                                       default='').rstrip('/')
+    storage_mount = utils.get_config_param(config, config_type,
+                                           'storage_mount',
+                                           default='/net/storageserver')
 
     if not args.logdir:
         log_dir = utils.get_config_param(config, config_type, 'log_dir')
@@ -588,55 +1684,178 @@ if __name__ == '__main__':
 
     log.info(f"Starting Scrub data in UT range: {args.utd} to {args.utd2}\n")
 
-    # this should be /koadata,  files_root becomes /k1koadata
-    basic_root = utils.get_config_param(config, 'koa_disk', 'path_root')
-    files_root = f"/{args.tel}{basic_root.strip('/')}"
-
-    nfiles_before = utils.count_koa_files(args, files_root)
-    # nfiles_before =9999
-    storage_direct = storage_root + storage_num
-    store_before = utils.count_store(user, store_server, f'{storage_direct}',
-                                     f'{args.inst}/*', log)
-    # store_before = 9999
-
-    log.info(f"MOVE KOA PROCESSED FILES to storage: {move}")
-
-    delete_obj = ToDelete(args.inst)
-    metrics = delete_obj.get_metrics()
-    if move:
-        metrics['koaid'] = delete_obj.del_mv(None, delete_obj.store_lev0_func)
-        # if args.inst == 'KPF':
-        #     delete_obj.store_kpf_components()
-        metrics['staged'] = delete_obj.del_mv(None, delete_obj.store_stage_func)
-
-    if lev1:
-        metrics['lev1'] = delete_obj.del_mv('lev1', delete_obj.store_lev1_func)
-
-    if lev2:
-        metrics['lev2'] = delete_obj.del_mv('lev2', delete_obj.store_lev2_func)
-
-    utils.clean_empty_dirs(files_root, log)
-    nfiles_after = utils.count_koa_files(args, files_root)
-    store_after = utils.count_store(user, store_server, f'{storage_direct}',
-                                    f'{args.inst}/*', log)
-
-    log.info(f'Number of KOA FILES before: {nfiles_before}')
-    log.info(f'Number of KOA FILES after: {nfiles_after}')
-
-    metrics['total_koa_mv'] = nfiles_before - nfiles_after
-    metrics['total_storage_mv'] = store_after - store_before
-    metrics['total_files'] = delete_obj.db_obj.num_all_files(args.utd, args.utd2)
-
-    report = utils.create_rti_report(args, metrics, move, args.inst)
-    log.info(report)
-
-    # only send report if difference in totals.
-    if metrics['total_koa_mv'] == metrics['total_storage_mv']:
-        report = None
-
-    utils.write_emails(config, report, log, errors=delete_obj.db_obj.get_errors(),
-                       prefix='RTI')
-
+    api = utils.get_rti_api(site, config, log)
+    catalog = shared.get('catalog') or scrubber_catalog.open_catalog(config)
+
+    history_file = utils.get_config_param(config, 'plan', 'history',
+                                          default='')
+    capacity = shared.get('capacity') or utils.create_capacity(config,
+                                                               config_type,
+                                                               log)
+    run_name = f'{args.tel}_{args.inst}'
+
+    if args.command == 'plan':
+        executor = None
+        delete_obj = ToDelete(args.inst)
+        delete_obj.plan = RunPlan({'inst': args.inst, 'tel': args.tel,
+                                   'utd': args.utd, 'utd2': args.utd2,
+                                   'config_type': config_type,
+                                   'remove': bool(delete_obj.rm),
+                                   'created': datetime.now().strftime(
+                                       '%Y-%m-%d %H:%M:%S')})
+        delete_obj.run_moves()
+        delete_obj.plan.estimate(utils.read_throughput(history_file, args.inst))
+        plan_file = args.plan_file or f'{log_dir}/rti_plan_{args.tel}_' \
+                                      f'{args.inst}_{args.utd}_{args.utd2}.json'
+        delete_obj.plan.write(plan_file)
+        log.info(delete_obj.plan.summary())
+        print(delete_obj.plan.summary())
+        for full in plan_space(capacity, delete_obj.plan):
+            log.warning(f'the plan does not fit,  {full}')
+            print(f'the plan does not fit,  {full}')
+        print(f"plan written to: {plan_file}")
+        if catalog and 'catalog' not in shared:
+            catalog.close()
+        return delete_obj.get_metrics()
+
+    helpers = shared.get('helpers') or scrubber_helper.HelperPool(config, log)
+    journal = scrubber_journal.open_journal(config, f'rti_{args.tel}_{args.inst}',
+                                            log)
+
+    # the run closes what it opened,  and releases the bytes held on the
+    # storage disks,  also if it fails
+    try:
+        # this should be /koadata,  files_root becomes /k1koadata
+        basic_root = utils.get_config_param(config, 'koa_disk', 'path_root')
+        files_root = f"{koa_mount}/{args.tel}{basic_root.strip('/')}"
+
+        # only count the directories that will be moved
+        count_levels = [level for level, on in enumerate((move, lev1, lev2))
+                        if on]
+        count_workers = int(utils.get_config_param(
+            config, 'executor', 'count_workers', default='8'))
+        with scrubber_metrics.phase('count', inst=args.inst):
+            koa_before = utils.count_koa_files(args, files_root,
+                                               levels=count_levels, stage=move)
+
+        # the transfers only start if they fit on the storage disks
+        no_space = None
+        if capacity and run_plan:
+            no_space = '; '.join(plan_space(capacity, run_plan)) or None
+        elif capacity:
+            placed = preflight(capacity, run_name, koa_before)
+            if placed is None:
+                no_space = f'no storage disk has the space for {args.utd}'
+            else:
+                koa_before = placed
+        if no_space:
+            log.error(f'files not moved,  {no_space}')
+
+        with scrubber_metrics.phase('count', inst=args.inst):
+            nfiles_before, nbytes_before = utils.count_totals(koa_before)
+            # count only the storage date directories for the run KOAIDs
+            storage_dirs = utils.storage_dirs_for_range(args.inst, args.utd,
+                                                        args.utd2, config,
+                                                        config_type,
+                                                        levels=count_levels,
+                                                        stage=move)
+            store_before = utils.count_totals(utils.count_storage_dirs(
+                storage_dirs, log, storage_mount, workers=count_workers))[0]
+
+        log.info(f"MOVE KOA PROCESSED FILES to storage: {move}")
+
+        executor = shared.get('executor') or utils.create_executor(config, log)
+        backends = utils.transfer_backends(config)
+
+        delete_obj = ToDelete(args.inst, store_dirs=shared.get('store_dirs'))
+        # the first run of an orchestrator sets the cache for the others
+        shared.setdefault('store_dirs', delete_obj.store_dirs)
+        delete_obj.recover()
+        metrics = delete_obj.get_metrics()
+        move_start = time.time()
+        if run_plan and not no_space:
+            delete_obj.apply_plan(run_plan)
+        elif not no_space:
+            delete_obj.run_moves()
+        move_time = time.time() - move_start
+
+        utils.clean_empty_dirs(files_root, log)
+        with scrubber_metrics.phase('count', inst=args.inst):
+            koa_after = utils.count_koa_files(args, files_root,
+                                              prev_counts=koa_before)
+            nfiles_after, nbytes_after = utils.count_totals(koa_after)
+            store_after = utils.count_totals(utils.count_storage_dirs(
+                storage_dirs, log, storage_mount, workers=count_workers))[0]
+
+        log.info(f'Number of KOA FILES before: {nfiles_before}')
+        log.info(f'Number of KOA FILES after: {nfiles_after}')
+        log.info(f'Bytes of KOA FILES moved: {nbytes_before - nbytes_after}')
+        for count_dir, cnt in koa_before.items():
+            log.info(f'{count_dir}: {cnt[0]} files ({cnt[1]} bytes) before, '
+                     f'{koa_after[count_dir][0]} files after')
+
+        utils.record_throughput(history_file, args.inst,
+                                nfiles_before - nfiles_after,
+                                nbytes_before - nbytes_after, move_time)
+
+        metrics['total_koa_mv'] = nfiles_before - nfiles_after
+        metrics['total_storage_mv'] = store_after - store_before
+        metrics['total_files'] = delete_obj.db_obj.num_all_files(args.utd, args.utd2)
+        metrics['move_time'] = move_time
+
+        metrics['transfer_limits'] = executor.report()
+
+        write_metrics(metrics, nbytes_before - nbytes_after)
+
+        report = utils.create_rti_report(args, metrics, move, args.inst)
+        log.info(report)
+
+        # only send report if difference in totals.
+        if metrics['total_koa_mv'] == metrics['total_storage_mv']:
+            report = None
+
+        errors = delete_obj.db_obj.get_errors()
+        if no_space:
+            errors = dict(errors or {}, **{f'files not moved,  {no_space}':
+                                           [run_name]})
+
+        utils.write_emails(config, report, log, errors=errors, prefix='RTI')
+    finally:
+        if capacity:
+            capacity.release(run_name)
+        if 'helpers' not in shared:
+            helpers.close()
+        if journal:
+            journal.close()
+        if catalog and 'catalog' not in shared:
+            catalog.close()
+
+    return metrics
 
 
+if __name__ == '__main__':
+    """
+    to run:
+        python scrub_koa_rti.py --inst NIRC2 --tel k2 --utd 2021-02-11 --utd2 2021-02-12
+    """
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
 
+    args = utils.parse_args(config, plan=True)
+    profiler = scrubber_profile.start(args.profile)
+    run_plan = None
+    if args.command == 'apply':
+        if not args.plan_file:
+            sys.exit("apply requires --plan_file")
+        run_plan = RunPlan.read(args.plan_file)
+        if (run_plan.header['inst'], run_plan.header['tel']) != (args.inst, args.tel):
+            sys.exit(f"the plan is for {run_plan.header['inst']} "
+                     f"{run_plan.header['tel']}")
+        args.utd = run_plan.header['utd']
+        args.utd2 = run_plan.header['utd2']
+
+    run(config, args, run_plan=run_plan)
+
+    if profiler:
+        profiler.set_log(log)
+        profiler.stop()
@@ -5,6 +5,7 @@ import configparser
 from datetime import datetime, timedelta
 
 import scrubber_utils as utils
+import scrubber_profile
 
 APP_PATH = os.path.abspath(os.path.dirname(__file__))
 CONFIG_FILE = f'{APP_PATH}/scrub_sdata_config.live.ini'
@@ -89,6 +90,9 @@ def parse_args(config, inst):
                         help="Only log the commands,  do not execute")
     parser.add_argument("--logdir", type=str,
                         help="Define the directory for the log.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the run,  the profile is written next "
+                             "to the log.")
 
     # add inst specific start/end ndays from the config if exist
     args, unknown_args = parser.parse_known_args()
@@ -121,6 +125,7 @@ if __name__ == '__main__':
 
     args = parse_args(config, 'KPF')
     print(args)
+    profiler = scrubber_profile.start(args.profile)
 
     if args.dev:
         config_type = 'DEV'
@@ -132,6 +137,8 @@ if __name__ == '__main__':
     pw = utils.get_config_param(config, 'passwords', 'eng_account')
 
     log = setup_log(config)
+    if profiler:
+        profiler.set_log(log)
     log.info(f"Scrubbing kpfguider images created before: {args.utd2}\n")
     log.info(f"directory: {direct}.\n")
 
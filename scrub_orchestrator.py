@@ -0,0 +1,237 @@
+"""
+Run the RTI scrubber for a list of instruments on both telescopes in one
+process.
+
+The runs share one API client (per site),  one storage directory cache,
+one helper pool,  one catalog and one transfer executor,  so the
+[source_limit] / [storage_limit] and the [executor] workers hold for all
+the runs together.  The runs are interleaved,  [orchestrator] jobs run at
+once,  so an instrument on a slow mount only holds its own transfers.
+
+Each run has its own copy of the scrub_koa_rti module (its settings are
+module globals),  the two telescopes of an instrument are not run at once
+(they write to the same log).
+
+To run:
+    python scrub_orchestrator.py
+    python scrub_orchestrator.py --inst NIRES,KCWI --tel k2 --utd 2021-02-11 --utd2 2021-02-12
+"""
+
+import sys
+import time
+import argparse
+import threading
+import configparser
+import logging
+import importlib.util
+
+from collections import deque
+
+import scrubber_utils as utils
+import scrubber_catalog
+import scrubber_helper
+import scrub_koa_rti
+
+
+def load_scrubber(name):
+    """
+    Load a copy of the scrub_koa_rti module for one run.
+
+    :param name: <str> the name of the copy,  ie: k2_NIRES
+    :return: <module> the module.
+    """
+    spec = importlib.util.spec_from_file_location(f'scrub_koa_rti_{name}',
+                                                  scrub_koa_rti.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def interleave_jobs(insts, tels):
+    """
+    Order the runs so the telescopes (source mounts) alternate and the two
+    runs of an instrument are apart.
+
+    :param insts: <list<str>> the instruments.
+    :param tels: <list<str>> the telescopes.
+    :return: <list<tuple>> (inst, tel) for each run.
+    """
+    jobs = []
+    for shift in range(len(tels)):
+        for indx, inst in enumerate(insts):
+            jobs.append((inst, tels[(indx + shift) % len(tels)]))
+
+    return jobs
+
+
+def run_jobs(jobs, job_func, workers):
+    """
+    Run the jobs in a pool of threads,  the next job is the first one whose
+    instrument is not running.
+
+    :param jobs: <list<tuple>> (inst, tel) for each run.
+    :param job_func: <func> runs one job,  job_func(inst, tel).
+    :param workers: <int> the jobs run at once.
+    :return: <dict> (inst, tel): the return of job_func.
+    """
+    pending = deque(jobs)
+    running = set()
+    results = {}
+    cond = threading.Condition()
+
+    def worker():
+        while True:
+            with cond:
+                while True:
+                    if not pending:
+                        return
+                    job = next((job for job in pending
+                                if job[0] not in running), None)
+                    if job:
+                        pending.remove(job)
+                        running.add(job[0])
+                        break
+                    cond.wait()
+            try:
+                results[job] = job_func(*job)
+            finally:
+                with cond:
+                    running.discard(job[0])
+                    cond.notify_all()
+
+    threads = [threading.Thread(target=worker, name=f'scrub_job_{indx}')
+               for indx in range(max(1, min(workers, len(jobs))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {job: results.get(job) for job in jobs}
+
+
+def run_one(config, args, shared, inst, tel):
+    """
+    Run the scrubber for one instrument and telescope.
+
+    :return: <dict> the metrics of the run,  None if it failed.
+    """
+    utd, utd2 = utils.default_utd_range(config, inst)
+    run_args = argparse.Namespace(dev=args.dev, logdir=args.logdir, inst=inst,
+                                  tel=tel, force=args.force, command='run',
+                                  plan_file=None, utd=args.utd or utd,
+                                  utd2=args.utd2 or utd2)
+
+    log.info(f'starting {inst} {tel}: {run_args.utd} to {run_args.utd2}')
+    start = time.time()
+    try:
+        metrics = load_scrubber(f'{tel}_{inst}').run(config, run_args, shared)
+    except Exception as err:
+        log.error(f'run {inst} {tel} failed: {err}', exc_info=True)
+        return None
+
+    log.info(f'finished {inst} {tel} in {time.time() - start:.1f} s')
+
+    return metrics
+
+
+def create_summary(results):
+    """
+    :param results: <dict> (inst, tel): the metrics of each run.
+    :return: <str> the files moved by each run.
+    """
+    lines = ['RTI ORCHESTRATOR SUMMARY']
+    for (inst, tel), metrics in results.items():
+        if metrics is None:
+            lines.append(f'{inst:>8} {tel}:  FAILED')
+            continue
+
+        lines.append(f"{inst:>8} {tel}:  {metrics.get('total_koa_mv', 0)} KOA "
+                     f"files moved,  {metrics.get('total_storage_mv', 0)} at "
+                     f"storage,  {metrics.get('move_time', 0):.1f} s")
+
+    return '\n'.join(lines)
+
+
+def parse_args(config):
+    """
+    Parse the command line arguments.
+
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :return: <obj> commandline arguments
+    """
+    parser = argparse.ArgumentParser(description="Run the RTI Data Scrubber "
+                                                 "for all instruments")
+
+    parser.add_argument("--dev", action="store_true",
+                        help="Only log the commands,  do not execute")
+    parser.add_argument("--logdir", type=str,
+                        help="Define the directory for the log.")
+    parser.add_argument("--inst", type=str,
+                        default=utils.get_config_param(config, 'inst_list',
+                                                       'insts'),
+                        help="Comma separated instruments,  default [inst_list].")
+    parser.add_argument("--tel", type=str, default='k1,k2',
+                        help="Comma separated telescopes,  default k1,k2.")
+    parser.add_argument("--force", type=int, default=0,
+                        help="Don't exclude files with archive_dir set.")
+    parser.add_argument("--jobs", type=int,
+                        help="The runs at once,  default [orchestrator] jobs.")
+    parser.add_argument("--utd", type=str,
+                        help="Start date to process YYYY-MM-DD,  default from "
+                             "[TIMEFRAME] for each instrument.")
+    parser.add_argument("--utd2", type=str,
+                        help="End date to process YYYY-MM-DD.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    config = configparser.ConfigParser()
+    config.read(scrub_koa_rti.CONFIG_FILE)
+
+    args = parse_args(config)
+
+    insts = [inst.strip().upper() for inst in args.inst.split(',') if inst.strip()]
+    tels = [tel.strip().lower() for tel in args.tel.split(',') if tel.strip()]
+    if set(tels) - {'k1', 'k2'}:
+        sys.exit(f'unknown telescope in: {args.tel}')
+
+    config_type = 'DEV' if args.dev else 'DEFAULT'
+    if args.logdir:
+        log_dir = args.logdir
+    else:
+        log_dir = utils.get_config_param(config, config_type, 'log_dir')
+
+    log_name, log_stream = utils.create_logger('rti_orchestrator', log_dir)
+    log = logging.getLogger(log_name)
+
+    jobs = args.jobs or int(utils.get_config_param(config, 'orchestrator',
+                                                   'jobs', default='4'))
+
+    # the API client of each site,  shared by the runs,  logs to this log
+    for tel in tels:
+        utils.get_rti_api(utils.get_config_param(config, config_type,
+                                                 f'site_{tel}'), config, log)
+
+    shared = {'executor': utils.create_executor(config, log),
+              'helpers': scrubber_helper.HelperPool(config, log)}
+    catalog = scrubber_catalog.open_catalog(config)
+    if catalog:
+        shared['catalog'] = catalog
+    capacity = utils.create_capacity(config, config_type, log)
+    if capacity:
+        shared['capacity'] = capacity
+
+    log.info(f'running {len(insts)} instruments on {tels},  {jobs} at once')
+    results = run_jobs(interleave_jobs(insts, tels),
+                       lambda inst, tel: run_one(config, args, shared, inst, tel),
+                       jobs)
+
+    summary = create_summary(results)
+    log.info(summary)
+    print(summary)
+
+    shared['helpers'].close()
+    if catalog:
+        catalog.close()
@@ -1,12 +1,19 @@
 import os
 import re
-import sys
+import bisect
 import pwd
 import grp
+import time
+import itertools
 import configparser
 import logging
-import json
 import scrubber_utils as utils
+import scrubber_catalog
+import scrubber_helper
+import scrubber_journal
+import scrubber_metrics
+import scrubber_profile
+import scrubber_rules
 
 from datetime import datetime, timedelta
 from glob import glob
@@ -26,8 +33,12 @@ class ToDelete:
         self.dirs_made = []
         self.lev1_moved = []
         self.paths2cln = set()
+        self.updates = utils.BulkUpdater(self._send_update, self._log_update,
+                                         update_batch, log,
+                                         done_func=self._update_done)
         self.metrics = {'staged': [0, 0], 'sdata': [0, 0], 'koaid': [0, 0],
                         'inst': [0, 0], 'nresults': self.db_obj.get_nresults(),
+                        'rejected': self.db_obj.get_rejected(),
                         'warnings': self.db_obj.get_warnings()}
 
     def get_metrics(self):
@@ -39,18 +50,73 @@ class ToDelete:
 
         :return: <list<int>,<int>> number moved/deleted, number in list.
         """
-        if not sdata_files:
-            return [0, 0]
-
+        nfiles = 0
         n_files_touched = 0
         for result in sdata_files:
+            nfiles += 1
             # rsync will return 1 per file,  when it succeeds
-            n_files_touched += self.rm_sdata_func(result)
+            n_files_touched += self.journaled(self.rm_sdata_func, result)
+
+        if not nfiles:
+            return [0, 0]
 
         if self.inst == 'KPF':
             self.clean_up_kpf()
 
-        return [len(sdata_files), n_files_touched]
+        self.updates.flush()
+
+        return [nfiles, n_files_touched]
+
+    def journaled(self, func, *func_args):
+        """
+        Run func with its intent and commit written to the journal.
+
+        :param func: <func> a method of ToDelete that removes files.
+        :return: the return value of func.
+        """
+        if not journal:
+            return func(*func_args)
+
+        seq = journal.intent('remove', func=func.__name__, args=list(func_args))
+        ret_val = func(*func_args)
+        journal.commit([seq])
+
+        return ret_val
+
+    def recover(self):
+        """
+        Roll forward the steps left incomplete in the journal by an
+        interrupted run,  before the new work begins.
+        """
+        if not journal:
+            return
+
+        entries = journal.incomplete()
+        if not entries:
+            return
+
+        log.warning(f'recovering {len(entries)} incomplete steps from the '
+                    f'journal: {journal.path}')
+
+        for entry in entries:
+            if entry['step'] != 'remove':
+                continue
+            func = getattr(self, entry['func'], None)
+            if not func:
+                log.error(f'unknown journal step: {entry}')
+                continue
+            try:
+                func(*entry['args'])
+            except Exception as err:
+                log.error(f"Error recovering {entry['func']}: {err}")
+                continue
+            journal.commit([entry['seq']])
+
+        for entry in entries:
+            if entry['step'] == 'update':
+                self.updates.add(tuple(entry['update']), entry['koaid'])
+
+        self.updates.flush()
 
     def rm_sdata_func(self, result):
         """
@@ -88,29 +154,48 @@ class ToDelete:
 
         :param koaid: <str> koaid of file to mark as deleted
         """
-        results = utils.query_rti_api(site, 'update', 'MARKDELETED',
-                                      log=log, val=koaid)
-        self._log_update(koaid, results, 'SOURCE_DELETED')
+        if journal:
+            journal.update_intent(('SOURCE_DELETED',), koaid)
+
+        self.updates.add(('SOURCE_DELETED',), koaid)
+
+    def _send_update(self, update, koaids):
+        """
+        Send one API update for a list of koaids.
+
+        :param update: <tuple> the column name
+        :param koaids: <list> the koaids to update.
+        :return: <dict> the decoded database results
+        """
+        with scrubber_metrics.phase('update', inst=self.inst):
+            return api.update('MARKDELETED', val=','.join(koaids))
+
+    def _update_done(self, koaids, update):
+        """
+        Record the koaids marked as deleted in the catalog.
+
+        :param koaids: <list> the koaids that were updated.
+        :param update: <tuple> the column name
+        """
+        if journal:
+            journal.commit_updates(update, koaids)
+
+        if catalog:
+            catalog.mark_deleted(koaids)
 
     def _log_update(self, koaid, results, column):
         """
         Log the update
 
         :param koaid: <str> koaid of files to update
-        :param results: <str> the database results in json format
+        :param results: <dict> the decoded database results
         :param column: <str> the column name for logging
         """
-        try:
-            results = json.loads(results)
-        except Exception as err:
-            self.log.warning(f"Error: {err}, line: {sys.exc_info()[-1].tb_lineno}")
-
         if results and type(results) == dict and results['success'] == 1:
             self.log.info(f"{results['data']}")
             self.log.info(f"{column} set for koaid: {koaid}")
         else:
-            self.log.warning(f"{column} not set for: {koaid}, "
-                             f"line: {sys.exc_info()[-1].tb_lineno}")
+            self.log.warning(f"{column} not set for: {koaid}")
             return False
 
         return True
@@ -220,10 +305,11 @@ class ToDelete:
                 log.warning(f"UID {uid} is not approved to remove files.")
                 return False
             if os.path.isdir(local_path):
-                command = ["rmdir", local_path]
+                op = ["rmdir", local_path]
             else:
-                command = ["rm", local_path]
-            success = utils.run_cmd_as_user(uid, gid, command, log)
+                op = ["remove", local_path]
+            with scrubber_metrics.phase('remove', inst=self.inst):
+                success = helpers.run_op(uid, gid, op)
             if not success:
                 return False
 
@@ -315,13 +401,10 @@ class ChkArchive:
     def __init__(self, inst):
         self.log = logging.getLogger(log_name)
         self.nresults = {'sdata': [0, 0]}
+        self.rejected = {}
         self.uniq_warn = []
         self.errors_dict = {}
-        self.move_sdata = []
-
-        if sdata_move:
-            add = f"{deleted_col} IS NULL"
-            self.move_sdata = self.get_file_list(args.utd, args.utd2, inst, add)
+        self.inst = inst
 
     def get_errors(self):
         return self.errors_dict
@@ -329,16 +412,25 @@ class ChkArchive:
     def get_nresults(self):
         return self.nresults
 
+    def get_rejected(self):
+        return self.rejected
+
     def get_warnings(self):
         return self.uniq_warn
 
     def get_files_to_move(self):
         """
-        Access to the list of files to delete
+        Access to the files to delete.  The query results are read as the
+        files are used,  so each call runs the query.
 
-        :return: <list/dict> the file list to of files to move
+        :return: <generator<dict>> the verified rows of the files to delete
         """
-        return self.move_sdata
+        if not sdata_move:
+            return []
+
+        add = f"{deleted_col} IS NULL"
+
+        return self.get_file_list(args.utd, args.utd2, self.inst, add)
 
     def num_all_files(self, utd, utd2):
         """
@@ -349,14 +441,10 @@ class ChkArchive:
         :param utd2: <str> UT date at end of range.
         :return: <int> the number of files in the archive between the two dates.
         """
-        try:
-            results = utils.query_rti_api(site, 'search', 'GENERAL', log=log,
-                                          key=deleted_col, val='0',
-                                          columns='koaid', utd=utd, utd2=utd2)
-            archived_results = json.loads(results)
-            return len(archived_results['data'])
-        except:
-            return 0
+        rows = api.iter_search('GENERAL', page_size=page_size, key=deleted_col,
+                               val='0', columns='koaid', utd=utd, utd2=utd2)
+
+        return sum(1 for _ in rows)
 
     def kpf_move_data(self, utd, utd2):
         def daterange(start_date, end_date):
@@ -382,7 +470,8 @@ class ChkArchive:
     def get_file_list(self, utd, utd2, inst, add):
         """
         Query the database for the files to delete or move.  Verify
-        the results are valid
+        the results are valid.  The rows are read from the API as they are
+        used,  so the full results are not held in memory.
 
         :param utd: <str> YYYY-MM-DD initial date
         :param utd2: <str> YYYY-MM-DD the final date,  if None,  only one day
@@ -390,7 +479,7 @@ class ChkArchive:
         :param inst: <str> the instrument name
         :param add: <str> the tail of the query string.
 
-        :return: <list><dict> the verified data results from the query
+        :return: <dict> yields the verified data results from the query
         """
         cmd_type = 'sdata'
 
@@ -401,145 +490,177 @@ class ChkArchive:
         key = status_col
         val = archived_key
 
-        try:
-            results = utils.query_rti_api(site, 'search', 'GENERAL', log=log,
-                                          columns=columns, key=key, val=val,
-                                          add=add, utd=utd, utd2=utd2, inst=inst)
-            archived_results = json.loads(results)
-        except Exception as err:
-            self.log.info(f"NO RESULTS from query,  error: {err}")
-            return []
-
-        success = archived_results.get('success')
-        if success != 1:
-            return []
+        meta = {}
+        rows = api.iter_search('GENERAL', page_size=page_size, meta=meta,
+                               columns=columns, key=key, val=val, add=add,
+                               utd=utd, utd2=utd2, inst=inst)
+        rows = scrubber_metrics.timed_iter('scrubber_phase_seconds', rows,
+                                           phase='query', inst=inst)
+
+        self.nresults[cmd_type] = [0, 0]
+        filtered = []
+
+        def count_rows():
+            for dat in rows:
+                if meta.get('success', 1) != 1:
+                    break
+                self.nresults[cmd_type][0] += 1
+                yield dat
+
+        # the storage check (over NFS) runs only on the rows with valid fields
+        for dat in self.verify_db_results(count_rows(), columns, filtered,
+                                          cmd_type):
+            self.nresults[cmd_type][1] += 1
+            yield dat
+
+        for utd_range in meta.get('failed', []):
+            utd_ranges = self.errors_dict.setdefault(
+                'API search failed for the UT dates', [])
+            if utd_range not in utd_ranges:
+                utd_ranges.append(utd_range)
+
+        if meta.get('success') != 1:
+            self.log.info(f"NO RESULTS from query")
+            return
 
-        self.log.info(f"API Results = Success {success}")
+        self.log.info(f"API Results = Success {meta.get('success')}")
+        self.log.info(f"KOAIDs filtered from list: {filtered}")
 
-        data = archived_results.get('data', [])
-        d_before = [dat['koaid'] for dat in data]
+    def check_files_stored(self, rows):
+        """
+        Check the files of the rows are at storage.  Each storage directory
+        is listed once for the rows,  in place of a glob for each file.
 
-        # check that all values in the list have been archived
-        archived_data = []
-        for dat in data:
-            if not self.check_file_stored(dat):
+        :param rows: <list<dict>> the db rows.
+        :return: <list<bool>> True for each row with its file at storage.
+        """
+        listings = {}
+        stored = []
+        catalog_files = []
+        for dat in rows:
+            ofname = dat.get('ofname', None)
+            koaid = dat.get('koaid', None)
+            if not koaid or not ofname:
+                log.error(f'not removing, cannot determine ofname or koaid: {dat}')
+                stored.append(False)
                 continue
 
-            archived_data.append(dat)
-
-        self.nresults[cmd_type][0] = len(archived_data)
-
-        archived_data = self.verify_db_results(archived_data, columns)
-
-        if archived_data:
-            self.nresults[cmd_type][1] = len(archived_data)
-            d_after = [dat['koaid'] for dat in archived_data]
-        else:
-            d_after = []
-
-        self.log.info(f"KOAIDs filtered from list: "
-                      f"{utils.diff_list(d_before, d_after)}")
-
-        return archived_data
+            filename = ofname.split('/')[-1]
+
+            # the default storage disk,  then the overflow disk
+            store_dirs = [utils.determine_storage(koaid, config, config_type,
+                                                  ofname=ofname)]
+            if overflow_disk:
+                store_dirs.append(utils.determine_storage(
+                    koaid, config, config_type, ofname=ofname,
+                    store_num=overflow_disk))
+
+            # an index lookup in the catalog before the listing over NFS
+            if catalog and any(catalog.is_stored(store_dir, filename)
+                               for store_dir in store_dirs):
+                log.info(f'File found stored (catalog) at: {store_dirs}/{filename}')
+                stored.append(True)
+                continue
 
-    @staticmethod
-    def check_file_stored(dat):
-        ofname = dat.get('ofname', None)
-        koaid = dat.get('koaid', None)
-        if not koaid or not ofname:
-            log.error(f'not removing, cannot determine ofname or koaid: {dat}')
-            return False
+            matched = []
+            for store_dir in dict.fromkeys(store_dirs):
+                store_path = f'{storage_mount}/{store_dir}'
+                if store_path not in listings:
+                    store_files = utils.list_dir_files(store_path)
+                    listings[store_path] = (store_files, sorted(store_files))
+                store_files, names = listings[store_path]
+
+                # the names are sorted,  the files of filename* are contiguous
+                indx = bisect.bisect_left(names, filename)
+                while indx < len(names) and names[indx].startswith(filename):
+                    matched.append(names[indx])
+                    indx += 1
+                if matched:
+                    break
+
+            if not matched:
+                log.error(f'data not on storage: {storage_mount}/'
+                          f'{store_dirs[0]}/{filename}* data: {dat}')
+                stored.append(False)
+                continue
 
-        store_dir = utils.determine_storage(koaid, config, config_type,
-                                            ofname=ofname)
+            catalog_files += [(koaid, 0, None, name, store_dir,
+                               store_files[name].st_size,
+                               store_files[name].st_mtime) for name in matched]
 
-        filename = ofname.split('/')[-1]
-        storage_path = f'/net/storageserver/{store_dir}/{filename}*'
-        if not utils.chk_file_exists(storage_path):
-            log.error(f'data not on storage: {storage_path} data: {dat}')
-            return False
+            log.info(f'File found stored at: {store_path}/{filename}*')
+            stored.append(True)
 
-        log.info(f'File found stored at: {storage_path}')
+        if catalog and catalog_files:
+            catalog.record_stored(catalog_files)
 
-        return True
+        return stored
 
-    def verify_db_results(self, data, column_str):
+    def verify_db_results(self, data, column_str, filtered=None,
+                          cmd_type=None):
         """
-        Verify the results.
-
-        :param data: <list / dict> the data portion of the json db results.
-        :return: data: <list / dict> cleaned db results.
+        Verify the results with the rules of scrubber_rules,  the cheapest
+        rules first over each batch of rows,  the file at storage is checked
+        last.
+
+        :param data: <iterable<dict>> the data portion of the json db results.
+        :param column_str: <str> the comma separated columns in the results.
+        :param filtered: <list> the koaids of the invalid results are added.
+        :param cmd_type: <str> the search,  the rows rejected by each rule
+                               are counted for it.
+        :return: data: <dict> yields the cleaned db results.
         """
-        if not data:
-            return None
-
-        columns = column_str.replace(' ', '').split(',')
-
-        filter_data = []
-        for result in data:
-
-            err_msg = self._verify_result(result, columns)
-            if err_msg:
-
-                koaid = result.get('koaid', '')
-                if err_msg in self.errors_dict:
-                    if koaid not in self.errors_dict[err_msg]:
-                        self.errors_dict[err_msg].append(koaid)
-                else:
-                    self.errors_dict[err_msg] = [koaid]
-
-                self.log.warning(f"ERROR: {err_msg} for {result}")
-                continue
-
-            # skip files with paths that include the 'path_exclude' string
-            if path_exclude and path_exclude in result['ofname']:
-                log_str = f"skipping {result['ofname']} -- contains: {path_exclude}."
-                log.info(log_str)
-                continue
-
-            filter_data.append(result)
-
-        return filter_data
+        rules = scrubber_rules.result_rules(
+            column_str, archived_key, optional=('status_code', 'archive_dir',
+                                                'source_deleted', 'stage_file'))
+        # skip files with paths that include the 'path_exclude' string
+        if path_exclude:
+            rules.append(scrubber_rules.path_exclude_rule(path_exclude))
+        rules.append(scrubber_rules.stored_rule(self.check_files_stored))
 
-    def _verify_result(self, result, columns):
-        """
-        Verify that the results make sense before sending them to be deleted.
+        engine = scrubber_rules.RuleEngine(rules)
+        if cmd_type:
+            self.rejected[cmd_type] = engine.rejected
 
-        :param result: <dict> a single row from the db query
-        :return: <bool, str> True if valid,  err_msg when invalid.
-        """
-        if not result:
-            return "No results found from query."
+        def rejected(result, rule):
+            koaid = (result or {}).get('koaid', '')
+            if filtered is not None:
+                filtered.append(koaid)
 
-        err = None
-        for col in columns:
-            if err:
-                break
-            val = result.get(col)
+            if not rule.error:
+                log.info(f"skipping {koaid} -- {rule.message}.")
+                return
 
-            if not val and col not in ['status_code', 'archive_dir',
-                                       'source_deleted', 'stage_file']:
-                err = "INCOMPLETE RESULTS {}"
-            elif col == 'status' and val != archived_key:
-                err = f"INVALID STATUS, STATUS must be = {archived_key}"
-            elif col == 'process_dir' and 'lev' not in val.split('/')[-1]:
-                err = "INVALID ARCHIVE DIR"
+            if rule.message not in self.uniq_warn:
+                self.uniq_warn.append(rule.message)
+            koaids = self.errors_dict.setdefault(rule.message, [])
+            if koaid not in koaids:
+                koaids.append(koaid)
 
-        if err and err not in self.uniq_warn:
-            self.uniq_warn.append(err)
+            self.log.warning(f"ERROR: {rule.message} for {result}")
 
-        return err
+        yield from engine.verify(data, rejected)
 
 
-if __name__ == '__main__':
+def run(run_config, run_args, shared=None):
     """
-    to run:
-        python scrub_sdata_nightly.py --utd 2021-02-11 --utd2 2021-02-12
+    Run the sdata scrubber for one instrument.  The settings of the run are
+    the module globals used by ToDelete and ChkArchive.
+
+    :param run_config: <class 'configparser.ConfigParser'> the config file parser.
+    :param run_args: <obj> the arguments,  as from utils.parse_args.
+    :param shared: <dict> the helpers shared with the caller,  None to open
+                          them for this run.
+    :return: <dict> the metrics of the run.
     """
-    config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+    global config, args, config_type, sdata_move, update_batch, page_size, \
+        deleted_col, archived_key, status_col, approved_uids, path_exclude, \
+        inst_comp, log_name, log, api, catalog, helpers, journal, inst_name, \
+        koa_disk_num, storage_mount, overflow_disk
 
-    args = utils.parse_args(config)
+    config = run_config
+    args = run_args
+    shared = shared if shared is not None else {}
 
     if args.dev:
         config_type = 'DEV'
@@ -555,7 +676,15 @@ if __name__ == '__main__':
         sdata_move = 0
 
     site = utils.get_config_param(config, config_type, f'site_{args.tel}')
-    store_server = utils.get_config_param(config, config_type, 'store_server')
+    update_batch = int(utils.get_config_param(config, 'api', 'update_batch',
+                                              default='1'))
+    page_size = int(utils.get_config_param(config, 'api', 'page_size',
+                                           default='0'))
+    storage_mount = utils.get_config_param(config, config_type, 'storage_mount',
+                                           default='/net/storageserver')
+    # the files of a full storage disk are moved to the overflow disk
+    overflow_disk = utils.get_config_param(config, 'storage_capacity',
+                                           'overflow', default='')
 
     deleted_col = utils.get_config_param(config, 'db_columns', 'deleted')
     archived_key = utils.get_config_param(config, 'archive', 'archived')
@@ -588,42 +717,100 @@ if __name__ == '__main__':
     log.info(f"Scrubbing sdata in UT range: {args.utd} to {args.utd2}\n")
     log.info(f"Avoiding paths with: {path_exclude}")
 
-    delete_obj = ToDelete(inst_name)
-    metrics = delete_obj.get_metrics()
-    sdata_files = delete_obj.db_obj.get_files_to_move()
-
-    if not sdata_files:
-        exit("No files found to remove.")
+    api = utils.get_rti_api(site, config, log)
+    catalog = scrubber_catalog.open_catalog(config)
+    helpers = shared.get('helpers') or scrubber_helper.HelperPool(config, log)
+    journal = scrubber_journal.open_journal(config, f'sdata_{inst_name}', log)
 
+    # the run closes what it opened,  also if it fails
     try:
-        mv_path = sdata_files[0]['ofname']
-    except:
-        mv_path = None
-
-    if mv_path:
-        nfiles_before = utils.count_koa(mv_path, log)
-    else:
-        nfiles_before = 0
-
-    koa_disk_num = utils.get_config_param(config, 'koa_disk', inst_name)
-    if sdata_move:
-        metrics['sdata'] = delete_obj.rm_sdata_files(sdata_files)
-
-    # count files after
-    nfiles_after = utils.count_koa(mv_path, log)
-
-    log.info(f'Number of SDATA FILES before: {nfiles_before}')
-    log.info(f'Number of SDATA FILES after: {nfiles_after}')
-
-    metrics['total_sdata_mv'] = nfiles_before - nfiles_after
-    metrics['total_files'] = delete_obj.db_obj.num_all_files(args.utd, args.utd2)
+        delete_obj = ToDelete(inst_name)
+        delete_obj.recover()
+        metrics = delete_obj.get_metrics()
+        sdata_files = iter(delete_obj.db_obj.get_files_to_move())
+        first_file = next(sdata_files, None)
+
+        if not first_file:
+            print("No files found to remove.")
+            log.info("No files found to remove.")
+            return metrics
+
+        sdata_files = itertools.chain([first_file], sdata_files)
+        mv_path = first_file.get('ofname')
+
+        if mv_path:
+            nfiles_before = utils.count_koa(mv_path, log)
+        else:
+            nfiles_before = 0
 
-    report = utils.create_sdata_report(args, metrics, inst_name)
-    log.info(report)
+        koa_disk_num = utils.get_config_param(config, 'koa_disk', inst_name)
+        rm_start = time.time()
+        if sdata_move:
+            metrics['sdata'] = delete_obj.rm_sdata_files(sdata_files)
+        rm_time = time.time() - rm_start
+
+        # count files after
+        nfiles_after = utils.count_koa(mv_path, log)
+
+        log.info(f'Number of SDATA FILES before: {nfiles_before}')
+        log.info(f'Number of SDATA FILES after: {nfiles_after}')
+
+        metrics['total_sdata_mv'] = nfiles_before - nfiles_after
+        metrics['total_files'] = delete_obj.db_obj.num_all_files(args.utd,
+                                                                 args.utd2)
+        metrics['rm_time'] = rm_time
+
+        nremoved = metrics['total_sdata_mv']
+        scrubber_metrics.inc('scrubber_files_total', nremoved, kind='removed',
+                             inst=inst_name)
+        scrubber_metrics.set_gauge('scrubber_run_seconds', round(rm_time, 3),
+                                   inst=inst_name)
+        if rm_time:
+            scrubber_metrics.set_gauge('scrubber_files_per_second',
+                                       round(nremoved / rm_time, 3),
+                                       inst=inst_name)
+        scrubber_metrics.set_gauge('scrubber_last_run_timestamp_seconds',
+                                   int(time.time()), inst=inst_name)
+        scrubber_metrics.write_run_metrics(
+            config, f'sdata_{inst_name}',
+            {'scrubber': 'sdata', 'inst': inst_name},
+            {'sdata': metrics.get('sdata'), 'total_sdata_mv': nremoved,
+             'total_files': metrics['total_files'], 'rm_time': rm_time}, log)
+
+        report = utils.create_sdata_report(args, metrics, inst_name)
+        log.info(report)
+
+        utils.write_emails(config, report, log,
+                           errors=delete_obj.db_obj.get_errors(),
+                           prefix=f'{inst_name} SDATA')
+    finally:
+        close_run(helpers, journal, catalog, 'helpers' not in shared)
+
+    return metrics
+
+
+def close_run(helpers, journal, catalog, close_helpers=True):
+    if close_helpers:
+        helpers.close()
+    if journal:
+        journal.close()
+    if catalog:
+        catalog.close()
 
-    utils.write_emails(config, report, log, errors=delete_obj.db_obj.get_errors(),
-                       prefix=f'{inst_name} SDATA')
 
+if __name__ == '__main__':
+    """
+    to run:
+        python scrub_sdata_nightly.py --utd 2021-02-11 --utd2 2021-02-12
+    """
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
 
+    args = utils.parse_args(config)
+    profiler = scrubber_profile.start(args.profile)
 
+    run(config, args)
 
+    if profiler:
+        profiler.set_log(log)
+        profiler.stop()
@@ -0,0 +1,602 @@
+"""
+The client of the KOA RTI API:  the pooled session,  the paged and sharded
+searches,  the streamed JSON rows and the batched updates.
+
+Loaded by scrubber_utils on the first use of one of its names,  requests
+is only imported by the runs that use the API.
+"""
+
+import json
+import time
+import codecs
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+import scrubber_metrics
+from scrubber_utils import get_config_param, utd_shards
+
+
+# use the faster json decoder when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+class RtiApi:
+    """
+    Client for the KOA RTI API.  One pooled,  keep-alive session is shared
+    for all the queries of a run.  The searches are retried with a backoff,
+    the updates are sent once.
+    """
+    def __init__(self, url, timeout=(10, 120), retries=3, backoff=2.0,
+                 pool_size=10, shard_days=0, shard_workers=4, log=None):
+        """
+        :param url: <str> the API url.
+        :param timeout: <tuple> the connect and read timeouts in seconds.
+        :param retries: <int> the number of retries for a search.
+        :param backoff: <float> seconds before the first retry,  doubled for
+                                each retry after.
+        :param pool_size: <int> the number of connections kept open.
+        :param shard_days: <int> the days in each search of a longer UT date
+                                 range,  0 searches the range at once.
+        :param shard_workers: <int> the shard searches run at once.
+        :param log: <class 'logging.Logger'> the log
+        """
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.shard_days = shard_days
+        self.shard_workers = max(1, shard_workers)
+        self.log = log
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+    def request(self, qtype, type_val, **params):
+        """
+        Send the query to the API.  The parameters are url encoded,  those
+        without a value are not sent.
+
+        :param qtype: <str> type of query [search, update].
+        :param type_val: <str> the query name,  [GENERAL, HEADER, etc].
+        :param params: the query parameters (val, columns, key, inst, utd,
+                       utd2, update_val, add, level).
+        :return: <bytes> the response content,  None on error.
+        """
+        if qtype not in ['search', 'update']:
+            return None
+
+        query = {qtype: type_val}
+        query.update({key: val for key, val in params.items() if val})
+
+        # only the searches are safe to send again
+        attempts = self.retries + 1 if qtype == 'search' else 1
+        for attempt in range(attempts):
+            try:
+                with scrubber_metrics.timer('scrubber_api_seconds', qtype=qtype,
+                                            query=type_val):
+                    response = self.session.get(self.url, params=query,
+                                                timeout=self.timeout)
+                if self.log:
+                    self.log.info(f'API URL: {response.url}')
+                response.raise_for_status()
+                return response.content
+            except RequestException as err:
+                if self.log:
+                    self.log.warning(f'API {qtype} failed ({attempt + 1}/'
+                                     f'{attempts}): {err}')
+                if attempt + 1 < attempts:
+                    time.sleep(self.backoff * 2 ** attempt)
+
+        return None
+
+    def query(self, qtype, type_val, **params):
+        """
+        Send the query to the API and decode the json results.
+
+        :return: <dict> the decoded results,  None on error.
+        """
+        content = self.request(qtype, type_val, **params)
+        if not content:
+            return None
+
+        try:
+            return json_loads(content)
+        except ValueError as err:
+            if self.log:
+                self.log.warning(f'Could not decode the API results: {err}')
+            return None
+
+    def search(self, type_val, **params):
+        return self.query('search', type_val, **params)
+
+    def iter_search(self, type_val, page_size=0, meta=None, **params):
+        """
+        Search the API and yield the result rows one at a time,  the
+        response is parsed as it is read so the full results are never held
+        in memory.
+
+        With a page_size the search is paged by koaid (keyset),  each page
+        asks for the koaids after the largest koaid read.  A page that fails
+        is fetched again from the largest koaid read.  The paging needs the
+        API to accept limit and order=koaid,  so the page_size is 0 (one
+        request) in the configuration files.
+
+        A UT date range longer than shard_days is split into shards that are
+        searched at once (see _iter_shards).
+
+        :param type_val: <str> the query name,  [GENERAL, HEADER, etc].
+        :param page_size: <int> the rows per page,  0 for a single request.
+        :param meta: <dict> filled with the other values in the results,
+                            ie: success,  and the UT date ranges of the
+                            searches that failed in 'failed'.
+        :param params: the query parameters,  as for request.
+        :return: <dict> yields each row of the results data.
+        """
+        meta = {} if meta is None else meta
+        shards = []
+        if self.shard_days and params.get('utd') and params.get('utd2'):
+            shards = utd_shards(params['utd'], params['utd2'], self.shard_days)
+
+        if len(shards) > 1:
+            return self._iter_shards(type_val, page_size, meta, shards, params)
+
+        return self._iter_pages(type_val, page_size, meta, params)
+
+    def _iter_shards(self, type_val, page_size, meta, shards, params):
+        """
+        Search each UT date shard in a pool of threads,  at most
+        shard_workers shards are read at once.  The rows are yielded in the
+        order of the shards,  so in koaid order,  starting as soon as the
+        first shard has rows.  The rows are de-duplicated by koaid.  The
+        memory held is the rows of the shards read ahead.
+
+        :param shards: <list<tuple>> the (utd, utd2) of each shard.
+        :return: <dict> yields each row of the results data.
+        """
+        stop = threading.Event()
+
+        def fetch(shard, rows_queue, shard_meta):
+            shard_params = dict(params, utd=shard[0], utd2=shard[1])
+            try:
+                for row in self._iter_pages(type_val, page_size, shard_meta,
+                                            shard_params):
+                    if stop.is_set():
+                        return
+                    rows_queue.put(row)
+            except Exception as err:
+                shard_meta['success'] = 0
+                shard_meta['failed'] = [f'{shard[0]} to {shard[1]}']
+                if self.log:
+                    self.log.warning(f'API search of {shard[0]} to {shard[1]} '
+                                     f'failed: {err}')
+            finally:
+                rows_queue.put(None)
+
+        if self.log:
+            self.log.info(f'API search of {params["utd"]} to {params["utd2"]} '
+                          f'in {len(shards)} shards')
+
+        seen = set()
+        succeeded = 0
+        failed = []
+        shards = iter(shards)
+        window = deque()
+        with ThreadPoolExecutor(max_workers=self.shard_workers) as pool:
+
+            def submit():
+                shard = next(shards, None)
+                if shard:
+                    rows_queue, shard_meta = Queue(), {}
+                    pool.submit(fetch, shard, rows_queue, shard_meta)
+                    window.append((rows_queue, shard_meta))
+
+            try:
+                for _ in range(self.shard_workers):
+                    submit()
+
+                while window:
+                    rows_queue, shard_meta = window.popleft()
+                    submit()
+                    for row in iter(rows_queue.get, None):
+                        koaid = row.get('koaid')
+                        if koaid:
+                            if koaid in seen:
+                                continue
+                            seen.add(koaid)
+                        yield row
+
+                    # an empty shard is not a success,  the search is a
+                    # success if any shard is and no shard failed
+                    success = shard_meta.pop('success', 0)
+                    failed += shard_meta.pop('failed', [])
+                    meta.update(shard_meta)
+                    if success == 1:
+                        succeeded += 1
+                    elif self.log:
+                        self.log.info(f'API search shard success: {success}')
+
+                meta['success'] = 1 if succeeded and not failed else 0
+                if failed:
+                    meta['failed'] = failed
+            finally:
+                stop.set()
+
+    def _iter_pages(self, type_val, page_size, meta, params):
+        """
+        Search the API,  paged by koaid with a page_size (see iter_search).
+
+        :return: <dict> yields each row of the results data.
+        """
+        params = dict(params)
+        add = params.pop('add', None)
+        # the largest koaid read,  the rows of a page may not be in order
+        max_koaid = None
+        failures = 0
+
+        while True:
+            page = dict(params, add=add)
+            if page_size:
+                page.update({'limit': page_size, 'order': 'koaid'})
+                if max_koaid:
+                    keyset = f"koaid > '{max_koaid}'"
+                    page['add'] = f"{add} AND {keyset}" if add else keyset
+
+            nrows = 0
+            try:
+                for row in self._stream_rows('search', type_val, meta, page):
+                    nrows += 1
+                    koaid = row.get('koaid')
+                    if koaid and (not max_koaid or koaid > max_koaid):
+                        max_koaid = koaid
+                    yield row
+            except (RequestException, ValueError) as err:
+                failures += 1
+                if self.log:
+                    self.log.warning(f'API search failed ({failures}/'
+                                     f'{self.retries + 1}): {err}')
+                # without paging,  the search can not continue part way
+                if failures > self.retries or (nrows and not page_size):
+                    meta['success'] = 0
+                    meta['failed'] = [f"{params.get('utd')} to "
+                                      f"{params.get('utd2')}"]
+                    return
+                time.sleep(self.backoff * 2 ** (failures - 1))
+                continue
+
+            if not page_size or nrows < page_size:
+                return
+
+    def _stream_rows(self, qtype, type_val, meta, params):
+        """
+        Send one query and yield the rows of the results data as the
+        response is read.
+
+        :return: <dict> yields each row of the results data.
+        """
+        query = {qtype: type_val}
+        query.update({key: val for key, val in params.items() if val})
+
+        def read_rows():
+            with self.session.get(self.url, params=query, timeout=self.timeout,
+                                  stream=True) as response:
+                if self.log:
+                    self.log.info(f'API URL: {response.url}')
+                response.raise_for_status()
+
+                yield from iter_json_rows(
+                    response.iter_content(chunk_size=65536), meta)
+
+        # the latency is the request and the reads of the results,  not the
+        # time the rows are used between the reads
+        yield from scrubber_metrics.timed_iter('scrubber_api_seconds',
+                                               read_rows(), qtype=qtype,
+                                               query=type_val)
+
+    def update(self, type_val, **params):
+        return self.query('update', type_val, **params)
+
+    def close(self):
+        self.session.close()
+
+
+def iter_json_rows(chunks, meta=None, array_key='data'):
+    """
+    Incrementally parse a json object read in chunks,  yielding the elements
+    of one array as each is complete.  The other top level values are added
+    to meta.
+
+        {"success": 1, "data": [{"koaid": ...}, {"koaid": ...}]}
+
+    :param chunks: <iterable> the bytes (or str) chunks of the json object.
+    :param meta: <dict> filled with the top level values other than the array.
+    :param array_key: <str> the key of the array to yield.
+    :return: yields each element of the array.
+    """
+    meta = {} if meta is None else meta
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+
+    def more():
+        # read the next chunk,  drop the parsed part of the buffer
+        nonlocal buf, pos, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf = buf[pos:] + utf8.decode(b'', final=True)
+        else:
+            if isinstance(chunk, bytes):
+                chunk = utf8.decode(chunk)
+            buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip(chars):
+        # move past whitespace and the chars,  return the next character
+        nonlocal pos
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] in chars):
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if eof:
+                raise ValueError('json results ended early')
+            more()
+
+    def value():
+        # decode the next complete value,  the end of a value at the end of
+        # the buffer may be incomplete (ie a number) unless at the end of data
+        nonlocal pos
+        while True:
+            try:
+                val, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    pos = end
+                    return val
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            more()
+
+    if skip('') != '{':
+        raise ValueError('json results are not an object')
+    pos += 1
+
+    while skip(',') != '}':
+        key = value()
+        skip(':')
+        if key == array_key and skip('') == '[':
+            pos += 1
+            while skip(',') != ']':
+                yield value()
+            pos += 1
+        else:
+            meta[key] = value()
+
+
+_rti_apis = {}
+
+
+def get_rti_api(url, config=None, log=None):
+    """
+    The shared API client for a url,  created on first use with the
+    [api] settings from the config file.
+
+    :param url: <str> the API url.
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :param log: <class 'logging.Logger'> the log
+    :return: <RtiApi> the API client.
+    """
+    if url in _rti_apis:
+        return _rti_apis[url]
+
+    settings = {}
+    if config:
+        timeout = (float(get_config_param(config, 'api', 'connect_timeout',
+                                          default='10')),
+                   float(get_config_param(config, 'api', 'read_timeout',
+                                          default='120')))
+        shard_workers = int(get_config_param(config, 'api', 'shard_workers',
+                                             default='4'))
+        settings = {'timeout': timeout,
+                    'retries': int(get_config_param(config, 'api', 'retries',
+                                                    default='3')),
+                    'backoff': float(get_config_param(config, 'api', 'backoff',
+                                                      default='2')),
+                    'shard_days': int(get_config_param(config, 'api',
+                                                       'shard_days',
+                                                       default='0')),
+                    'shard_workers': shard_workers,
+                    'pool_size': max(10, 2 * shard_workers)}
+
+    _rti_apis[url] = RtiApi(url, log=log, **settings)
+
+    return _rti_apis[url]
+
+
+def query_rti_api(url, qtype, type_val, val=None, columns=None, key=None, inst=None,
+                  utd=None, utd2=None, update_val=None, add=None, log=None, level=None):
+    """
+    Query the API to get or update information in the KOA RTI DB,  through
+    the shared client for the url.
+
+    :param url: <str> the API url.
+    :param qtype: <str> type of query [search, update].
+    :param type_val: <str> the query name,  [GENERAL, HEADER, etc].
+    :param columns: <str> comma separated string of columns to return
+    :param key: <str> the search key to match with val.
+    :param val: <str> the value to match with search.
+    :param add: <str> additional query parameters to add at end of query.
+    :param utd: <str> the initial date, YYYY-MM-DD.
+    :param utd2: <str> the final date, YYYY-MM-DD.
+    :return: <bytes> the json results,  None on error.
+    """
+    api = get_rti_api(url, log=log)
+
+    return api.request(qtype, type_val, val=val, columns=columns, key=key,
+                       inst=inst, utd=utd, utd2=utd2, update_val=update_val,
+                       add=add, level=level)
+
+
+def api_success(results):
+    """
+    Check the success flag of the API results.
+
+    :param results: <dict> the decoded API results.
+    :return: <bool> True if the API reported success.
+    """
+    return type(results) == dict and results.get('success') == 1
+
+
+def api_updated(results, koaids):
+    """
+    Check the API results of an update report all the koaids sent,  the
+    data is the list of koaids (or rows) updated,  or the number updated.
+    An update of a list of koaids can report success without updating the
+    koaids if the API matches the koaid to the full list.
+
+    :param results: <dict> the decoded API results.
+    :param koaids: <list> the koaids sent.
+    :return: <bool> True if the results report the koaids as updated.
+    """
+    if not api_success(results):
+        return False
+
+    data = results.get('data')
+    if type(data) == int:
+        return data == len(koaids)
+    if type(data) != list:
+        return False
+
+    updated = set(row.get('koaid') if type(row) == dict else row
+                  for row in data)
+
+    return updated.issuperset(koaids)
+
+
+class BulkUpdater:
+    """
+    Queue the API updates for many koaids and send them with one API call
+    per batch.  A batch that fails is split in half and sent again,  down
+    to single koaids,  so failures are still reported per koaid.  If the
+    API does not report the koaids of a batch as updated,  the koaids are
+    sent one at a time,  and so are the later updates.
+    """
+    def __init__(self, send_func, log_func, batch_size=1, log=None,
+                 done_func=None):
+        """
+        :param send_func: <func> send_func(update, koaids) sends one API
+                                 update for a list of koaids,  returns the
+                                 decoded API results.
+        :param log_func: <func> log_func(koaid, results, column) logs the
+                                result for a koaid,  returns True on success.
+        :param batch_size: <int> the max koaids per call,  1 or less sends
+                                 each update immediately.
+        :param log: <class 'logging.Logger'> the log
+        :param done_func: <func> done_func(koaids, update) is called with
+                                 the koaids that were updated.
+        """
+        self.send_func = send_func
+        self.log_func = log_func
+        self.done_func = done_func
+        self.batch_size = batch_size
+        self.log = log
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, update, koaid):
+        """
+        Add an update for a koaid.
+
+        :param update: <tuple> the update,  the column name first followed by
+                               the values sent to the API.  Updates that are
+                               equal are sent together.
+        :param koaid: <str> the koaid to update.
+        :return: <bool> the update result when sent immediately,  otherwise
+                        True,  the result is logged when the batch is sent.
+        """
+        with self._lock:
+            batch_size = self.batch_size
+        if batch_size <= 1:
+            return self._send(update, [koaid]) == 0
+
+        with self._lock:
+            koaids = self.pending.setdefault(update, [])
+            koaids.append(koaid)
+            if len(koaids) < self.batch_size:
+                return True
+            del self.pending[update]
+
+        self._send(update, koaids)
+
+        return True
+
+    def flush(self):
+        """
+        Send all the queued updates.
+
+        :return: <int> the number of koaids that were not updated.
+        """
+        with self._lock:
+            pending = self.pending
+            self.pending = {}
+
+        n_failed = 0
+        for update, koaids in pending.items():
+            n_failed += self._send(update, koaids)
+
+        return n_failed
+
+    def _send(self, update, koaids):
+        """
+        Send the update for a list of koaids,  splitting the list if the
+        update fails.
+
+        :param update: <tuple> the update (column name, values...).
+        :param koaids: <list> the koaids to update.
+        :return: <int> the number of koaids that were not updated.
+        """
+        results = self.send_func(update, koaids)
+
+        if len(koaids) > 1 and api_success(results) and \
+                not api_updated(results, koaids):
+            if self.log:
+                self.log.warning(f"{update[0]} batch of {len(koaids)} not "
+                                 f"reported as updated,  sending one koaid "
+                                 f"per update.")
+            with self._lock:
+                self.batch_size = 1
+            return sum(self._send(update, [koaid]) for koaid in koaids)
+
+        if len(koaids) > 1 and not api_success(results):
+            if self.log:
+                self.log.warning(f"{update[0]} batch of {len(koaids)} failed,"
+                                 f" splitting the batch.")
+            half = len(koaids) // 2
+            return (self._send(update, koaids[:half]) +
+                    self._send(update, koaids[half:]))
+
+        done = []
+        for koaid in koaids:
+            if self.log_func(koaid, results, update[0]):
+                done.append(koaid)
+
+        if done and self.done_func:
+            self.done_func(done, update)
+
+        return len(koaids) - len(done)
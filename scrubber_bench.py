@@ -0,0 +1,773 @@
+"""
+Benchmarks for the scrubber.
+
+transfer:  compare the rsync and native transfer backends on a synthetic
+tree of files,  run as the current user (no setpriv).
+
+e2e:  run the scrub_koa_rti and scrub_sdata_nightly flows end to end on a
+synthetic KOA tree,  for each --nfiles (KOAIDs).  In a work directory:
+
+    koa/k1koadata/<INST>/<utd>/lev0|lev1|lev2    the KOA disk ([DEFAULT] koa_mount)
+    koa/k1koadata/<INST>/stage/<utd>/s/sdataNNN/...
+    net/<inst_disk>/sdataNNN/...                the /s/sdata disk ([inst_disk])
+    storageserver/                              the /net/storageserver mount
+
+a local HTTP server stands in for the RTI API (search,  update and
+MARKDELETED),  and the helpers run as the current user (setpriv=False).
+The RTI flow moves the lev0,  lev1,  lev2 and stage files to storage and sets
+the archive_dir,  the sdata flow then removes the /s/sdata files found at
+storage and marks them deleted.  The throughput of each flow is reported,
+with the time in each phase from scrubber_metrics.
+
+startup:  the start time of short --dev runs,  each flow is run in a new
+interpreter on a small synthetic tree.  The import time,  the run time and
+the heavy modules imported (astropy,  requests,  pexpect) are reported,  the
+benchmark fails (exit status 1) if a basic --dev run imports one of the
+--forbid modules (default astropy).
+
+To run:
+    python scrubber_bench.py transfer --nfiles 200 --size 20
+    python scrubber_bench.py transfer --src /k1koadata/NIRES/20240101/lev0 \
+        --dest /net/storageserver/koastorage06/bench
+    python scrubber_bench.py e2e --nfiles 1000 10000 100000
+    python scrubber_bench.py startup --repeat 3
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import shutil
+import getpass
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import configparser
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import scrubber_helper
+
+APP_PATH = os.path.abspath(os.path.dirname(__file__))
+
+# the imports that make the start of a run slow
+HEAVY_MODULES = ('astropy', 'requests', 'pexpect')
+
+# the module of each flow
+FLOWS = {'rti': 'scrub_koa_rti', 'sdata': 'scrub_sdata_nightly'}
+
+
+def make_files(root_dir, nfiles, size_mb, prefix='NR.20240101'):
+    """
+    Write a synthetic lev0 directory,  the data is random so (like the
+    .fits.gz files) it does not compress.
+
+    :param root_dir: <str> the directory for the files.
+    :param nfiles: <int> the number of files.
+    :param size_mb: <float> the size of each file in MB.
+    :param prefix: <str> the start of the koaid of the files.
+    :return: <list<str>> the filenames.
+    """
+    os.makedirs(root_dir, exist_ok=True)
+    data = os.urandom(int(size_mb * (1 << 20)))
+    filenames = []
+    for indx in range(nfiles):
+        filename = f'{prefix}.{indx:05d}.00.fits.gz'
+        with open(f'{root_dir}/{filename}', 'wb') as fp:
+            fp.write(data)
+        filenames.append(filename)
+
+    return filenames
+
+
+def drop_dest(dest_dir):
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    os.makedirs(dest_dir)
+
+
+def bench_rsync(src_dir, dest_dir, filenames, options):
+    """
+    :return: <float> the seconds to rsync the files,  None without rsync.
+    """
+    if not shutil.which('rsync'):
+        return None
+
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as fp:
+        fp.write('\n'.join(filenames) + '\n')
+        files_from = fp.name
+
+    start = time.time()
+    subprocess.run(['rsync'] + options + [f'--files-from={files_from}',
+                                          f'{src_dir}/', dest_dir],
+                   check=True, stdout=subprocess.DEVNULL)
+    seconds = time.time() - start
+    os.remove(files_from)
+
+    return seconds
+
+
+def bench_native(src_dir, dest_dir, filenames, algorithm=None):
+    """
+    :return: <float> the seconds to copy the files with the native backend.
+    """
+    start = time.time()
+    for filename in filenames:
+        scrubber_helper.copy_file(f'{src_dir}/{filename}',
+                                  f'{dest_dir}/{filename}', algorithm)
+
+    return time.time() - start
+
+
+def run_transfer(args):
+    work_dir = tempfile.mkdtemp(prefix='scrub_bench_', dir=args.tmpdir)
+    src_dir = args.src or f'{work_dir}/src'
+    dest_dir = args.dest or f'{work_dir}/dest'
+
+    if args.src:
+        filenames = sorted(name for name in os.listdir(src_dir)
+                           if os.path.isfile(f'{src_dir}/{name}'))
+    else:
+        filenames = make_files(src_dir, args.nfiles, args.size)
+    nbytes = sum(os.path.getsize(f'{src_dir}/{name}') for name in filenames)
+
+    runs = [('rsync -avz', lambda: bench_rsync(src_dir, dest_dir, filenames,
+                                               ['-avz'])),
+            ('rsync -a', lambda: bench_rsync(src_dir, dest_dir, filenames,
+                                             ['-a'])),
+            ('native', lambda: bench_native(src_dir, dest_dir, filenames)),
+            (f'native + {args.hash}', lambda: bench_native(
+                src_dir, dest_dir, filenames, args.hash))]
+
+    print(f'{len(filenames)} files,  {nbytes / 1e6:.1f} MB,  '
+          f'from: {src_dir} to: {dest_dir}')
+    for name, func in runs:
+        times = []
+        for _ in range(args.repeat):
+            drop_dest(dest_dir)
+            seconds = func()
+            if seconds is None:
+                break
+            times.append(seconds)
+
+        if not times:
+            print(f'{name:>20}:  not available')
+            continue
+
+        best = min(times)
+        print(f'{name:>20}:  {best:8.3f} s  {nbytes / best / 1e6:8.1f} MB/s  '
+              f'{len(filenames) / best:8.1f} files/s')
+
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if args.dest:
+            shutil.rmtree(dest_dir, ignore_errors=True)
+
+
+
+def synthetic_koaids(prefix, utds, nkoaids):
+    """
+    KOAIDs spread over the UT dates,  ie: NI.20240101.00864.00
+
+    :param prefix: <str> the KOAID prefix of the instrument,  ie: NI
+    :param utds: <list<str>> the UT dates,  YYYY-MM-DD.
+    :param nkoaids: <int> the number of KOAIDs.
+    :return: <list<tuple>> (koaid, utd) in koaid order.
+    """
+    per_day = -(-nkoaids // len(utds))
+    step = 8640000 // per_day
+
+    koaids = []
+    for indx in range(nkoaids):
+        utd = utds[indx // per_day]
+        # the seconds of the day,  to 1/100 s
+        day_time = (indx % per_day) * step
+        koaids.append((f"{prefix}.{utd.replace('-', '')}.{day_time // 100:05d}."
+                       f"{day_time % 100:02d}", utd))
+
+    return koaids
+
+
+def make_koa_tree(work_dir, inst, tel, koaids, size_kb, sdata_dir):
+    """
+    Write the synthetic KOA tree,  and the /s/sdata files of the stage
+    files,  and return the database rows for the API stand-in.
+
+    :param work_dir: <str> the work directory.
+    :param inst: <str> the instrument name,  ie: NIRES
+    :param tel: <str> k1 or k2
+    :param koaids: <list<tuple>> (koaid, utd) from synthetic_koaids.
+    :param size_kb: <float> the size of each file in KB.
+    :param sdata_dir: <str> the sdata path of the instrument,
+                            ie: sdata1500/nires1
+    :return: <list<dict>> the rows,  one per KOAID and level.
+    """
+    data = os.urandom(int(size_kb * 1024))
+    made = set()
+
+    def write(path):
+        dir_path = os.path.dirname(path)
+        if dir_path not in made:
+            os.makedirs(dir_path, exist_ok=True)
+            made.add(dir_path)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+    koa_root = f'{work_dir}/koa/{tel}koadata'
+    rows = []
+    for indx, (koaid, utd) in enumerate(koaids):
+        utd_dir = utd.replace('-', '')
+        night = datetime.strptime(utd, '%Y-%m-%d').strftime('%Y%b%d').lower()
+        filename = f'{inst.lower()}_{indx:06d}.fits'
+        ofname = f'/s/{sdata_dir}/{night}/{filename}'
+        stage_file = f'/koadata/{inst}/stage/{utd_dir}{ofname}'
+
+        write(f'{koa_root}/{inst}/{utd_dir}/lev0/{koaid}.fits')
+        write(f'{koa_root}{stage_file[len("/koadata"):]}')
+        write(f'{work_dir}/net/{inst.lower()}/{ofname[len("/s/"):]}')
+
+        row = {'koaid': koaid, 'inst': inst, 'utd': utd, 'level': 0,
+               'status': 'COMPLETE', 'status_code': '', 'ofname': ofname,
+               'stage_file': stage_file, 'archive_dir': None,
+               'source_deleted': None,
+               'process_dir': f'/koadata/{inst}/{utd_dir}/lev0'}
+        rows.append(row)
+
+        for level in (1, 2):
+            write(f'{koa_root}/{inst}/{utd_dir}/lev{level}/'
+                  f'{koaid}_lev{level}.fits')
+            rows.append(dict(row, level=level, ofname='', stage_file='',
+                             process_dir=f'/koadata/{inst}/{utd_dir}/lev{level}'))
+
+    return rows
+
+
+class RtiStub:
+    """
+    A local stand-in for the RTI API,  the rows are held in memory.  It
+    answers the queries sent by scrubber_utils.RtiApi:
+
+        search=GENERAL  columns, key / val, inst, level, utd / utd2,  and
+                        add:  <column> IS NULL and koaid > '<koaid>' joined
+                        with AND,  limit with order=koaid.
+        update=GENERAL  columns=archive_dir, update_val, val=<koaids>,
+                        add=LEVEL=<level>
+        update=MARKDELETED  val=<koaids>
+    """
+    def __init__(self, rows):
+        """
+        :param rows: <list<dict>> the rows,  from make_koa_tree.
+        """
+        self.rows = {}
+        for row in rows:
+            self.rows.setdefault(row['level'], []).append(row)
+        for level_rows in self.rows.values():
+            level_rows.sort(key=lambda row: row['koaid'])
+        self.koaids = {level: [row['koaid'] for row in level_rows]
+                       for level, level_rows in self.rows.items()}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        """
+        Serve the API on a free local port,  in a thread.
+
+        :return: <str> the url of the API.
+        """
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                query = {key: vals[0] for key, vals in
+                         parse_qs(urlparse(self.path).query).items()}
+                body = json.dumps(stub.answer(query)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *log_args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        return f'http://127.0.0.1:{self.server.server_port}/'
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def answer(self, query):
+        if 'search' in query:
+            return self.search(query)
+        if query.get('update') == 'MARKDELETED':
+            return self.update(query, 'source_deleted', 1)
+        if query.get('update') == 'GENERAL':
+            return self.update(query, query.get('columns', '').strip(),
+                               query.get('update_val'))
+
+        return {'success': 0, 'data': []}
+
+    def search(self, query):
+        level = int(query.get('level') or 0)
+        koaids = self.koaids.get(level, [])
+        rows = self.rows.get(level, [])
+
+        is_null = []
+        start = 0
+        for cond in (query.get('add') or '').split(' AND '):
+            cond = cond.strip()
+            if cond.upper().endswith(' IS NULL'):
+                is_null.append(cond[:-len(' IS NULL')].strip().lower())
+            elif cond.startswith('koaid >'):
+                start = bisect.bisect_right(koaids,
+                                            cond.split('>', 1)[1].strip(" '"))
+
+        key, val = query.get('key'), query.get('val')
+        inst = (query.get('inst') or '').upper()
+        utd, utd2 = query.get('utd'), query.get('utd2') or query.get('utd')
+        limit = int(query.get('limit') or 0)
+        columns = [col.strip() for col in
+                   query.get('columns', 'koaid').split(',')]
+
+        data = []
+        with self.lock:
+            for row in rows[start:]:
+                if inst and row['inst'] != inst:
+                    continue
+                if utd and not utd <= row['utd'] <= utd2:
+                    continue
+                if key and str(row.get(key) or 0) != val:
+                    continue
+                if any(row.get(col) for col in is_null):
+                    continue
+                data.append({col: row.get(col) for col in columns})
+                if len(data) == limit:
+                    break
+
+        return {'success': 1, 'data': data}
+
+    def update(self, query, column, value):
+        koaids = set((query.get('val') or '').split(','))
+        level = 0
+        add = (query.get('add') or '').replace(' ', '')
+        if add.upper().startswith('LEVEL='):
+            level = int(add.split('=', 1)[1])
+
+        updated = []
+        with self.lock:
+            for row in self.rows.get(level, []):
+                if row['koaid'] in koaids:
+                    row[column] = value
+                    updated.append(row['koaid'])
+
+        return {'success': 1, 'data': updated}
+
+
+def bench_config(config_file, work_dir, inst, api_url, sdata=False,
+                 workers=None, backend='native'):
+    """
+    The scrubber config file,  set to use the synthetic tree,  the API
+    stand-in and the current user.
+
+    :param config_file: <str> scrubber_config.ini or scrub_sdata_config.ini
+    :param work_dir: <str> the work directory.
+    :param inst: <str> the instrument name.
+    :param api_url: <str> the url of the API stand-in.
+    :param sdata: <bool> the sdata scrubber config.
+    :param workers: <int> the [executor] workers,  None for the config value.
+    :param backend: <str> the [transfer_backend],  rsync or native.
+    :return: <class 'configparser.ConfigParser'> the config.
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    user = getpass.getuser()
+    settings = {
+        'DEFAULT': {'site_k1': api_url, 'site_k2': api_url, 'user': user,
+                    'log_dir': f'{work_dir}/logs',
+                    'koa_mount': f'{work_dir}/koa',
+                    'storage_mount': f'{work_dir}/storageserver',
+                    'storage_root': '/koastorage',
+                    'storage_root_rti': '/koastorage'},
+        'helper': {'enabled': '1'},
+        'journal': {'dir': f'{work_dir}/journal'},
+        'plan': {'history': f'{work_dir}/throughput.jsonl'},
+        'metrics': {'textfile_dir': '', 'json_dir': f'{work_dir}/metrics'},
+        'transfer_backend': {'default': backend},
+        # nothing listens on port 1,  the reports are not sent
+        'email': {'from': user, 'admin': user, 'warnings': user,
+                  'server': '127.0.0.1:1'},
+        'MODE': {'move': '1', 'lev1': '1', 'lev2': '1'},
+        # the stand-in reports the koaids of a batch update
+        'api': {'update_batch': '100'},
+    }
+    if sdata:
+        uid = os.getuid()
+        settings.update({'SDATA_REMOVE': {inst: '1'},
+                         'approved_uids': {inst: f'{uid},{user}'},
+                         'inst_disk': {'path_root': f'{work_dir}/net',
+                                       inst: inst.lower()}})
+    if workers:
+        settings['executor'] = {'workers': str(workers)}
+
+    # lev2 is off in production,  its columns are those of lev1
+    if config.has_option('db_columns', 'lev1') and \
+            not config.has_option('db_columns', 'lev2'):
+        settings['db_columns'] = {'lev2': config['db_columns']['lev1']}
+
+    for section, values in settings.items():
+        if section != 'DEFAULT' and not config.has_section(section):
+            config.add_section(section)
+        for key, val in values.items():
+            config[section][key] = val
+
+    # the dev settings are the same
+    for key, val in settings['DEFAULT'].items():
+        if config.has_section('DEV'):
+            config['DEV'][key] = val
+
+    return config
+
+
+def tree_count(paths):
+    """
+    :return: <list<int>> the files and bytes below the paths.
+    """
+    import scrubber_utils as utils
+
+    totals = [0, 0]
+    for path in paths:
+        cnt = utils.walk_file_count(path) or [0, 0]
+        totals[0] += cnt[0]
+        totals[1] += cnt[1]
+
+    return totals
+
+
+def run_flow(name, run_func, count_paths):
+    """
+    Run one scrubber flow,  and the files and bytes it removed from the
+    source tree.
+
+    :return: <dict> the name,  files,  bytes,  seconds and the phase times.
+    """
+    import scrubber_metrics
+
+    before = tree_count(count_paths)
+    scrubber_metrics.REGISTRY.reset()
+    start = time.time()
+    run_func()
+    seconds = time.time() - start
+    after = tree_count(count_paths)
+
+    phases = {}
+    for hist in scrubber_metrics.REGISTRY.snapshot()['histograms']:
+        if hist['name'] == 'scrubber_phase_seconds':
+            phase = hist['labels']['phase']
+            phases[phase] = phases.get(phase, 0) + hist['sum']
+
+    return {'flow': name, 'files': before[0] - after[0],
+            'bytes': before[1] - after[1], 'seconds': seconds,
+            'phases': phases}
+
+
+def run_e2e(args):
+    import scrubber_utils as utils
+    import scrub_koa_rti
+    import scrub_sdata_nightly
+
+    inst = args.inst.upper()
+    tel = args.tel.lower()
+    utd_dt = datetime.strptime(args.utd, '%Y-%m-%d')
+    utds = [(utd_dt + timedelta(days=day)).strftime('%Y-%m-%d')
+            for day in range(args.days)]
+    sdata_dir = f'{args.sdata}/{inst.lower()}1'
+
+    config = configparser.ConfigParser()
+    config.read(args.rti_config)
+    prefix = utils.inst_koaid_prefix(inst, config)
+    if not prefix:
+        sys.exit(f'no [inst_prefix] for: {inst}')
+
+    results = []
+    for nfiles in args.nfiles:
+        work_dir = tempfile.mkdtemp(prefix=f'scrub_e2e_{nfiles}_',
+                                    dir=args.tmpdir)
+        os.makedirs(f'{work_dir}/logs')
+
+        start = time.time()
+        koaids = synthetic_koaids(prefix, utds, nfiles)
+        rows = make_koa_tree(work_dir, inst, tel, koaids, args.size, sdata_dir)
+        print(f'{nfiles} KOAIDs,  {tree_count([work_dir])[0]} files written '
+              f'to: {work_dir} in {time.time() - start:.1f} s')
+
+        stub = RtiStub(rows)
+        api_url = stub.start()
+        rti_config = bench_config(args.rti_config, work_dir, inst, api_url,
+                                  workers=args.workers, backend=args.backend)
+        sdata_config = bench_config(args.sdata_config, work_dir, inst,
+                                    api_url, sdata=True)
+        run_args = argparse.Namespace(dev=False, logdir=None, inst=inst,
+                                      tel=tel, force=0, command='run',
+                                      plan_file=None, profile=False,
+                                      utd=utds[0], utd2=utds[-1])
+
+        # the helpers run as the current user,  without sudo setpriv
+        bench_log = logging.getLogger('scrubber_bench')
+        rti_shared = {'helpers': scrubber_helper.HelperPool(
+            rti_config, bench_log, setpriv=False)}
+        sdata_shared = {'helpers': scrubber_helper.HelperPool(
+            sdata_config, bench_log, setpriv=False)}
+
+        koa_root = f'{work_dir}/koa/{tel}koadata/{inst}'
+        try:
+            for name, run_func, count_paths in (
+                    ('rti', lambda: scrub_koa_rti.run(rti_config, run_args,
+                                                      shared=rti_shared),
+                     [koa_root]),
+                    ('sdata', lambda: scrub_sdata_nightly.run(
+                        sdata_config, run_args, shared=sdata_shared),
+                     [f'{work_dir}/net'])):
+                result = run_flow(name, run_func, count_paths)
+                result['nfiles'] = nfiles
+                results.append(result)
+                print_result(result)
+        finally:
+            stub.stop()
+            rti_shared['helpers'].close()
+            sdata_shared['helpers'].close()
+            if not args.keep:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=1)
+
+
+def startup_child():
+    """
+    Run one --dev flow in this interpreter and print the times and the heavy
+    modules imported as JSON,  run by run_startup in a new interpreter:
+
+        python -c 'import scrubber_bench; scrubber_bench.startup_child()' \
+            <flow> <config file> <inst> <tel> <utd> <utd2>
+    """
+    import importlib
+    import scrubber_profile
+
+    flow, config_file, inst, tel, utd, utd2 = sys.argv[1:7]
+
+    start = time.perf_counter()
+    module = importlib.import_module(FLOWS[flow])
+    import_seconds = time.perf_counter() - start
+
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    run_args = argparse.Namespace(dev=True, logdir=None, inst=inst, tel=tel,
+                                  force=0, command='run', plan_file=None,
+                                  profile=False, utd=utd, utd2=utd2)
+    start = time.perf_counter()
+    module.run(config, run_args)
+    run_seconds = time.perf_counter() - start
+
+    # the last line of the output
+    print(json.dumps({'flow': flow, 'import_seconds': import_seconds,
+                      'run_seconds': run_seconds,
+                      'total_seconds': scrubber_profile.startup_seconds(),
+                      'modules': [name for name in HEAVY_MODULES
+                                  if name in sys.modules]}))
+
+
+def run_startup(args):
+    import scrubber_utils as utils
+
+    inst = args.inst.upper()
+    tel = args.tel.lower()
+    config = configparser.ConfigParser()
+    config.read(args.rti_config)
+    prefix = utils.inst_koaid_prefix(inst, config)
+    if not prefix:
+        sys.exit(f'no [inst_prefix] for: {inst}')
+
+    work_dir = tempfile.mkdtemp(prefix='scrub_startup_', dir=args.tmpdir)
+    os.makedirs(f'{work_dir}/logs')
+    koaids = synthetic_koaids(prefix, [args.utd], args.nfiles)
+    rows = make_koa_tree(work_dir, inst, tel, koaids, 1,
+                         f'sdata1500/{inst.lower()}1')
+
+    stub = RtiStub(rows)
+    api_url = stub.start()
+    config_files = {}
+    for flow, config_file in (('rti', args.rti_config),
+                              ('sdata', args.sdata_config)):
+        config = bench_config(config_file, work_dir, inst, api_url,
+                              sdata=flow == 'sdata')
+        config_files[flow] = f'{work_dir}/{flow}_config.ini'
+        with open(config_files[flow], 'w') as fp:
+            config.write(fp)
+
+    results = []
+    failed = []
+    try:
+        for flow in args.flows:
+            for _ in range(args.repeat):
+                cmd = [sys.executable, '-c',
+                       'import scrubber_bench; scrubber_bench.startup_child()',
+                       flow, config_files[flow], inst, tel, args.utd, args.utd]
+                output = subprocess.run(cmd, cwd=APP_PATH, capture_output=True,
+                                        text=True)
+                lines = output.stdout.strip().splitlines()
+                if output.returncode or not lines:
+                    sys.exit(f'the {flow} run failed:\n{output.stderr}')
+                result = json.loads(lines[-1])
+                results.append(result)
+
+                forbidden = sorted(set(result['modules']) & set(args.forbid))
+                if forbidden:
+                    failed.append(f'{flow}: {forbidden}')
+                total = result['total_seconds']
+                print(f"{flow:>6}:  import {result['import_seconds']:6.3f} s  "
+                      f"run {result['run_seconds']:6.3f} s  total "
+                      f"{total if total is not None else float('nan'):6.3f} s"
+                      f"  heavy modules: {result['modules'] or 'none'}")
+    finally:
+        stub.stop()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=1)
+
+    if failed:
+        sys.exit(f'FAILED,  a basic --dev run imported: {failed}')
+
+
+def print_result(result):
+    seconds = result['seconds'] or 1e-9
+    phases = ',  '.join(f'{phase} {secs:.2f}' for phase, secs in
+                        sorted(result['phases'].items()))
+    print(f"{result['flow']:>6} {result['nfiles']:>7}:  {result['files']:>7} "
+          f"files  {result['seconds']:8.2f} s  "
+          f"{result['files'] / seconds:8.1f} files/s  "
+          f"{result['bytes'] / seconds / 1e6:7.2f} MB/s")
+    if phases:
+        print(f"{'':>16}phase seconds: {phases}")
+
+def parse_args():
+    """
+    Parse the command line arguments.
+
+    :return: <obj> commandline arguments
+    """
+    parser = argparse.ArgumentParser(description="Scrubber benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    transfer = subparsers.add_parser('transfer',
+                                     help='Compare the transfer backends.')
+    transfer.add_argument("--nfiles", type=int, default=100,
+                          help="The number of synthetic files.")
+    transfer.add_argument("--size", type=float, default=10,
+                          help="The size (MB) of each synthetic file.")
+    transfer.add_argument("--src", type=str,
+                          help="Copy the files of an existing directory.")
+    transfer.add_argument("--dest", type=str,
+                          help="The destination,  ie: over the storage mount.")
+    transfer.add_argument("--tmpdir", type=str,
+                          help="The directory for the synthetic files.")
+    transfer.add_argument("--hash", type=str, default='blake2b',
+                          help="The hash for the hash while copy run.")
+    transfer.add_argument("--repeat", type=int, default=3,
+                          help="The runs of each backend,  the best is shown.")
+    transfer.add_argument("--keep", action="store_true",
+                          help="Keep the files.")
+
+    e2e = subparsers.add_parser('e2e', help='Run the scrubbers on a synthetic '
+                                            'KOA tree and API.')
+    e2e.add_argument("--nfiles", type=int, nargs='+',
+                     default=[1000, 10000, 100000],
+                     help="The KOAIDs of each run,  each has a lev0,  lev1,  "
+                          "lev2,  stage and sdata file.")
+    e2e.add_argument("--size", type=float, default=4,
+                     help="The size (KB) of each synthetic file.")
+    e2e.add_argument("--inst", type=str, default='NIRES',
+                     help="The instrument of the synthetic KOAIDs.")
+    e2e.add_argument("--tel", type=str, default='k1', choices=('k1', 'k2'))
+    e2e.add_argument("--utd", type=str, default='2024-01-01',
+                     help="The first UT date of the synthetic KOAIDs.")
+    e2e.add_argument("--days", type=int, default=3,
+                     help="The UT dates the KOAIDs are spread over.")
+    e2e.add_argument("--sdata", type=str, default='sdata1500',
+                     help="The sdata disk of the stage files.")
+    e2e.add_argument("--workers", type=int,
+                     help="The [executor] workers,  default from the config.")
+    e2e.add_argument("--backend", type=str, default='native',
+                     choices=('native', 'rsync'),
+                     help="The [transfer_backend] of the run.")
+    e2e.add_argument("--rti_config", type=str,
+                     default=f'{APP_PATH}/scrubber_config.ini',
+                     help="The config the RTI run starts from.")
+    e2e.add_argument("--sdata_config", type=str,
+                     default=f'{APP_PATH}/scrub_sdata_config.ini',
+                     help="The config the sdata run starts from.")
+    e2e.add_argument("--tmpdir", type=str,
+                     help="The directory for the synthetic trees.")
+    e2e.add_argument("--json", type=str,
+                     help="Write the results to a JSON file,  ie: to compare "
+                          "with an earlier run.")
+    e2e.add_argument("--keep", action="store_true",
+                     help="Keep the synthetic trees and logs.")
+
+    startup = subparsers.add_parser('startup', help='Check the start time and '
+                                                    'imports of --dev runs.')
+    startup.add_argument("--flows", type=str, nargs='+', default=list(FLOWS),
+                         choices=list(FLOWS), help="The scrubbers to run.")
+    startup.add_argument("--repeat", type=int, default=1,
+                         help="The runs of each flow.")
+    startup.add_argument("--forbid", type=str, nargs='*', default=['astropy'],
+                         help="Fail if a run imports one of these modules.")
+    startup.add_argument("--nfiles", type=int, default=20,
+                         help="The KOAIDs of the synthetic tree.")
+    startup.add_argument("--inst", type=str, default='NIRES',
+                         help="The instrument of the synthetic KOAIDs.")
+    startup.add_argument("--tel", type=str, default='k1', choices=('k1', 'k2'))
+    startup.add_argument("--utd", type=str, default='2024-01-01',
+                         help="The UT date of the synthetic KOAIDs.")
+    startup.add_argument("--rti_config", type=str,
+                         default=f'{APP_PATH}/scrubber_config.ini',
+                         help="The config the RTI run starts from.")
+    startup.add_argument("--sdata_config", type=str,
+                         default=f'{APP_PATH}/scrub_sdata_config.ini',
+                         help="The config the sdata run starts from.")
+    startup.add_argument("--tmpdir", type=str,
+                         help="The directory for the synthetic tree.")
+    startup.add_argument("--json", type=str,
+                         help="Write the results to a JSON file.")
+    startup.add_argument("--keep", action="store_true",
+                         help="Keep the synthetic tree and logs.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.command == 'transfer':
+        run_transfer(args)
+    elif args.command == 'e2e':
+        run_e2e(args)
+    elif args.command == 'startup':
+        run_startup(args)
+    else:
+        sys.exit(f'unknown command: {args.command}')
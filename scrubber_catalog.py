@@ -0,0 +1,281 @@
+"""
+Local catalog of the files the scrubbers have moved to storage and removed.
+
+The catalog is an SQLite file,  keyed by KOAID and the storage path of each
+file.  It records the size,  mtime,  storage directory,  and whether the
+archive_dir / source_deleted columns have been set in the RTI DB.  The
+scrubbers use it to skip completed work and to check a file is stored
+without a glob over NFS.
+
+To run:
+    python scrubber_catalog.py --db /log/scrubber_logs/scrubber_catalog.db vacuum --days 365
+    python scrubber_catalog.py --db /log/scrubber_logs/scrubber_catalog.db import \
+        --root /net/storageserver/koastorage03/NIRES
+"""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+import configparser
+
+KOAID_RE = re.compile(r'^([A-Z0-9]{2}\.\d{8}\.\d{5}\.\d{2})')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    koaid TEXT NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    storage_dir TEXT NOT NULL,
+    src_path TEXT,
+    level INTEGER,
+    size INTEGER,
+    mtime REAL,
+    archive_dir_set INTEGER NOT NULL DEFAULT 0,
+    source_deleted INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL,
+    PRIMARY KEY (koaid, path)
+);
+CREATE INDEX IF NOT EXISTS files_stored ON files (storage_dir, name);
+"""
+
+
+def norm_dir(storage_dir):
+    """
+    The storage directories from determine_storage can include '//' and a
+    trailing '/',  normalize them so they match on lookup.
+
+    :param storage_dir: <str> the storage directory.
+    :return: <str> the normalized directory,  ie: /koastorage03/NIRES/stage
+    """
+    return os.path.normpath('/' + storage_dir.strip('/'))
+
+
+class ScrubCatalog:
+    def __init__(self, db_path):
+        """
+        :param db_path: <str> the path to the SQLite catalog file.
+        """
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def record_stored(self, files):
+        """
+        Record files moved to storage.
+
+        :param files: <list<tuple>> (koaid, level, src_path, name, storage_dir,
+                                     size, mtime) for each file.
+        """
+        now = time.time()
+        rows = []
+        for koaid, level, src_path, name, storage_dir, size, mtime in files:
+            store_dir = norm_dir(storage_dir)
+            rows.append((koaid, f'{store_dir}/{name}', name, store_dir,
+                         src_path, level, size, mtime, now))
+
+        with self.lock:
+            self.conn.executemany(
+                'INSERT INTO files (koaid, path, name, storage_dir, src_path, '
+                'level, size, mtime, updated) VALUES (?,?,?,?,?,?,?,?,?) '
+                'ON CONFLICT (koaid, path) DO UPDATE SET '
+                'src_path=excluded.src_path, level=excluded.level, '
+                'size=excluded.size, mtime=excluded.mtime, '
+                'updated=excluded.updated', rows)
+            self.conn.commit()
+
+    def mark_archive_dir(self, koaids, level=0):
+        """
+        Record that archive_dir is set in the DB for the koaids.
+
+        :param koaids: <list<str>> the koaids.
+        :param level: <int> the level of the archive_dir.
+        """
+        self._set_flag('archive_dir_set', koaids,
+                       'AND (level=? OR level IS NULL)', (level,))
+
+    def mark_deleted(self, koaids):
+        """
+        Record that source_deleted is set in the DB for the koaids.
+
+        :param koaids: <list<str>> the koaids.
+        """
+        self._set_flag('source_deleted', koaids)
+
+    def _set_flag(self, column, koaids, where='', where_args=()):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                f'UPDATE files SET {column}=1, updated=? WHERE koaid=? {where}',
+                [(now, koaid) + tuple(where_args) for koaid in koaids])
+            self.conn.commit()
+
+    def is_complete(self, koaid, level=0):
+        """
+        Has the koaid been moved and its archive_dir set?
+
+        :param koaid: <str> the koaid.
+        :param level: <int> the level moved.
+        :return: <bool> True if the catalog has the koaid as completed.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM files WHERE koaid=? AND level=? '
+                'AND archive_dir_set=1 LIMIT 1', (koaid, level)).fetchone()
+
+        return row is not None
+
+    def is_stored(self, storage_dir, filename):
+        """
+        Is a file,  or a file starting with filename (ie: the .gz),  in the
+        storage directory?  This is an index lookup in place of a glob.
+
+        :param storage_dir: <str> the storage directory.
+        :param filename: <str> the filename (or start of the filename).
+        :return: <bool> True if the catalog has the file at storage.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM files WHERE storage_dir=? AND name>=? AND name<? '
+                'LIMIT 1', (norm_dir(storage_dir), filename,
+                            filename + '\U0010ffff')).fetchone()
+
+        return row is not None
+
+    def compact(self, days=None):
+        """
+        Remove the completed entries older than days,  then vacuum the file.
+
+        :param days: <int> the age in days of the entries to remove,  None
+                           to keep all entries.
+        :return: <int> the number of entries removed.
+        """
+        n_removed = 0
+        with self.lock:
+            if days is not None:
+                cutoff = time.time() - days * 86400
+                cursor = self.conn.execute(
+                    'DELETE FROM files WHERE updated<? AND archive_dir_set=1 '
+                    'AND source_deleted=1', (cutoff,))
+                n_removed = cursor.rowcount
+                self.conn.commit()
+            self.conn.execute('VACUUM')
+            self.conn.execute('PRAGMA optimize')
+
+        return n_removed
+
+    def import_tree(self, root_dir, storage_mount='/net/storageserver',
+                    chunk=5000):
+        """
+        Add the files in an existing storage tree to the catalog.  The koaid
+        is taken from the filename,  files without one (ie: stage files) are
+        added with an empty koaid.
+
+        :param root_dir: <str> the storage tree,  under the storage mount.
+        :param storage_mount: <str> the mount point of the storage server.
+        :param chunk: <int> the number of files added per transaction.
+        :return: <int> the number of files added.
+        """
+        n_files = 0
+        files = []
+        for dir_path, _, filenames in os.walk(root_dir):
+            storage_dir = dir_path[len(storage_mount):] \
+                if dir_path.startswith(storage_mount) else dir_path
+            for name in filenames:
+                try:
+                    stat = os.stat(os.path.join(dir_path, name))
+                except OSError:
+                    continue
+                match = KOAID_RE.match(name)
+                koaid = match.group(1) if match else ''
+                files.append((koaid, None, None, name, storage_dir,
+                              stat.st_size, stat.st_mtime))
+
+            if len(files) >= chunk:
+                self.record_stored(files)
+                n_files += len(files)
+                files = []
+
+        if files:
+            self.record_stored(files)
+            n_files += len(files)
+
+        return n_files
+
+
+def open_catalog(config):
+    """
+    Open the catalog set in the [catalog] section of the config file.
+
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :return: <ScrubCatalog> the catalog,  None if no catalog is configured.
+    """
+    try:
+        db_path = config['catalog']['path']
+    except KeyError:
+        return None
+
+    if not db_path:
+        return None
+
+    return ScrubCatalog(db_path)
+
+
+def parse_args():
+    """
+    Parse the command line arguments.
+
+    :return: <obj> commandline arguments
+    """
+    parser = argparse.ArgumentParser(description="Scrubber file catalog")
+    parser.add_argument("--db", type=str,
+                        help="The catalog file,  default is [catalog] path.")
+    parser.add_argument("--config", type=str,
+                        help="The config file with the [catalog] path.")
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    vacuum = subparsers.add_parser('vacuum', help='Compact the catalog.')
+    vacuum.add_argument("--days", type=int,
+                        help="Remove completed entries older than days.")
+
+    bulk = subparsers.add_parser('import', help='Import a storage tree.')
+    bulk.add_argument("--root", type=str, required=True,
+                      help="The storage tree,  ie: /net/storageserver/koastorage03/NIRES")
+    bulk.add_argument("--mount", type=str, default='/net/storageserver',
+                      help="The mount point of the storage server.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.db:
+        catalog = ScrubCatalog(args.db)
+    else:
+        config = configparser.ConfigParser()
+        config.read(args.config or '')
+        catalog = open_catalog(config)
+        if not catalog:
+            sys.exit("No catalog,  use --db or set [catalog] path.")
+
+    if args.command == 'vacuum':
+        n_removed = catalog.compact(args.days)
+        print(f"Removed {n_removed} entries,  vacuumed: {catalog.db_path}")
+    elif args.command == 'import':
+        n_files = catalog.import_tree(args.root, args.mount)
+        print(f"Imported {n_files} files from: {args.root}")
+
+    catalog.close()
@@ -0,0 +1,72 @@
+"""
+The FITS headers of the KPF files,  the component files and directories
+named in the header of the lev0 file.
+
+Loaded by scrubber_utils on the first use of one of its names,  astropy is
+only imported by the runs that read a KPF header.
+"""
+
+from astropy.io import fits
+
+
+def kpf_component_files(mv_path_local, mv_path_remote, log):
+    log.info(f'kpf_component_files: {mv_path_local} {mv_path_remote}')
+    hdu = fits.open(mv_path_local, ignore_missing_end=True)
+    hdr = hdu[0].header
+
+    files_to_remove = []
+    if 'GREENFN' in hdr:
+        log.info(f"GREEN filename: {hdr['GREENFN']}")
+        files_to_remove.append(hdr['GREENFN'])
+    if 'REDFN' in hdr:
+        log.info(f"RED filename: {hdr['REDFN']}")
+        files_to_remove.append(hdr['REDFN'])
+    if 'CA_HKFN' in hdr:
+        log.info(f"CA_HK filename: {hdr['CA_HKFN']}")
+        files_to_remove.append(hdr['CA_HKFN'])
+    if 'EXPMETERFN' in hdr:
+        log.info(f"Exposure Meter filename: {hdr['EXPMETERFN']}")
+        files_to_remove.append(hdr['EXPMETERFN'])
+
+    return files_to_remove
+
+
+def kpf_component_dirs(mv_path_local, mv_path_remote, log):
+    log.info(f'kpf_component_dirs: {mv_path_local} {mv_path_remote}')
+    try:
+        hdu = fits.open(mv_path_local, ignore_missing_end=True)
+        hdr = hdu[0].header
+    except FileNotFoundError:
+        return None
+
+    if 'GREENFN' in hdr:
+        direct = get_kpf_compdir(hdr, 'GREENFN', 'Green', log)
+        if direct:
+            return direct
+    if 'REDFN' in hdr:
+        direct = get_kpf_compdir(hdr, 'REDFN', 'Red', log)
+        if direct:
+            return direct
+    if 'CA_HKFN' in hdr:
+        direct = get_kpf_compdir(hdr, 'CA_HKFN', 'CaHK', log)
+        if direct:
+            return direct
+    if 'EXPMETERFN' in hdr:
+        direct = get_kpf_compdir(hdr, 'EXPMETERFN', 'ExpMeter', log)
+        if direct:
+            return direct
+
+    return None
+
+
+def get_kpf_compdir(hdr, hdr_key, comp_name, log):
+    log.info(f"{comp_name} filename: {hdr[hdr_key]}")
+    filename = hdr[hdr_key]
+    try:
+        direct = filename.split(comp_name)[0]
+        log.info(f"{comp_name} file directory: {direct}")
+        return direct
+    except IndexError:
+        log.error(f"could not determine directory: {comp_name}, filename: {filename}")
+
+    return None
@@ -0,0 +1,536 @@
+"""
+Long-lived helper process to run filesystem operations as another user.
+
+In place of a 'sudo setpriv ... <cmd>' for each mkdir, rm and rmdir,  one
+helper is started per (uid, gid) with setpriv and reads batches of
+operations from a pipe.  The helper also runs the native file copy of the
+'native' transfer backend.  Each batch is one JSON line:
+
+    {"id": 1, "ops": [["mkdir", "/net/storageserver/..."], ["remove", "..."]]}
+
+and the helper returns one JSON line with a result for each operation:
+
+    {"id": 1, "results": [{"ok": true}, {"ok": false, "error": "..."}]}
+
+The helper process uses the standard library,  scrubber_metrics and xxhash
+(if installed),  it runs as:
+    sudo setpriv --reuid=<uid> --regid=<gid> --clear-groups \
+        python3 scrubber_helper.py --serve
+"""
+
+import os
+import sys
+import errno
+import json
+import hashlib
+import threading
+import subprocess
+
+import scrubber_metrics
+
+# xxhash is faster than blake2b for the transfer verification
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HELPER_PATH = os.path.abspath(__file__)
+
+
+def file_hasher(algorithm='blake2b'):
+    """
+    A hash object for the transfer verification.  xxh3 / xxh64 are used if
+    xxhash is installed,  otherwise blake2b.
+
+    :param algorithm: <str> xxh3, xxh64, blake2b or a hashlib algorithm.
+    :return: <obj> the hash object.
+    """
+    if algorithm.startswith('xxh') and xxhash:
+        if algorithm == 'xxh64':
+            return xxhash.xxh64()
+        return xxhash.xxh3_128()
+
+    if algorithm.startswith('xxh') or algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=32)
+
+    return hashlib.new(algorithm)
+
+
+def copy_file(src_path, dst_path, algorithm=None, chunk_size=8 << 20):
+    """
+    Copy a file into a temporary file next to dst_path,  set its mode and
+    times from the source and rename it into place,  so a partial copy is
+    never seen at dst_path.  Without a hash the data is copied in the kernel
+    (copy_file_range,  or sendfile).  With a hash the source is read once,
+    hashed and written.
+
+    :param src_path: <str> the file to copy.
+    :param dst_path: <str> the path of the copy.
+    :param algorithm: <str> hash the source while copying (see file_hasher).
+    :param chunk_size: <int> the bytes copied at once.
+    :return: <str> the hex digest of the source,  None without a hash.
+    """
+    dst_dir = os.path.dirname(dst_path)
+    os.makedirs(dst_dir, exist_ok=True)
+    tmp_path = f'{dst_dir}/.{os.path.basename(dst_path)}.{os.getpid()}.tmp'
+
+    hasher = file_hasher(algorithm) if algorithm else None
+    try:
+        with open(src_path, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+            src_fd = fsrc.fileno()
+            dst_fd = fdst.fileno()
+            src_stat = os.fstat(src_fd)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            if hasher:
+                buf = bytearray(chunk_size)
+                view = memoryview(buf)
+                while True:
+                    nread = fsrc.readinto(buf)
+                    if not nread:
+                        break
+                    hasher.update(view[:nread])
+                    fdst.write(view[:nread])
+                view.release()
+            else:
+                _kernel_copy(src_fd, dst_fd, src_stat.st_size, chunk_size)
+
+            fdst.flush()
+            os.fchmod(dst_fd, src_stat.st_mode & 0o7777)
+            os.utime(dst_fd, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            # the source is removed after the copy,  the data must be on disk
+            os.fsync(dst_fd)
+
+        os.replace(tmp_path, dst_path)
+        _fsync_dir(dst_dir)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    return hasher.hexdigest() if hasher else None
+
+
+def _fsync_dir(dir_path):
+    """
+    Flush a directory,  so a file renamed into it is kept after a crash.
+    """
+    dir_fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    except OSError as err:
+        # a filesystem that cannot flush a directory
+        if err.errno != errno.EINVAL:
+            raise
+    finally:
+        os.close(dir_fd)
+
+
+def _kernel_copy(src_fd, dst_fd, size, chunk_size):
+    """
+    Copy the data without reading it into python,  copy_file_range (which
+    the NFS server can do without sending the data) then sendfile.
+    """
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                ncopied = os.copy_file_range(src_fd, dst_fd,
+                                             min(chunk_size, size - offset))
+                if not ncopied:
+                    break
+                offset += ncopied
+        except OSError:
+            # not supported between these file systems
+            pass
+
+    while offset < size:
+        nsent = os.sendfile(dst_fd, src_fd, offset,
+                            min(chunk_size, size - offset))
+        if not nsent:
+            break
+        offset += nsent
+
+    if offset < size:
+        raise OSError(f'short copy,  {offset} of {size} bytes')
+
+
+def _mkdir(path):
+    os.makedirs(path, exist_ok=True)
+
+
+def _isdir(path):
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f'not a directory: {path}')
+
+
+OPS = {'mkdir': _mkdir, 'remove': os.remove, 'rmdir': os.rmdir,
+       'isdir': _isdir, 'copy': copy_file}
+
+# the commands run in place of the operations if the helper is not used
+OP_CMDS = {'mkdir': ['mkdir', '-p'], 'remove': ['rm'], 'rmdir': ['rmdir'],
+           'isdir': ['test', '-d'], 'copy': ['cp', '-p']}
+
+
+def run_op(op):
+    """
+    Run one operation in the helper.
+
+    :param op: <list> the operation name and its args,  ie: ['mkdir', path]
+                      or ['copy', src, dst, hash algorithm or None]
+    :return: <dict> {'ok': True} or {'ok': False, 'error': <str>},  a copy
+                    adds the 'hash' of the source.
+    """
+    if op[0] not in OPS:
+        return {'ok': False, 'error': f'unknown operation: {op[0]}'}
+
+    try:
+        value = OPS[op[0]](*op[1:])
+    except (OSError, TypeError, ValueError) as err:
+        return {'ok': False, 'error': str(err)}
+
+    if op[0] == 'copy':
+        return {'ok': True, 'hash': value}
+
+    return {'ok': True}
+
+
+def serve(stdin=sys.stdin, stdout=sys.stdout):
+    """
+    The helper loop,  run the batches of operations read from stdin until
+    it is closed.
+    """
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            results = [run_op(op) for op in request['ops']]
+            response = {'id': request.get('id'), 'results': results}
+        except (ValueError, KeyError, TypeError) as err:
+            response = {'id': None, 'error': f'bad request: {err}'}
+
+        stdout.write(json.dumps(response) + '\n')
+        stdout.flush()
+
+
+def setpriv_cmd(uid, gid):
+    """
+    The setpriv command to run as uid / gid,  the same as run_cmd_as_user.
+
+    :param uid: <int/str> the user id or name.
+    :param gid: <int/str> the group id or name.
+    :return: <list> the command.
+    """
+    if 'mosfire' in str(uid):
+        return ["sudo", "setpriv", f"--reuid={uid}", f"--regid={gid}",
+                "--groups=mosgrp"]
+
+    return ["sudo", "setpriv", f"--reuid={uid}", f"--regid={gid}",
+            "--clear-groups"]
+
+
+class PrivHelper:
+    def __init__(self, uid, gid, log, python=None, setpriv=True):
+        """
+        A helper process running as uid / gid.
+
+        :param uid: <int/str> the user id or name.
+        :param gid: <int/str> the group id or name.
+        :param log: <class 'logging.Logger'> the log
+        :param python: <str> the python to run the helper,  default is the
+                             python running the scrubber.
+        :param setpriv: <bool> False runs the helper as the current user.
+        """
+        self.uid = uid
+        self.gid = gid
+        self.log = log
+        self.python = python or sys.executable
+        self.setpriv = setpriv
+        self.proc = None
+        self.req_id = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the helper and check it answers.
+
+        :return: <bool> True if the helper is running.
+        """
+        cmd = setpriv_cmd(self.uid, self.gid) if self.setpriv else []
+        cmd += [self.python, HELPER_PATH, '--serve']
+        scrubber_metrics.inc('scrubber_subprocess_total', cmd='helper')
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL,
+                                         text=True, bufsize=1)
+        except OSError as err:
+            self.log.warning(f'could not start helper {cmd}: {err}')
+            self.proc = None
+            return False
+
+        if self._send([]) is None:
+            self.close()
+            return False
+
+        self.log.info(f'started helper for {self.uid}/{self.gid}, '
+                      f'pid: {self.proc.pid}')
+
+        return True
+
+    def run_ops(self, ops, chunk=1000):
+        """
+        Run the operations in the helper,  sent in batches of chunk.
+
+        :param ops: <list<list>> the operations,  ie: [['rmdir', path], ...]
+        :param chunk: <int> the number of operations sent at once.
+        :return: <list<dict>> the result of each operation run,  fewer
+                              results than operations if the helper failed.
+        """
+        results = []
+        for indx in range(0, len(ops), chunk):
+            batch_results = self._send(ops[indx:indx + chunk])
+            if batch_results is None:
+                break
+            results += batch_results
+
+        return results
+
+    def _send(self, ops):
+        with self.lock:
+            if not self.proc or self.proc.poll() is not None:
+                return None
+
+            self.req_id += 1
+            try:
+                with scrubber_metrics.timer('scrubber_helper_seconds'):
+                    self.proc.stdin.write(json.dumps({'id': self.req_id,
+                                                      'ops': ops}) + '\n')
+                    self.proc.stdin.flush()
+                    response = json.loads(self.proc.stdout.readline())
+            except (OSError, ValueError) as err:
+                self.log.warning(f'helper for {self.uid}/{self.gid} failed: {err}')
+                return None
+
+        if response.get('id') != self.req_id or 'results' not in response:
+            self.log.warning(f'helper for {self.uid}/{self.gid} bad '
+                             f'response: {response}')
+            return None
+
+        return response['results']
+
+    def close(self):
+        with self.lock:
+            if not self.proc:
+                return
+            try:
+                self.proc.stdin.close()
+                self.proc.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
+            self.proc = None
+
+
+class HelperPool:
+    def __init__(self, config, log, setpriv=True):
+        """
+        The helpers for each (uid, gid),  started when first used.  Without
+        the [helper] section (or enabled = 0),  and if a helper cannot be
+        started,  the operations are run with run_cmd_as_user.
+
+        :param config: <class 'configparser.ConfigParser'> the config file parser.
+        :param log: <class 'logging.Logger'> the log
+        :param setpriv: <bool> False runs the helpers and the commands as the
+                               current user,  without sudo setpriv,  only for
+                               scrubber_bench.py e2e.
+        """
+        self.log = log
+        self.setpriv = setpriv
+        self.helpers = {}
+        # the copy helpers,  and the idle ones for each (uid, gid)
+        self.copy_helpers = []
+        self.idle = {}
+        self.no_copy_helper = set()
+        self.lock = threading.Lock()
+        try:
+            self.enabled = int(config['helper']['enabled'])
+            self.python = config['helper'].get('python') or None
+        except (KeyError, ValueError):
+            self.enabled = 0
+            self.python = None
+
+    def get_helper(self, uid, gid):
+        """
+        :return: <PrivHelper> the running helper for uid / gid,  or None.
+        """
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            key = self._key(uid, gid)
+            if key not in self.helpers:
+                helper = PrivHelper(uid, gid, self.log, self.python,
+                                    self.setpriv)
+                self.helpers[key] = helper if helper.start() else None
+
+            return self.helpers[key]
+
+    def checkout_helper(self, uid, gid):
+        """
+        An idle copy helper for uid / gid,  started when all are busy.  The
+        helper is returned with checkin_helper and reused by the later
+        transfers,  so there is one helper per transfer running at once.
+
+        :return: <PrivHelper> the helper,  or None.
+        """
+        if not self.enabled:
+            return None
+
+        key = self._key(uid, gid)
+        with self.lock:
+            if key in self.no_copy_helper:
+                return None
+            idle = self.idle.setdefault(key, [])
+            if idle:
+                return idle.pop()
+
+        helper = PrivHelper(uid, gid, self.log, self.python, self.setpriv)
+        with self.lock:
+            if not helper.start():
+                self.no_copy_helper.add(key)
+                return None
+            self.copy_helpers.append(helper)
+
+        return helper
+
+    def checkin_helper(self, uid, gid, helper):
+        """
+        Return a copy helper of checkout_helper.
+        """
+        with self.lock:
+            self.idle.setdefault(self._key(uid, gid), []).append(helper)
+
+    @staticmethod
+    def _key(uid, gid):
+        return str(uid), str(gid)
+
+    def run_ops(self, uid, gid, ops):
+        """
+        Run the operations as uid / gid.
+
+        :param uid: <int/str> the user id or name.
+        :param gid: <int/str> the group id or name.
+        :param ops: <list<list>> the operations,  ie: [['mkdir', path], ...]
+        :return: <list<bool>> True for each operation that succeeded.
+        """
+        return [result['ok'] for result in
+                self.run_ops_results(uid, gid, ops)]
+
+    def run_ops_results(self, uid, gid, ops):
+        """
+        Run the operations as uid / gid.
+
+        :return: <list<dict>> the result of each operation (see run_op).
+        """
+        if not ops:
+            return []
+
+        helper = self.get_helper(uid, gid)
+        results = self._helper_ops(helper, uid, gid, ops)
+        if len(results) == len(ops):
+            return results
+
+        # the helper may still be running after a bad response
+        if helper:
+            helper.close()
+            with self.lock:
+                self.helpers[self._key(uid, gid)] = None
+
+        return results + self._setpriv_ops(uid, gid, ops[len(results):])
+
+    def _helper_ops(self, helper, uid, gid, ops):
+        """
+        :return: <list<dict>> the results of the operations run by the
+                              helper,  in order,  fewer results than
+                              operations if there is no helper or it failed.
+        """
+        results = helper.run_ops(ops) if helper else []
+        for op, result in zip(ops, results):
+            if not result['ok']:
+                self.log.warning(f"Error: {op} as {uid}/{gid}, "
+                                 f"{result.get('error')}")
+
+        if helper and len(results) < len(ops):
+            self.log.warning(f'helper for {uid}/{gid} failed,  running '
+                             f'{len(ops) - len(results)} of {len(ops)} '
+                             f'commands with setpriv.')
+
+        return results
+
+    def _setpriv_ops(self, uid, gid, ops):
+        import scrubber_utils as utils
+        results = []
+        for op in ops:
+            op_args = list(op[1:3]) if op[0] == 'copy' else list(op[1:])
+            ok = utils.run_cmd_as_user(uid, gid, OP_CMDS[op[0]] + op_args,
+                                       self.log, setpriv=self.setpriv)
+            results.append({'ok': ok, 'hash': None} if op[0] == 'copy'
+                           else {'ok': ok})
+
+        return results
+
+    def copy_files(self, uid, gid, pairs, algorithm=None):
+        """
+        Copy files as uid / gid with the native copy (see copy_file),  in
+        an idle copy helper,  so the transfers run at once.
+
+        :param pairs: <list<tuple>> (source path, destination path).
+        :param algorithm: <str> hash the sources while copying.
+        :return: <dict> source path: hash (None without a hash) of each
+                        file copied.
+        """
+        ops = [['copy', src, dst, algorithm] for src, dst in pairs]
+        if not ops:
+            return {}
+
+        helper = self.checkout_helper(uid, gid)
+        results = self._helper_ops(helper, uid, gid, ops)
+        if len(results) == len(ops):
+            self.checkin_helper(uid, gid, helper)
+        else:
+            if helper:
+                helper.close()
+            results += self._setpriv_ops(uid, gid, ops[len(results):])
+
+        return {pair[0]: result.get('hash')
+                for pair, result in zip(pairs, results) if result['ok']}
+
+    def run_op(self, uid, gid, op):
+        """
+        Run one operation as uid / gid.
+
+        :return: <bool> True if the operation succeeded.
+        """
+        return self.run_ops(uid, gid, [op])[0]
+
+    def close(self):
+        with self.lock:
+            helpers = [helper for helper in self.helpers.values() if helper]
+            helpers += self.copy_helpers
+            self.helpers = {}
+            self.copy_helpers = []
+            self.idle = {}
+
+        for helper in helpers:
+            helper.close()
+
+
+if __name__ == '__main__':
+    if '--serve' in sys.argv[1:]:
+        serve()
+    else:
+        sys.exit(f'usage: {sys.argv[0]} --serve')
@@ -0,0 +1,183 @@
+"""
+Write-ahead journal of the work done by a scrubber run.
+
+Each step (transfer,  source removal,  DB update) is written to the journal
+as an intent before it starts and as a commit when it is done,  each record
+is fsync'd.  The intents of an interrupted run have no commit,  they are
+read when the next run starts so the scrubber can roll them forward before
+new work begins.
+
+The journal is one JSON record per line:
+    {"seq": 1, "op": "intent", "step": "transfer", "func": ..., "args": [...]}
+    {"seq": 2, "op": "intent", "step": "update", "update": [...], "koaid": ...}
+    {"op": "commit", "seqs": [1, 2]}
+"""
+
+import os
+import json
+import threading
+
+
+class Journal:
+    def __init__(self, path, log=None):
+        """
+        Open the journal,  read the intents not committed by the last run and
+        rewrite the journal with only those intents.
+
+        :param path: <str> the journal file.
+        :param log: <class 'logging.Logger'> the log
+        """
+        self.path = path
+        self.log = log
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.pending = {}
+        self.update_seqs = {}
+
+        self._load()
+        self.recovered = sorted(self.pending.values(), key=lambda rec: rec['seq'])
+
+        # compact,  the new journal holds only the incomplete intents
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as fp:
+            for record in self.recovered:
+                fp.write(json.dumps(record) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+
+    def _load(self):
+        try:
+            with open(self.path) as fp:
+                lines = fp.readlines()
+        except FileNotFoundError:
+            return
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last record of a crashed run can be cut short
+                continue
+
+            if record.get('op') == 'intent':
+                self.seq = max(self.seq, record['seq'])
+                self.pending[record['seq']] = record
+                if record['step'] == 'update':
+                    key = (tuple(record['update']), record['koaid'])
+                    self.update_seqs.setdefault(key, []).append(record['seq'])
+            elif record.get('op') == 'commit':
+                for seq in record.get('seqs', []):
+                    self.pending.pop(seq, None)
+
+        # drop the commits of the intents that were removed
+        for key, seqs in list(self.update_seqs.items()):
+            seqs = [seq for seq in seqs if seq in self.pending]
+            if seqs:
+                self.update_seqs[key] = seqs
+            else:
+                del self.update_seqs[key]
+
+    def _write(self, record):
+        os.write(self.fd, (json.dumps(record) + '\n').encode())
+        os.fsync(self.fd)
+
+    def incomplete(self):
+        """
+        :return: <list<dict>> the intents left incomplete by the last run.
+        """
+        return list(self.recovered)
+
+    def intent(self, step, **data):
+        """
+        Record the intent to start a step.
+
+        :param step: <str> transfer,  remove or update.
+        :param data: the values to replay the step.
+        :return: <int> the sequence number of the intent.
+        """
+        with self.lock:
+            self.seq += 1
+            record = {'seq': self.seq, 'op': 'intent', 'step': step}
+            record.update(data)
+            self._write(record)
+            self.pending[self.seq] = record
+
+            return self.seq
+
+    def commit(self, seqs):
+        """
+        Record the steps as done.
+
+        :param seqs: <list<int>> the sequence numbers of the intents.
+        """
+        seqs = list(seqs)
+        if not seqs:
+            return
+
+        with self.lock:
+            self._write({'op': 'commit', 'seqs': seqs})
+            for seq in seqs:
+                self.pending.pop(seq, None)
+
+    def update_intent(self, update, koaid):
+        """
+        Record the intent to update a koaid in the DB.
+
+        :param update: <tuple> the update (column name, values...).
+        :param koaid: <str> the koaid to update.
+        """
+        seq = self.intent('update', update=list(update), koaid=koaid)
+        with self.lock:
+            self.update_seqs.setdefault((tuple(update), koaid), []).append(seq)
+
+    def commit_updates(self, update, koaids):
+        """
+        Record the DB updates of the koaids as done.
+
+        :param update: <tuple> the update (column name, values...).
+        :param koaids: <list<str>> the koaids updated.
+        """
+        seqs = []
+        with self.lock:
+            for koaid in koaids:
+                seqs += self.update_seqs.pop((tuple(update), koaid), [])
+
+        self.commit(seqs)
+
+    def close(self):
+        """
+        Close the journal,  it is removed if all the steps are done.
+        """
+        with self.lock:
+            os.close(self.fd)
+            if not self.pending:
+                os.remove(self.path)
+            elif self.log:
+                self.log.warning(f'{len(self.pending)} incomplete steps in '
+                                 f'the journal: {self.path}')
+
+
+def open_journal(config, name, log=None):
+    """
+    Open the journal in the [journal] dir of the config file.
+
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :param name: <str> the name of the journal,  one per scrubber and
+                       instrument,  ie: rti_k1_NIRES
+    :param log: <class 'logging.Logger'> the log
+    :return: <Journal> the journal,  None if no journal dir is configured.
+    """
+    try:
+        journal_dir = config['journal']['dir']
+    except KeyError:
+        return None
+
+    if not journal_dir:
+        return None
+
+    os.makedirs(journal_dir, exist_ok=True)
+
+    return Journal(f'{journal_dir}/{name}.journal', log)
@@ -0,0 +1,290 @@
+"""
+Performance metrics of the scrubber runs.
+
+The metrics are kept in one registry per process:  counters,  gauges and
+histograms of seconds,  each with a set of labels.  At the end of a run
+they are written to a node-exporter textfile (Prometheus text format) and
+to a JSON summary,  in the [metrics] directories of the config file.
+
+    scrubber_phase_seconds      the time in each phase of a run (query,
+                                verify, mkdir, transfer, remove, update,
+                                count),  a histogram.
+    scrubber_api_seconds        the latency of the API requests.
+    scrubber_subprocess_seconds the latency of each process spawned.
+    scrubber_scan_seconds       the latency of the directory scans (NFS).
+    scrubber_files_total / scrubber_bytes_total
+                                the files and bytes moved and removed.
+
+Only the standard library is used,  the helper process imports it.
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime
+
+# seconds,  from a stat on a fast mount to a long transfer
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+
+class Metrics:
+    """
+    A thread-safe registry of counters,  gauges and histograms.
+    """
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: <tuple<float>> the upper bounds of the histograms.
+        """
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(val)) for key, val in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add to a counter.
+
+        :param name: <str> the metric name.
+        :param value: <float> the amount to add.
+        :param labels: the labels of the series,  ie: phase='transfer'
+        """
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge.
+
+        :param name: <str> the metric name.
+        :param value: <float> the value.
+        :param labels: the labels of the series.
+        """
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Add a value to a histogram.
+
+        :param name: <str> the metric name.
+        :param seconds: <float> the value.
+        :param labels: the labels of the series.
+        """
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            indx = bisect.bisect_left(self.buckets, seconds)
+            if indx < len(self.buckets):
+                hist[0][indx] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Time a block of code into a histogram.
+
+            with metrics.timer('scrubber_phase_seconds', phase='mkdir'):
+                ...
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def phase(self, phase, **labels):
+        """
+        Time a phase of a run.
+
+        :param phase: <str> query, verify, mkdir, transfer, remove, update,
+                            count
+        """
+        return self.timer('scrubber_phase_seconds', phase=phase, **labels)
+
+    def timed_iter(self, name, rows, **labels):
+        """
+        Yield the items of an iterator,  the time waiting for each item is
+        added to one observation,  ie: the time reading the API results.
+
+        :param name: <str> the metric name.
+        :param rows: <iterable> the items.
+        :return: yields each item.
+        """
+        waited = 0.0
+        rows = iter(rows)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    waited += time.perf_counter() - start
+                yield row
+        finally:
+            self.observe(name, waited, **labels)
+
+    def snapshot(self):
+        """
+        :return: <dict> the metrics as JSON-able lists of
+                        {'name':, 'labels':, ...}
+        """
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            gauges = [{'name': name, 'labels': dict(labels), 'value': value}
+                      for (name, labels), value in sorted(self.gauges.items())]
+            histograms = [{'name': name, 'labels': dict(labels),
+                           'count': hist[2], 'sum': round(hist[1], 6),
+                           'buckets': dict(zip(map(str, self.buckets), hist[0]))}
+                          for (name, labels), hist in sorted(self.histograms.items())]
+
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def to_text(self, const_labels=None):
+        """
+        The metrics in the Prometheus text format.
+
+        :param const_labels: <dict> labels added to every series,  ie: the
+                                    scrubber and instrument.  The series of
+                                    another instrument (a label with another
+                                    value) are not included.
+        :return: <str> the text.
+        """
+        const_labels = {key: str(val) for key, val in (const_labels or {}).items()}
+
+        def other_run(labels):
+            return any(const_labels.get(key, val) != val for key, val in labels)
+
+        def fmt(labels, **extra):
+            labels = dict(const_labels, **dict(labels), **extra)
+            if not labels:
+                return ''
+            pairs = ','.join(f'{key}="{_escape(val)}"'
+                             for key, val in sorted(labels.items()))
+            return '{' + pairs + '}'
+
+        lines = []
+        with self.lock:
+            for kind, series in (('counter', self.counters),
+                                 ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(series.items()):
+                    if other_run(labels):
+                        continue
+                    if name not in typed:
+                        lines.append(f'# TYPE {name} {kind}')
+                        typed.add(name)
+                    lines.append(f'{name}{fmt(labels)} {value}')
+
+            typed = set()
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if other_run(labels):
+                    continue
+                if name not in typed:
+                    lines.append(f'# TYPE {name} histogram')
+                    typed.add(name)
+                total = 0
+                for bound, count in zip(self.buckets, hist[0]):
+                    total += count
+                    lines.append(f'{name}_bucket{fmt(labels, le=bound)} {total}')
+                lines.append(f'{name}_bucket{fmt(labels, le="+Inf")} {hist[2]}')
+                lines.append(f'{name}_sum{fmt(labels)} {hist[1]:.6f}')
+                lines.append(f'{name}_count{fmt(labels)} {hist[2]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+
+def _escape(val):
+    return str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# the registry of the process,  used by scrubber_utils and the scrubbers
+REGISTRY = Metrics()
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+phase = REGISTRY.phase
+timed_iter = REGISTRY.timed_iter
+
+
+@contextmanager
+def spawn(cmd):
+    """
+    Count and time a process spawned.
+
+    :param cmd: <str> the program,  ie: rsync
+    """
+    inc('scrubber_subprocess_total', cmd=cmd)
+    with timer('scrubber_subprocess_seconds', cmd=cmd):
+        yield
+
+
+def write_run_metrics(config, name, const_labels=None, summary=None, log=None):
+    """
+    Write the metrics of a run to the [metrics] textfile_dir (for the
+    node-exporter textfile collector) and json_dir.  The textfile is
+    written to a temp file and renamed so a partial file is never read.
+
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :param name: <str> the name of the files,  ie: rti_k2_NIRES
+    :param const_labels: <dict> labels added to every series.
+    :param summary: <dict> the run totals added to the JSON summary.
+    :param log: <class 'logging.Logger'> the log
+    :return: <list<str>> the files written.
+    """
+    try:
+        textfile_dir = config['metrics'].get('textfile_dir', '')
+        json_dir = config['metrics'].get('json_dir', '')
+    except KeyError:
+        return []
+
+    written = []
+    try:
+        if textfile_dir:
+            os.makedirs(textfile_dir, exist_ok=True)
+            path = f'{textfile_dir}/scrubber_{name}.prom'
+            with open(f'{path}.tmp', 'w') as fp:
+                fp.write(REGISTRY.to_text(const_labels))
+            os.replace(f'{path}.tmp', path)
+            written.append(path)
+
+        if json_dir:
+            os.makedirs(json_dir, exist_ok=True)
+            now = datetime.now()
+            path = f"{json_dir}/scrubber_{name}_{now.strftime('%Y%m%d_%H%M%S')}.json"
+            record = {'name': name, 'date': now.strftime('%Y-%m-%d %H:%M:%S'),
+                      'labels': const_labels or {}, 'summary': summary or {}}
+            record.update(REGISTRY.snapshot())
+            with open(path, 'w') as fp:
+                json.dump(record, fp, indent=1, default=str)
+            written.append(path)
+    except OSError as err:
+        if log:
+            log.warning(f'could not write the metrics: {err}')
+
+    if log and written:
+        log.info(f'metrics written to: {written}')
+
+    return written
@@ -0,0 +1,189 @@
+"""
+The --profile mode of the scrubbers.
+
+The run is profiled with cProfile and its memory traced with tracemalloc.
+When the scrubber exits (also on sys.exit) the profile is written next to
+the run log:
+
+    <log_name>_<date>.pstats        read with:  python -m pstats <file>
+    <log_name>_<date>.tracemalloc   read with:  tracemalloc.Snapshot.load
+
+and a table of the hotspots,  the peak memory and the time spent before
+the profile started (the imports,  ie: astropy) is added to the run log.
+The time in the API,  the spawned processes and the directory scans is
+added from scrubber_metrics when it was used.
+
+The --dev runs can be profiled,  ie: to profile a production size run
+without moving the files.
+"""
+
+import io
+import os
+import sys
+import time
+import atexit
+import pstats
+import logging
+import cProfile
+import tracemalloc
+
+from datetime import datetime
+
+TOP = 25
+
+
+def startup_seconds():
+    """
+    The seconds since the process started,  the interpreter start and the
+    imports before the profile starts.
+
+    :return: <float> the seconds,  None if not known (not Linux).
+    """
+    try:
+        with open('/proc/self/stat') as fp:
+            # the command can have spaces,  the fields start after the ')'
+            fields = fp.read().rsplit(')', 1)[1].split()
+        start_ticks = int(fields[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - \
+            start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError, AttributeError):
+        return None
+
+
+class Profiler:
+    def __init__(self, top=TOP):
+        """
+        :param top: <int> the number of functions in the hotspot table.
+        """
+        self.top = top
+        self.profile = cProfile.Profile()
+        self.log = None
+        self.startup = None
+        self.start_time = None
+        self.done = False
+
+    def start(self):
+        self.startup = startup_seconds()
+        self.start_time = time.time()
+        tracemalloc.start()
+        self.profile.enable()
+        atexit.register(self.stop)
+
+    def set_log(self, log):
+        """
+        Set the run log,  the profile is written to the directory of its
+        file.
+
+        :param log: <class 'logging.Logger'> the log
+        """
+        self.log = log
+
+    def _out_prefix(self):
+        log_path = None
+        if self.log:
+            log_path = next((handler.baseFilename for handler in self.log.handlers
+                             if isinstance(handler, logging.FileHandler)), None)
+        if log_path:
+            prefix = os.path.splitext(log_path)[0]
+        else:
+            prefix = os.path.join(os.getcwd(), os.path.basename(sys.argv[0])
+                                  .replace('.py', ''))
+
+        return f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+    def stop(self):
+        """
+        Stop the profile,  write the pstats and tracemalloc files and add
+        the report to the log.
+
+        :return: <str> the report,  None if already stopped.
+        """
+        if self.done:
+            return None
+        self.done = True
+
+        self.profile.disable()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        prefix = self._out_prefix()
+        written = []
+        try:
+            self.profile.dump_stats(f'{prefix}.pstats')
+            written.append(f'{prefix}.pstats')
+            snapshot.dump(f'{prefix}.tracemalloc')
+            written.append(f'{prefix}.tracemalloc')
+        except OSError as err:
+            written.append(f'could not write the profile: {err}')
+
+        report = self.report(snapshot, peak, written)
+        if self.log:
+            self.log.info(report)
+        else:
+            print(report, file=sys.stderr)
+
+        return report
+
+    def report(self, snapshot, peak, written):
+        """
+        :return: <str> the hotspot table,  the memory and the files written.
+        """
+        lines = ['PROFILE',
+                 f'run time: {time.time() - self.start_time:.2f} s']
+        if self.startup is not None:
+            lines.append(f'before the profile (imports): {self.startup:.2f} s')
+        lines.append(f'peak traced memory: {peak / 1e6:.1f} MB')
+        lines += self._metric_totals()
+
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        lines.append(stream.getvalue().strip())
+
+        lines.append('largest allocations (by line):')
+        for stat in snapshot.statistics('lineno')[:10]:
+            lines.append(f'    {stat}')
+
+        lines += [f'written: {path}' for path in written]
+
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _metric_totals():
+        """
+        :return: <list<str>> the total time in the API,  the spawned
+                             processes and the directory scans.
+        """
+        metrics = sys.modules.get('scrubber_metrics')
+        if not metrics:
+            return []
+
+        totals = {}
+        for hist in metrics.REGISTRY.snapshot()['histograms']:
+            name = hist['name']
+            if 'phase' in hist['labels']:
+                name = f"{name} {hist['labels']['phase']}"
+            total = totals.setdefault(name, [0.0, 0])
+            total[0] += hist['sum']
+            total[1] += hist['count']
+
+        return [f'{name}: {total[0]:.2f} s in {total[1]} calls'
+                for name, total in sorted(totals.items())]
+
+
+def start(enabled, top=TOP):
+    """
+    Start the profile of a run.
+
+    :param enabled: <bool> the --profile argument.
+    :param top: <int> the number of functions in the hotspot table.
+    :return: <Profiler> the running profiler,  None when not enabled.
+    """
+    if not enabled:
+        return None
+
+    profiler = Profiler(top)
+    profiler.start()
+
+    return profiler
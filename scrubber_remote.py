@@ -0,0 +1,58 @@
+"""
+The commands run on the remote servers,  over the shared ssh connections of
+scrubber_ssh.
+
+Loaded by scrubber_utils on the first use of one of its names.
+"""
+
+from scrubber_utils import get_config_param, disk_free
+
+
+def remote_df(user, ip, path):
+    """
+    Executes df on remote host and return
+    (total, free, used) as int in bytes
+    """
+    return disk_free([path], user, ip)[path]
+
+
+def inst_disk_usage_ok(inst, config, config_type, log):
+    """
+    Determine if the used disk space is less than the free disk space.
+
+    :param inst: <str> the instrument name
+    :param config: <class 'configparser.ConfigParser'>
+        the pointer to the config file
+    :param config_type: <str> either dev or default
+    :param log: <class 'logging.Logger'> the log
+    :return: <bool> True if disk used < disk free
+    """
+    koa_disk, storage_disk = get_locations(inst, config, config_type)
+    user = get_config_param(config, config_type, 'user')
+    server = get_config_param(config, 'servers', 'user')
+
+    stats = remote_df(user, server, koa_disk)
+    log.info(f'Disk Space Statistics for {inst} in {server}: {koa_disk}.')
+    log.info(f'Total: {stats.total}, Used: {stats.used}, Free: {stats.free}')
+
+    return stats.used < stats.free
+
+
+def get_locations(inst, config, config_type):
+    """
+    Determine the directories on each of the disks.
+
+    :param inst: <str> the instrument
+    :param config: the config file pointer
+    :return: <(str,str)> the paths to the files
+    """
+    koa_disk_root = get_config_param(config, 'koa_disk', 'path_root')
+    koa_disk_num = get_config_param(config, 'koa_disk', inst)
+    storage_disk_root = get_config_param(config, config_type, 'storage_root')
+    storage_disk_num = get_config_param(config, 'storage_disk', inst)
+
+    koa_disk = f'{koa_disk_root}{koa_disk_num}'
+    storage_disk = f'{storage_disk_root}{storage_disk_num}'
+
+    return koa_disk, storage_disk
+
@@ -0,0 +1,204 @@
+"""
+The reports of the scrubber runs and the emails.
+
+Loaded by scrubber_utils on the first use of one of its names.
+"""
+
+from datetime import datetime
+
+import scrubber_rules
+from scrubber_utils import get_config_param
+
+
+def send_email(email_msg, mailto, mailfrom, mailserver, subject, log):
+    """
+    send an email if there are any warnings or errors logged.
+
+    :param email_msg: <str> message to mail.
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    """
+    if not email_msg:
+        return
+
+    import smtplib
+
+    msg = f"From: {mailfrom}\r\nTo: {mailto}\r\n"
+    msg += f"Subject: {subject}\r\n\r\n{email_msg}"
+
+    try:
+        server = smtplib.SMTP(mailserver)
+        server.sendmail(mailfrom, mailto, msg)
+        server.quit()
+    except Exception as err:
+        log.warning(f"Error sending Email. Error: {err}.")
+
+
+def create_rti_report(args, metrics, move, inst):
+    """
+    Form the report to be emailed at the end of a scrub run.
+
+    :param metrics: <dict> the values of files,  moved, removed, total.
+    :return: <str> the report.
+    """
+
+    report = f"\nRTI Data Scrubber Results for {inst.upper()} " \
+             f"{args.utd} to {args.utd2}."
+
+    header = "Totals"
+    report += f"\n\n{header}" + "\n" + "-" * len(header)
+    report += f"\n{metrics['total_koa_mv']} : Total KOA files moved."
+    report += f"\n{metrics['total_storage_mv']} : Total Storage difference."
+    if 'removed' in metrics:
+        report += f"\n{metrics['removed'][0]} : Source files removed " \
+                  f"({metrics['removed'][1]} bytes)."
+
+    header = "Number of results"
+    report += f"\n\n{header}" + "\n" + "-" * len(header)
+    report += f"\n{metrics['nresults']['mv0'][0]} : KOAID in results to move (lev0)."
+    report += f"\n{metrics['nresults']['mv0'][1]} : verified results to move (lev0)."
+    report += f"\n{metrics['nresults']['mv1'][0]} : KOAID in results to move (lev1)."
+    report += f"\n{metrics['nresults']['mv1'][1]} : verified results to move (lev1)."
+    report += f"\n{metrics['nresults']['mv2'][0]} : KOAID in results to move (lev2)."
+    report += f"\n{metrics['nresults']['mv2'][1]} : verified results to move (lev2)."
+
+    report += rejected_report(metrics)
+
+    for val in {'mv0', 'del0', 'mv1'}:
+        diff = metrics['nresults'][val][0] - metrics['nresults'][val][1]
+        if diff > 0:
+            report += f"\n\nErrors: "
+            for err in metrics['warnings']:
+                report += f"\n    {err}"
+
+    if metrics.get('transfer_limits'):
+        header = "Transfer limits"
+        report += f"\n\n{header}" + "\n" + "-" * len(header)
+        for line in metrics['transfer_limits']:
+            report += f"\n{line}"
+
+    if move:
+        header = "Fits Files created by DEP on vm-[k1/k2]koarti"
+        report += f"\n\n{header}" + "\n" + "-" * len(header)
+        report += f"\n{metrics['staged'][0]} : Stage files found."
+        report += f"\n{metrics['staged'][1]} : Stage files moved."
+
+    report += f"\n\nTotal number of KOAIDs not previously deleted (any status): "
+    report += f"{metrics['total_files']}"
+
+    return report
+
+
+def rejected_report(metrics):
+    """
+    The results rejected by each verification rule.
+
+    :param metrics: <dict> the metrics with the 'rejected' counts.
+    :return: <str> the report section,  empty if none were rejected.
+    """
+    lines = scrubber_rules.rejected_report(metrics.get('rejected') or {})
+    if not lines:
+        return ''
+
+    header = "Results rejected by rule"
+    report = f"\n\n{header}" + "\n" + "-" * len(header)
+    for line in lines:
+        report += f"\n{line}"
+
+    return report
+
+
+def create_sdata_report(args, metrics, inst):
+    """
+    Form the report to be emailed at the end of a scrub run.
+
+    :param metrics: <dict> the values of files,  moved, removed, total.
+    :return: <str> the report.
+    """
+
+    report = f"\nRTI Data Scrubber Results for {inst.upper()} " \
+             f"{args.utd} to {args.utd2}."
+
+    header = "Number of results"
+    report += f"\n\n{header}" + "\n" + "-" * len(header)
+
+    report += f"\n{metrics['nresults']['sdata'][0]} : KOAID in sdata results to delete (lev0)."
+    report += f"\n{metrics['nresults']['sdata'][1]} : verified sdata results to delete (lev0)."
+
+    report += rejected_report(metrics)
+
+    for val in {'sdata'}:
+        diff = metrics['nresults'][val][0] - metrics['nresults'][val][1]
+        if diff > 0:
+            report += f"\n\nErrors: "
+            for err in metrics['warnings']:
+                report += f"\n    {err}"
+
+    header = "Files on Instrument servers"
+    report += f"\n\n{header}" + "\n" + "-" * len(header)
+    report += f"\n{metrics['sdata'][0]} : OFNAME Files found."
+    report += f"\n{metrics['sdata'][1]} : OFNAME Files deleted."
+
+    report += f"\n\nTotal number of SDATA not previously deleted (any status): "
+    report += f"{metrics['total_files']}"
+
+    return report
+
+
+def create_nightly_report(metrics, utd, utd2):
+    """
+    Form the report to be emailed at the end of a scrub run.
+
+    :param metrics: <dict> the values of files,  moved, removed, total.
+    :return: <str> the report.
+    """
+
+    report = f"KOA DEP Files moved to storage for dates: {utd} to {utd2}"
+    report += f"\n\n{metrics['koa_before']} : Total KOA files BEFORE."
+    report += f"\n{metrics['store_before']} : Total Storage files BEFORE."
+    report += f"\n{metrics['koa_after']} : Total KOA files AFTER."
+    report += f"\n{metrics['store_after']} : Total Storage files AFTER."
+
+    diff_koa = metrics['koa_before'] - metrics['koa_after']
+    diff_mv = metrics['store_after'] - metrics['store_before']
+
+    report += f"\n\n{diff_koa} : Number of files removed from KOA."
+    report += f"\n{diff_mv} : Number of files moved to storage.\n"
+
+    return report
+
+
+def write_emails(config, report, log, log_stream=None, errors=None, prefix=''):
+    """
+    Finish up the scrubbers,  create and send the emails.
+
+    :param config: the pointer to the config file.
+    :param report: the report to send.
+    :param log_stream: the logging stream.
+    :param errors: <dict> error key,  koaid list val
+    :param prefix: prefix for the subject of the email.
+    """
+    now = datetime.now().strftime('%Y-%m-%d')
+    mailto = get_config_param(config, 'email', 'admin')
+    mailfrom = get_config_param(config, 'email', 'from')
+    mailserver = get_config_param(config, 'email', 'server')
+
+    send_email(report, mailto, mailfrom, mailserver,
+               f'{prefix} Scrubber Report: {now}', log)
+
+    if log_stream:
+        log_contents = log_stream.getvalue()
+        log_stream.close()
+
+        if log_contents:
+            mailto = get_config_param(config, 'email', 'warnings')
+            send_email(log_contents, mailto, mailfrom, mailserver,
+                       f'{prefix} Scrubber Warnings: {now}', log)
+
+    if errors:
+        error_report = "ERRORS FOUND / KOAID\n\n"
+        for err in errors.keys():
+            error_report += f'ERROR: {err} \n {errors[err]}\n\n'
+
+        mailto = get_config_param(config, 'email', 'warnings')
+        send_email(error_report, mailto, mailfrom, mailserver,
+                   f'{prefix} Scrubber Warnings: {now}', log)
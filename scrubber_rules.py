@@ -0,0 +1,200 @@
+"""
+The verification rules of the API result rows.
+
+Each rule checks one property of the rows (the required columns are set,
+the status is archived,  the file is at storage, ...) and has a cost.  The
+engine reads the rows in batches and applies the rules cheapest first,  each
+rule to a whole column of the batch,  so a rule only sees the rows that
+passed the cheaper rules:  the NFS checks only run on rows with valid
+fields.  The rows rejected by each rule are counted for the report.
+
+    engine = RuleEngine(result_rules('koaid, status, process_dir', 'COMPLETE'))
+    for row in engine.verify(rows, reject_func):
+        ...
+"""
+
+# the cost of a check on the fields of a row,  and of a check over NFS
+FIELD_COST = 1
+IO_COST = 100
+
+
+class Batch:
+    """
+    A batch of rows,  with the values of each column read once.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, name):
+        """
+        :param name: <str> the column name.
+        :return: <list> the value of the column in each row,  None if missing.
+        """
+        if name not in self.columns:
+            self.columns[name] = [row.get(name) if row else None
+                                  for row in self.rows]
+
+        return self.columns[name]
+
+
+class Rule:
+    def __init__(self, name, message, check, cost=FIELD_COST, error=True):
+        """
+        :param name: <str> the name of the rule in the report.
+        :param message: <str> the message for a rejected row.
+        :param check: <func> check(batch),  returns a list of True / False
+                             (the row passed) for each row of the Batch.
+        :param cost: <int> the rules run in the order of their cost.
+        :param error: <bool> a rejected row is an error (reported),  False
+                             for rows skipped by design,  ie: path_exclude.
+        """
+        self.name = name
+        self.message = message
+        self.check = check
+        self.cost = cost
+        self.error = error
+
+
+class RuleEngine:
+    def __init__(self, rules, batch_size=1000):
+        """
+        :param rules: <list<Rule>> the rules,  run cheapest first (rules of
+                                   the same cost in the order given).
+        :param batch_size: <int> the rows checked at once.
+        """
+        self.rules = sorted(rules, key=lambda rule: rule.cost)
+        self.batch_size = max(1, batch_size)
+        self.rejected = {rule.name: 0 for rule in self.rules}
+
+    def verify(self, rows, reject_func=None):
+        """
+        Check the rows in batches,  as they are read.
+
+        :param rows: <iterable<dict>> the result rows.
+        :param reject_func: <func> reject_func(row, rule),  called for each
+                                   row rejected.
+        :return: <dict> yields the rows that passed every rule,  in order.
+        """
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                yield from self.verify_batch(batch, reject_func)
+                batch = []
+
+        if batch:
+            yield from self.verify_batch(batch, reject_func)
+
+    def verify_batch(self, rows, reject_func=None):
+        """
+        :param rows: <list<dict>> the result rows.
+        :param reject_func: <func> reject_func(row, rule).
+        :return: <list<dict>> the rows that passed every rule,  in order.
+        """
+        for rule in self.rules:
+            if not rows:
+                break
+
+            passed = rule.check(Batch(rows))
+            kept = []
+            for row, ok in zip(rows, passed):
+                if ok:
+                    kept.append(row)
+                    continue
+                self.rejected[rule.name] += 1
+                if reject_func:
+                    reject_func(row, rule)
+            rows = kept
+
+        return rows
+
+
+def not_empty_rule():
+    return Rule('empty', "No results found from query.",
+                lambda batch: [bool(row) for row in batch.rows], cost=0)
+
+
+def required_rule(columns, optional=()):
+    """
+    :param columns: <list<str>> the columns of the results.
+    :param optional: <list<str>> the columns that may be empty.
+    """
+    required = [col for col in columns if col not in optional]
+
+    def check(batch):
+        passed = [True] * len(batch)
+        for col in required:
+            passed = [ok and bool(val) for ok, val in
+                      zip(passed, batch.column(col))]
+        return passed
+
+    return Rule('incomplete', "INCOMPLETE RESULTS", check)
+
+
+def status_rule(archived_key):
+    """
+    :param archived_key: <str> the status of an archived file,  ie: COMPLETE
+    """
+    return Rule('status', f"INVALID STATUS, STATUS must be = {archived_key}",
+                lambda batch: [val == archived_key
+                               for val in batch.column('status')])
+
+
+def process_dir_rule():
+    return Rule('process_dir', "INVALID ARCHIVE DIR",
+                lambda batch: ['lev' in (val or '').split('/')[-1]
+                               for val in batch.column('process_dir')])
+
+
+def path_exclude_rule(path_exclude):
+    """
+    :param path_exclude: <str> skip the files with this string in the ofname.
+    """
+    return Rule('path_exclude', f"path contains: {path_exclude}",
+                lambda batch: [path_exclude not in (val or '')
+                               for val in batch.column('ofname')],
+                error=False)
+
+
+def stored_rule(stored_func):
+    """
+    :param stored_func: <func> stored_func(rows),  returns True / False for
+                               each row found at storage.
+    """
+    return Rule('not_stored', "data not on storage",
+                lambda batch: stored_func(batch.rows), cost=IO_COST,
+                error=False)
+
+
+def result_rules(column_str, archived_key, optional=()):
+    """
+    The field rules for the columns of a search.
+
+    :param column_str: <str> the comma separated columns in the results.
+    :param archived_key: <str> the status of an archived file.
+    :param optional: <list<str>> the columns that may be empty.
+    :return: <list<Rule>> the rules.
+    """
+    columns = column_str.replace(' ', '').split(',')
+
+    rules = [not_empty_rule(), required_rule(columns, optional)]
+    if 'status' in columns:
+        rules.append(status_rule(archived_key))
+    if 'process_dir' in columns:
+        rules.append(process_dir_rule())
+
+    return rules
+
+
+def rejected_report(rejected):
+    """
+    :param rejected: <dict> search: {rule name: rows rejected}
+    :return: <list<str>> a line for each rule that rejected rows.
+    """
+    return [f"{cnt} : {search} rejected by rule: {name}"
+            for search, counts in sorted(rejected.items())
+            for name, cnt in counts.items() if cnt]
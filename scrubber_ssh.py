@@ -0,0 +1,238 @@
+"""
+The ssh connections of the remote commands.
+
+One ssh connection is kept per (user, host) for the run,  with an OpenSSH
+ControlMaster socket:  the first command logs in and the later commands
+open a channel on the same connection,  without the key exchange and the
+login.  Commands run at once share the connection,  and run_many sends a
+list of commands in one channel:
+
+    pool = scrubber_ssh.ssh_pool()
+    result = pool.run('koaadmin', 'storageserver', ['df', '-P', '-k', path])
+    results = pool.run_many('k1obsao', 'k1aoserver-new',
+                            [['rmdir', dir1], ['rmdir', dir2]])
+
+The connections are closed (ssh -O exit) at exit,  or by close_pool.  Only
+the standard library is used,  the AO scrubber imports it.
+"""
+
+import os
+import shlex
+import shutil
+import atexit
+import tempfile
+import threading
+import subprocess
+
+import scrubber_metrics
+
+# the status of each command of run_many is written after this line
+MARKER = '__scrubber_ssh_status__'
+
+# seconds an idle connection is kept,  ie: if the run is killed
+PERSIST = 600
+
+
+class SshSession:
+    """
+    The multiplexed ssh connection to user@host.
+    """
+    def __init__(self, user, host, control_dir, connect_timeout=10):
+        """
+        :param user: <str> the remote user,  None for the ssh default.
+        :param host: <str> the remote host.
+        :param control_dir: <str> the directory of the control socket.
+        :param connect_timeout: <int> the seconds to wait to connect.
+        """
+        self.target = f'{user}@{host}' if user else host
+        # %C is a hash of the connection,  short enough for a socket path
+        self.control_path = os.path.join(control_dir, '%C')
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        self.started = False
+
+    def options(self):
+        """
+        :return: <list<str>> the ssh options to use the shared connection,
+                             ie: for rsync -e.
+        """
+        return ['-o', 'ControlMaster=auto',
+                '-o', f'ControlPath={self.control_path}',
+                '-o', f'ControlPersist={PERSIST}',
+                '-o', 'BatchMode=yes',
+                '-o', f'ConnectTimeout={self.connect_timeout}']
+
+    def command(self, cmd):
+        """
+        :param cmd: <list<str>> the remote command,  each argument is quoted
+                                for the remote shell.
+        :return: <list<str>> the ssh command.
+        """
+        return ['ssh'] + self.options() + [self.target, shlex.join(cmd)]
+
+    def start(self):
+        """
+        Open the connection,  once.  The commands run before the master is
+        up would each log in,  so the first caller opens it for the others.
+
+        :return: <bool> True if the connection is open.
+        """
+        with self.lock:
+            if self.started:
+                return True
+            cmd = ['ssh'] + self.options() + ['-N', '-f', self.target]
+            with scrubber_metrics.spawn('ssh'):
+                self.started = subprocess.run(
+                    cmd, stdin=subprocess.DEVNULL, capture_output=True,
+                    timeout=self.connect_timeout + 30).returncode == 0
+
+        return self.started
+
+    def run(self, cmd, timeout=None):
+        """
+        Run a command on the host.
+
+        :param cmd: <list<str>> the remote command,  ie: ['rmdir', path],
+                                the arguments are quoted,  not run by the
+                                remote shell.
+        :param timeout: <float> the seconds to wait.
+        :return: <subprocess.CompletedProcess> the result,  text output.
+        """
+        self.start()
+        with scrubber_metrics.spawn('ssh'):
+            return subprocess.run(self.command(cmd), stdin=subprocess.DEVNULL,
+                                  capture_output=True, text=True,
+                                  timeout=timeout)
+
+    def run_many(self, cmds, timeout=None):
+        """
+        Run a list of commands in one channel,  one after the other.
+
+        :param cmds: <list<list<str>>> the remote commands.
+        :param timeout: <float> the seconds to wait for all the commands.
+        :return: <list<(int, str)>> the exit status and the output of each
+                                    command,  -1 for the commands not run.
+        """
+        if not cmds:
+            return []
+
+        script = ''.join(f"{shlex.join(cmd)}\necho \"{MARKER} $?\"\n"
+                         for cmd in cmds)
+
+        self.start()
+        with scrubber_metrics.spawn('ssh'):
+            output = subprocess.run(self.command(['sh', '-s']), input=script,
+                                    capture_output=True, text=True,
+                                    timeout=timeout)
+
+        results = []
+        lines = []
+        for line in output.stdout.splitlines():
+            if line.startswith(MARKER):
+                results.append((int(line.split()[-1]), '\n'.join(lines)))
+                lines = []
+            else:
+                lines.append(line)
+
+        return results + [(-1, '')] * (len(cmds) - len(results))
+
+    def close(self):
+        """
+        Close the connection.
+        """
+        with self.lock:
+            if not self.started:
+                return
+            self.started = False
+            subprocess.run(['ssh', '-o', f'ControlPath={self.control_path}',
+                            '-O', 'exit', self.target],
+                           stdin=subprocess.DEVNULL, capture_output=True)
+
+
+class SshPool:
+    """
+    The ssh sessions of a run,  one per (user, host).
+    """
+    def __init__(self, connect_timeout=10):
+        """
+        :param connect_timeout: <int> the seconds to wait to connect.
+        """
+        self.connect_timeout = connect_timeout
+        self.control_dir = None
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, user, host):
+        """
+        :param user: <str> the remote user.
+        :param host: <str> the remote host.
+        :return: <SshSession> the session,  created on first use.
+        """
+        with self.lock:
+            if (user, host) not in self.sessions:
+                # the sockets are only for this process
+                if not self.control_dir:
+                    self.control_dir = tempfile.mkdtemp(prefix='scrub_ssh_')
+                self.sessions[(user, host)] = SshSession(
+                    user, host, self.control_dir, self.connect_timeout)
+
+            return self.sessions[(user, host)]
+
+    def run(self, user, host, cmd, timeout=None):
+        """
+        Run a command on user@host,  see SshSession.run.
+        """
+        return self.session(user, host).run(cmd, timeout)
+
+    def run_many(self, user, host, cmds, timeout=None):
+        """
+        Run a list of commands on user@host,  see SshSession.run_many.
+        """
+        return self.session(user, host).run_many(cmds, timeout)
+
+    def close(self):
+        """
+        Close the connections and remove the socket directory.
+        """
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+            control_dir, self.control_dir = self.control_dir, None
+
+        for session in sessions:
+            session.close()
+        if control_dir:
+            shutil.rmtree(control_dir, ignore_errors=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def ssh_pool():
+    """
+    :return: <SshPool> the ssh sessions of the process,  closed at exit.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = SshPool()
+
+        return _pool
+
+
+def close_pool():
+    """
+    Close the ssh sessions of the process,  a later command opens new ones.
+    """
+    global _pool
+
+    with _pool_lock:
+        pool, _pool = _pool, None
+
+    if pool:
+        pool.close()
+
+
+atexit.register(close_pool)
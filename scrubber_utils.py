@@ -1,22 +1,71 @@
-import requests
-from requests.exceptions import HTTPError
+"""
+The shared functions of the scrubbers.
+
+The functions with a heavy dependency are in submodules,  imported on the
+first use of one of their names (utils.get_rti_api,  utils.write_emails):
+
+    scrubber_api        the RTI API client (requests)
+    scrubber_fits       the KPF FITS headers (astropy)
+    scrubber_remote     the remote commands
+    scrubber_report     the reports and emails
+
+so a run only imports what it uses,  ie: a non-KPF run does not import
+astropy.  scrubber_bench.py startup checks the imports of a --dev run.
+"""
 
 import argparse
+import importlib
 import logging
+import json
+import mmap
 import os
 import sys
+import time
 from glob import glob
-import pexpect
-import tempfile
-
-from astropy.io import fits
 
 import subprocess
-from collections import namedtuple
+import threading
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from io import StringIO
+from scrubber_helper import file_hasher
+import scrubber_helper
+import scrubber_metrics
+import scrubber_ssh
 from datetime import datetime, timedelta
 
+LAZY_NAMES = {
+    'scrubber_api': ('RtiApi', 'iter_json_rows', 'get_rti_api',
+                     'query_rti_api', 'api_success', 'api_updated',
+                     'BulkUpdater'),
+    'scrubber_fits': ('kpf_component_files', 'kpf_component_dirs',
+                      'get_kpf_compdir'),
+    'scrubber_remote': ('remote_df', 'inst_disk_usage_ok', 'get_locations'),
+    'scrubber_report': ('send_email', 'create_rti_report', 'rejected_report',
+                        'create_sdata_report', 'create_nightly_report',
+                        'write_emails'),
+}
+_lazy_modules = {name: module for module, names in LAZY_NAMES.items()
+                 for name in names}
+
+
+def __getattr__(name):
+    """
+    Import the submodule of a name on its first use.
+    """
+    if name not in _lazy_modules:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(_lazy_modules[name]), name)
+    globals()[name] = value
+
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_modules))
+
 
 def chk_file_exists(file_location, filename=None):
     """
@@ -75,171 +124,6 @@ def glob_file_exists(file_location, filename=None):
     return glob(file_location)
 
 
-def send_email(email_msg, mailto, mailfrom, mailserver, subject, log):
-    """
-    send an email if there are any warnings or errors logged.
-
-    :param email_msg: <str> message to mail.
-    :param config: <class 'configparser.ConfigParser'> the config file parser.
-    """
-    if not email_msg:
-        return
-
-    import smtplib
-
-    msg = f"From: {mailfrom}\r\nTo: {mailto}\r\n"
-    msg += f"Subject: {subject}\r\n\r\n{email_msg}"
-
-    try:
-        server = smtplib.SMTP(mailserver)
-        server.sendmail(mailfrom, mailto, msg)
-        server.quit()
-    except Exception as err:
-        log.warning(f"Error sending Email. Error: {err}.")
-
-
-def query_rti_api(url, qtype, type_val, val=None, columns=None, key=None, inst=None,
-                  utd=None, utd2=None, update_val=None, add=None, log=None, level=None):
-    """
-    Query the API to get or update information in the KOA RTI DB.
-
-    :param url: <str> the API url.
-    :param qtype: <str> type of query [search, update].
-    :param type_val: <str> the query name,  [GENERAL, HEADER, etc].
-    :param columns: <str> comma separated string of columns to return
-    :param key: <str> the search key to match with val.
-    :param val: <str> the value to match with search.
-    :param add: <str> additional query parameters to add at end of query.
-    :param utd: <str> the initial date, YYYY-MM-DD.
-    :param utd2: <str> the final date, YYYY-MM-DD.
-    :return:
-    """
-    if qtype not in ['search', 'update']:
-        return None
-
-    url = f"{url}?{qtype}={type_val}"
-
-    # iterate through all the args passed
-    loc = locals()
-    for dict_key, dict_val in loc.items():
-        if dict_val and dict_key not in ['url', 'qtype', 'type_val', 'log']:
-            url += f"&{dict_key}={dict_val}"
-
-    try:
-        response = requests.get(url)
-    except HTTPError as err:
-        log.warning(err.response.text)
-
-    results = response.content
-
-    if log:
-        log.info(f'API URL: {url}')
-
-    return results
-
-
-def create_rti_report(args, metrics, move, inst):
-    """
-    Form the report to be emailed at the end of a scrub run.
-
-    :param metrics: <dict> the values of files,  moved, removed, total.
-    :return: <str> the report.
-    """
-
-    report = f"\nRTI Data Scrubber Results for {inst.upper()} " \
-             f"{args.utd} to {args.utd2}."
-
-    header = "Totals"
-    report += f"\n\n{header}" + "\n" + "-" * len(header)
-    report += f"\n{metrics['total_koa_mv']} : Total KOA files moved."
-    report += f"\n{metrics['total_storage_mv']} : Total Storage difference."
-
-    header = "Number of results"
-    report += f"\n\n{header}" + "\n" + "-" * len(header)
-    report += f"\n{metrics['nresults']['mv0'][0]} : KOAID in results to move (lev0)."
-    report += f"\n{metrics['nresults']['mv0'][1]} : verified results to move (lev0)."
-    report += f"\n{metrics['nresults']['mv1'][0]} : KOAID in results to move (lev1)."
-    report += f"\n{metrics['nresults']['mv1'][1]} : verified results to move (lev1)."
-    report += f"\n{metrics['nresults']['mv2'][0]} : KOAID in results to move (lev2)."
-    report += f"\n{metrics['nresults']['mv2'][1]} : verified results to move (lev2)."
-
-    for val in {'mv0', 'del0', 'mv1'}:
-        diff = metrics['nresults'][val][0] - metrics['nresults'][val][1]
-        if diff > 0:
-            report += f"\n\nErrors: "
-            for err in metrics['warnings']:
-                report += f"\n    {err}"
-
-    if move:
-        header = "Fits Files created by DEP on vm-[k1/k2]koarti"
-        report += f"\n\n{header}" + "\n" + "-" * len(header)
-        report += f"\n{metrics['staged'][0]} : Stage files found."
-        report += f"\n{metrics['staged'][1]} : Stage files moved."
-
-    report += f"\n\nTotal number of KOAIDs not previously deleted (any status): "
-    report += f"{metrics['total_files']}"
-
-    return report
-
-
-def create_sdata_report(args, metrics, inst):
-    """
-    Form the report to be emailed at the end of a scrub run.
-
-    :param metrics: <dict> the values of files,  moved, removed, total.
-    :return: <str> the report.
-    """
-
-    report = f"\nRTI Data Scrubber Results for {inst.upper()} " \
-             f"{args.utd} to {args.utd2}."
-
-    header = "Number of results"
-    report += f"\n\n{header}" + "\n" + "-" * len(header)
-
-    report += f"\n{metrics['nresults']['sdata'][0]} : KOAID in sdata results to delete (lev0)."
-    report += f"\n{metrics['nresults']['sdata'][1]} : verified sdata results to delete (lev0)."
-
-    for val in {'sdata'}:
-        diff = metrics['nresults'][val][0] - metrics['nresults'][val][1]
-        if diff > 0:
-            report += f"\n\nErrors: "
-            for err in metrics['warnings']:
-                report += f"\n    {err}"
-
-    header = "Files on Instrument servers"
-    report += f"\n\n{header}" + "\n" + "-" * len(header)
-    report += f"\n{metrics['sdata'][0]} : OFNAME Files found."
-    report += f"\n{metrics['sdata'][1]} : OFNAME Files deleted."
-
-    report += f"\n\nTotal number of SDATA not previously deleted (any status): "
-    report += f"{metrics['total_files']}"
-
-    return report
-
-
-def create_nightly_report(metrics, utd, utd2):
-    """
-    Form the report to be emailed at the end of a scrub run.
-
-    :param metrics: <dict> the values of files,  moved, removed, total.
-    :return: <str> the report.
-    """
-
-    report = f"KOA DEP Files moved to storage for dates: {utd} to {utd2}"
-    report += f"\n\n{metrics['koa_before']} : Total KOA files BEFORE."
-    report += f"\n{metrics['store_before']} : Total Storage files BEFORE."
-    report += f"\n{metrics['koa_after']} : Total KOA files AFTER."
-    report += f"\n{metrics['store_after']} : Total Storage files AFTER."
-
-    diff_koa = metrics['koa_before'] - metrics['koa_after']
-    diff_mv = metrics['store_after'] - metrics['store_before']
-
-    report += f"\n\n{diff_koa} : Number of files removed from KOA."
-    report += f"\n{diff_mv} : Number of files moved to storage.\n"
-
-    return report
-
-
 def run_cmd(cmd, log):
     """
     Run a system command.
@@ -250,7 +134,8 @@ def run_cmd(cmd, log):
     """
     try:
         log.info(f"cmd: {cmd}")
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+        with scrubber_metrics.spawn(os.path.basename(cmd[0])):
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
     except subprocess.CalledProcessError:
         log.warning(f"cmd failed: {cmd}")
         return -1
@@ -272,7 +157,8 @@ def clean_empty_dirs(root_dir, log):
     log.info(f"Cleaning directories at {root_dir}")
 
     try:
-        subprocess.run(cln_cmd, stdout=subprocess.DEVNULL, check=True)
+        with scrubber_metrics.spawn('find'):
+            subprocess.run(cln_cmd, stdout=subprocess.DEVNULL, check=True)
     except subprocess.CalledProcessError:
         log.warning(f"Error removing empty directories in: {root_dir}, "
                     f"line: {sys.exc_info()[-1].tb_lineno}")
@@ -280,43 +166,6 @@ def clean_empty_dirs(root_dir, log):
         return 0
 
 
-def write_emails(config, report, log, log_stream=None, errors=None, prefix=''):
-    """
-    Finish up the scrubbers,  create and send the emails.
-
-    :param config: the pointer to the config file.
-    :param report: the report to send.
-    :param log_stream: the logging stream.
-    :param errors: <dict> error key,  koaid list val
-    :param prefix: prefix for the subject of the email.
-    """
-    now = datetime.now().strftime('%Y-%m-%d')
-    mailto = get_config_param(config, 'email', 'admin')
-    mailfrom = get_config_param(config, 'email', 'from')
-    mailserver = get_config_param(config, 'email', 'server')
-
-    send_email(report, mailto, mailfrom, mailserver,
-               f'{prefix} Scrubber Report: {now}', log)
-
-    if log_stream:
-        log_contents = log_stream.getvalue()
-        log_stream.close()
-
-        if log_contents:
-            mailto = get_config_param(config, 'email', 'warnings')
-            send_email(log_contents, mailto, mailfrom, mailserver,
-                       f'{prefix} Scrubber Warnings: {now}', log)
-
-    if errors:
-        error_report = "ERRORS FOUND / KOAID\n\n"
-        for err in errors.keys():
-            error_report += f'ERROR: {err} \n {errors[err]}\n\n'
-
-        mailto = get_config_param(config, 'email', 'warnings')
-        send_email(error_report, mailto, mailfrom, mailserver,
-                   f'{prefix} Scrubber Warnings: {now}', log)
-
-
 def create_logger(name, logdir, inst=None):
     """
     Set the logger for writing to a log file,  and capturing the
@@ -337,6 +186,11 @@ def create_logger(name, logdir, inst=None):
         #Create logger object
         logger = logging.getLogger(log_name)
 
+        # a second run in the same process (orchestrator) gets new handlers
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
         logger.setLevel(logging.DEBUG)
 
         #file handler (full debug logging)
@@ -365,14 +219,14 @@ def create_logger(name, logdir, inst=None):
     return f'{log_name}.log', log_stream
 
 
-def parse_args(config):
+def parse_args(config, plan=False):
     """
     Parse the command line arguments.
 
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :param plan: <bool> add the run / plan / apply command and --plan_file.
     :return: <obj> commandline arguments
     """
-    now = datetime.now()
-
     insts = get_config_param(config, 'inst_list', 'insts')
     insts = f'{insts}, {insts.lower()}'
     inst_set = set(insts.split(', '))
@@ -390,28 +244,54 @@ def parse_args(config):
                         help="Name of instrument to run the scrubber for.")
     parser.add_argument("--force", type=int, default=0,
                         help="Don't exclude files with archive_dir set.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the run,  the profile is written next "
+                             "to the log.")
+    if plan:
+        parser.add_argument("command", nargs='?', default='run',
+                            choices=('run', 'plan', 'apply'),
+                            help="run the scrubber,  write a plan of the run,"
+                                 " or apply a saved plan.")
+        parser.add_argument("--plan_file", type=str,
+                            help="The plan file written by plan and read by "
+                                 "apply.")
 
     # add inst specific start/end ndays from the config if exist
     # args = parser.parse_args()
     args, unknown_args = parser.parse_known_args()
 
-    try:
-        start = int(get_config_param(config, 'TIMEFRAME', f'{args.inst.lower()}_start'))
-        end = int(get_config_param(config, 'TIMEFRAME', f'{args.inst.lower()}_end'))
-    except:
-        start = int(get_config_param(config, 'TIMEFRAME', 'start'))
-        end = int(get_config_param(config, 'TIMEFRAME', 'end'))
+    utd, utd2 = default_utd_range(config, args.inst)
 
-    parser.add_argument("--utd", type=str,
-                        default=(now - timedelta(days=start)).strftime('%Y-%m-%d'),
+    parser.add_argument("--utd", type=str, default=utd,
                         help="Start date to process YYYY-MM-DD.")
-    parser.add_argument("--utd2", type=str,
-                        default=(now - timedelta(days=end)).strftime('%Y-%m-%d'),
+    parser.add_argument("--utd2", type=str, default=utd2,
                         help="End date to process YYYY-MM-DD.")
 
     return parser.parse_args()
 
 
+def default_utd_range(config, inst):
+    """
+    The UT date range from the [TIMEFRAME] days back from today,  the
+    inst specific start/end are used if they exist.
+
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :param inst: <str> the instrument name
+    :return: <str, str> the start and end dates,  YYYY-MM-DD
+    """
+    now = datetime.now()
+
+    try:
+        start = int(get_config_param(config, 'TIMEFRAME', f'{inst.lower()}_start'))
+        end = int(get_config_param(config, 'TIMEFRAME', f'{inst.lower()}_end'))
+    except:
+        start = int(get_config_param(config, 'TIMEFRAME', 'start'))
+        end = int(get_config_param(config, 'TIMEFRAME', 'end'))
+
+    return ((now - timedelta(days=start)).strftime('%Y-%m-%d'),
+            (now - timedelta(days=end)).strftime('%Y-%m-%d'))
+
+
 def define_insts(include, exclude):
     """
     Set the lists of instruments to include / exclude
@@ -431,7 +311,7 @@ def define_insts(include, exclude):
     return exclude_insts, include_insts
 
 
-def get_config_param(config, section, param_name):
+def get_config_param(config, section, param_name, default=None):
     """
     Function used to read the config file,  and exit if key or value does not
     exist.
@@ -439,16 +319,22 @@ def get_config_param(config, section, param_name):
     :param config: <class 'configparser.ConfigParser'> the config file parser.
     :param section: <str> the section name in the config file.
     :param param_name: <str> the 'key' of the parameter within the section.
+    :param default: <str> value to use for an optional parameter that is
+                          missing or empty,  instead of exiting.
     :return: <str> the config file value for the parameter.
     """
     try:
         param_val = config[section][param_name]
     except KeyError:
+        if default is not None:
+            return default
         err_msg = f"Check Config file, there is no parameter name - "
         err_msg += f"section: {section} parameter name: {param_name}"
         sys.exit(err_msg)
 
     if not param_val:
+        if default is not None:
+            return default
         err_msg = f"Check Config file, there is no value for "
         err_msg += f"section: {section} parameter name: {param_name}"
         sys.exit(err_msg)
@@ -456,81 +342,105 @@ def get_config_param(config, section, param_name):
     return param_val
 
 
-def get_key_val(result_dict, key_name):
+def record_throughput(history_file, inst, nfiles, nbytes, seconds):
     """
-    Use to avoid an error while accessing a key that does not exist.
-
-    :param result_dict: (dict) dictionary to check
-    :param key_name: (str) key name
+    Add the throughput of a run to the history used to estimate the
+    runtime of a plan.
 
-    :return: dictionary value
+    :param history_file: <str> the history file,  one JSON record per line.
+    :param inst: <str> the instrument name
+    :param nfiles: <int> the number of files moved.
+    :param nbytes: <int> the number of bytes moved.
+    :param seconds: <float> the time to move the files.
     """
-    if result_dict and key_name in result_dict:
-        return result_dict[key_name]
+    if not history_file or nfiles <= 0 or seconds <= 0:
+        return
 
-    return None
+    record = {'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              'inst': inst, 'files': nfiles, 'bytes': nbytes,
+              'seconds': round(seconds, 3)}
+    with open(history_file, 'a') as fp:
+        fp.write(json.dumps(record) + '\n')
 
 
-def remote_df(user, ip, path):
+def read_throughput(history_file, inst=None, last=20):
     """
-    Executes df on remote host and return
-    (total, free, used) as int in bytes
+    The throughput of the last runs in the history.  The runs of the
+    instrument are used if there are any,  otherwise all runs.
+
+    :param history_file: <str> the history file.
+    :param inst: <str> the instrument name
+    :param last: <int> the number of runs to use.
+    :return: <tuple> (bytes per second, files per second),  None if there
+                     is no history.
     """
-    Result = namedtuple('diskfree', 'total used free')
-    output = subprocess.check_output(['ssh', f'{user}@{ip}', '-C', 'df', path],
-                                     shell=False)
-    output = output.splitlines()
-    for line in output[1:]:
-        result = line.decode().split()
-
-        if result[-1] == path and len(result) > 3:
-            used = result[2]
-            free = result[3]
-            total = used + free
-            return Result(total, used, free)
-        else:
-            raise Exception('Path "%s" not found' % path)
+    records = []
+    try:
+        with open(history_file) as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except (OSError, TypeError):
+        return None
 
+    inst_records = [rec for rec in records if rec.get('inst') == inst]
+    records = (inst_records or records)[-last:]
 
-def inst_disk_usage_ok(inst, config, config_type, log):
-    """
-    Determine if the used disk space is less than the free disk space.
+    seconds = sum(rec['seconds'] for rec in records)
+    if not seconds:
+        return None
 
-    :param inst: <str> the instrument name
-    :param config: <class 'configparser.ConfigParser'>
-        the pointer to the config file
-    :param config_type: <str> either dev or default
-    :param log: <class 'logging.Logger'> the log
-    :return: <bool> True if disk used < disk free
+    return (sum(rec['bytes'] for rec in records) / seconds,
+            sum(rec['files'] for rec in records) / seconds)
+
+
+def get_key_val(result_dict, key_name):
     """
-    koa_disk, storage_disk = get_locations(inst, config, config_type)
-    user = get_config_param(config, config_type, 'user')
-    server = get_config_param(config, 'servers', 'user')
+    Use to avoid an error while accessing a key that does not exist.
+
+    :param result_dict: (dict) dictionary to check
+    :param key_name: (str) key name
 
-    stats = remote_df(user, server, koa_disk)
-    log.info(f'Disk Space Statistics for {inst} in {server}: {koa_disk}.')
-    log.info(f'Total: {stats.total}, Used: {stats.used}, Free: {stats.free}')
+    :return: dictionary value
+    """
+    if result_dict and key_name in result_dict:
+        return result_dict[key_name]
 
-    return stats.used < stats.free
+    return None
 
 
-def get_locations(inst, config, config_type):
+def disk_free(paths, user=None, server=None):
     """
-    Determine the directories on each of the disks.
+    The size,  used and free bytes of the filesystems of the paths,  with
+    one df (over ssh if a server is given,  otherwise over the mounts).
 
-    :param inst: <str> the instrument
-    :param config: the config file pointer
-    :return: <(str,str)> the paths to the files
+    :param paths: <list<str>> the paths.
+    :param user: <str> the user on the server.
+    :param server: <str> the server,  None to run df locally.
+    :return: <dict> path: (total, used, free) in bytes.
     """
-    koa_disk_root = get_config_param(config, 'koa_disk', 'path_root')
-    koa_disk_num = get_config_param(config, 'koa_disk', inst)
-    storage_disk_root = get_config_param(config, config_type, 'storage_root')
-    storage_disk_num = get_config_param(config, 'storage_disk', inst)
+    Result = namedtuple('diskfree', 'total used free')
+    # POSIX output,  one line per path in 1024 byte blocks
+    cmd = ['df', '-P', '-k'] + list(paths)
+    if server:
+        output = scrubber_ssh.ssh_pool().run(user, server, cmd)
+    else:
+        with scrubber_metrics.spawn('df'):
+            output = subprocess.run(cmd, capture_output=True, text=True)
 
-    koa_disk = f'{koa_disk_root}{koa_disk_num}'
-    storage_disk = f'{storage_disk_root}{storage_disk_num}'
+    lines = output.stdout.splitlines()[1:]
+    if output.returncode or len(lines) != len(paths):
+        raise ValueError(f'df of {paths} failed: {output.stderr.strip()}')
 
-    return koa_disk, storage_disk
+    results = {}
+    for path, line in zip(paths, lines):
+        fields = line.split()
+        total, used, free = (int(val) * 1024 for val in fields[1:4])
+        results[path] = Result(total, used, free)
+
+    return results
 
 
 def make_storage_dir(storage_dir, storage_root, log):
@@ -582,35 +492,151 @@ def count_koa(files_path, log):
     return n_koa
 
 
-def count_store(user, store_server, store_path, inst, log):
+def inst_koaid_prefix(inst, config):
     """
-    Count the files on the remote storage server.
+    A KOAID prefix of an instrument,  ie: NI for NIRES.
 
-    :param user:
-    :param store_server:
-    :param store_path: <str> the path to store the files.
-    :param utd: <str> date YYYYMMDD
-    :param log: <class 'logging.Logger'> the log
+    :param inst: <str> the instrument name
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :return: <str> the prefix,  None if the instrument has no prefix.
+    """
+    for prefix in sorted(set(config.options('inst_prefix')) - set(config.defaults())):
+        if config['inst_prefix'][prefix].upper() == inst.upper():
+            return prefix.upper()
 
-    :return: the file count for the directory
+    return None
+
+
+def storage_dirs_for_range(inst, utd, utd2, config, config_type, levels=(0,),
+                           stage=True):
     """
-    log.info(f'counting files at {store_server}:{store_path}/{inst}')
-    n_store = 0
-    cmd = ['ssh', f'{user}@{store_server}', 'find',
-           f'{store_path}/{inst}/', '-type', 'f', '|', 'wc', '-l']
-    # cmd = ['find', f'/net/storageserver/{store_path}/{inst}/',
-    #        '-type', 'f', '|', 'wc', '-l']
-    # cmd = f"find /net/storageserver/{store_path}/{inst}/ -type f | wc -l"
+    The storage date directories for the KOAIDs of an instrument in a UT
+    date range,  as determine_storage places them.
 
-    try:
-        n_store = int(subprocess.check_output(cmd).decode('utf-8'))
-    except Exception as err:
-        log.warning(f'Error: {err} line: {sys.exc_info()[-1].tb_lineno}')
-        log.warning(f'Could not count files for: {store_path}')
+    :param inst: <str> the instrument name
+    :param utd: <str> the initial date, YYYY-MM-DD.
+    :param utd2: <str> the final date, YYYY-MM-DD.
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :param config_type: <str> either DEV or DEFAULT
+    :param levels: <list<int>> the lev directories to include.
+    :param stage: <bool> include the stage directories.
+    :return: <list<str>> the storage directories.
+    """
+    prefix = inst_koaid_prefix(inst, config)
+    if not prefix:
+        return []
+
+    storage_dirs = []
+    for utd_str in utd_range(utd, utd2):
+        koaid = f'{prefix}.{utd_str}.00000.00'
+        if stage:
+            storage_dirs.append(determine_storage(koaid, config, config_type,
+                                                  ofname='/stage.fits'))
+        # lev1 and lev2 are synced into the date directory,  which holds lev0
+        if 1 in levels or 2 in levels:
+            storage_dirs.append(determine_storage(koaid, config, config_type,
+                                                  level=1))
+        elif 0 in levels:
+            storage_dirs.append(determine_storage(koaid, config, config_type,
+                                                  level=0))
+
+    return storage_dirs
+
+
+def count_storage_dirs(storage_dirs, log, storage_mount='/net/storageserver',
+                       workers=8):
+    """
+    Count the files and bytes in the storage directories,  the directories
+    are walked in parallel over the storage mount.
 
-    log.info(f"{n_store} : files at {store_server}:{store_path}/{inst}")
+    :param storage_dirs: <list<str>> the storage directories.
+    :param log: <class 'logging.Logger'> the log
+    :param storage_mount: <str> the mount point of the storage server.
+    :param workers: <int> the number of directories walked at once.
+    :return: <dict> directory: [number of files, number of bytes]
+    """
+    paths = [f"{storage_mount}/{store_dir.strip('/')}" for store_dir in storage_dirs]
 
-    return n_store
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(walk_file_count, paths))
+
+    counts = {}
+    for store_dir, cnt in zip(storage_dirs, results):
+        counts[store_dir] = cnt or [0, 0]
+
+    nfiles, nbytes = count_totals(counts)
+    log.info(f"{nfiles} : files ({nbytes} bytes) in {len(storage_dirs)} "
+             f"storage directories")
+
+    return counts
+
+
+class StorageDirCache:
+    """
+    The storage directories known to exist.  The directories not in the
+    cache are made with one call to make_func,  later lookups are a set
+    lookup with no syscall or process.
+    """
+    def __init__(self, make_func, storage_mount='/net/storageserver'):
+        """
+        :param make_func: <func> makes a list of paths,  returns a list of
+                                 True / False for each path.
+        :param storage_mount: <str> the mount point of the storage server.
+        """
+        self.make_func = make_func
+        self.storage_mount = storage_mount
+        self.dirs_made = set()
+        self.lock = threading.Lock()
+
+    def bind(self, make_func):
+        """
+        A cache that shares the directories known to exist,  with its own
+        make_func,  ie: for another run of an orchestrator,  so each run
+        logs and times its own mkdirs.
+
+        :param make_func: <func> makes a list of paths.
+        :return: <StorageDirCache> the cache.
+        """
+        cache = StorageDirCache(make_func, self.storage_mount)
+        cache.dirs_made = self.dirs_made
+        cache.lock = self.lock
+
+        return cache
+
+    @staticmethod
+    def _key(storage_dir):
+        return os.path.normpath('/' + storage_dir.strip('/'))
+
+    def exists(self, storage_dir):
+        """
+        :param storage_dir: <str> the storage directory.
+        :return: <bool> True if the directory is in the cache.
+        """
+        return self._key(storage_dir) in self.dirs_made
+
+    def ensure(self, storage_dirs):
+        """
+        Make the storage directories not in the cache in one batch.
+
+        :param storage_dirs: <iterable<str>> the storage directories.
+        :return: <set> the directories (as given) that exist.
+        """
+        keys = {storage_dir: self._key(storage_dir)
+                for storage_dir in storage_dirs if storage_dir}
+
+        with self.lock:
+            missing = sorted(set(keys.values()) - self.dirs_made)
+
+        if missing:
+            made = self.make_func([f'{self.storage_mount}{key}'
+                                   for key in missing])
+            with self.lock:
+                self.dirs_made.update(key for key, ok in zip(missing, made)
+                                      if ok)
+
+        with self.lock:
+            return {storage_dir for storage_dir, key in keys.items()
+                    if key in self.dirs_made}
 
 
 def diff_list(list1, list2):
@@ -625,6 +651,31 @@ def diff_list(list1, list2):
     return [i for i in list1 + list2 if i not in list1 or i not in list2]
 
 
+def list_dir_files(dir_path):
+    """
+    List the files in a single directory with one scan,  used in place of
+    a glob / stat per file.
+
+    :param dir_path: <str> the directory to list.
+    :return: <dict> filename: os.stat_result,  empty if the directory is
+                    missing.
+    """
+    files = {}
+    try:
+        with scrubber_metrics.timer('scrubber_scan_seconds', op='list_dir'), \
+                os.scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        files[entry.name] = entry.stat()
+                except OSError:
+                    continue
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return {}
+
+    return files
+
+
 def count_files(path_str):
     """
     Count the files in directory with a wildcard.
@@ -635,36 +686,188 @@ def count_files(path_str):
     return len(glob(path_str))
 
 
-def count_koa_files(args, koa_dir):
-    '/koadata/NIRES/20210223/lev0/'
-    '/koadata/NIRES/stage/20210223/s/sdata1500/nires9/2021feb23/s210223_0002.fits'
-    utd2 = int(args.utd2.replace('-', ''))
-    diff = utd2 - int(args.utd.replace('-', ''))
+def utd_range(utd, utd2):
+    """
+    Iterate over the calendar dates in a UT date range.
+
+    :param utd: <str> the initial date, YYYY-MM-DD.
+    :param utd2: <str> the final date, YYYY-MM-DD (included).
+    :return: <str> yields each date as YYYYMMDD.
+    """
+    utd_dt = datetime.strptime(utd, '%Y-%m-%d')
+    utd_dt2 = datetime.strptime(utd2, '%Y-%m-%d')
 
-    sfiles = 0
-    ofiles = 0
-    for i in range(0, diff + 1):
-        utd = utd2 - i
+    while utd_dt <= utd_dt2:
+        yield utd_dt.strftime('%Y%m%d')
+        utd_dt += timedelta(days=1)
 
-        sfile_list = [rslt for rslt in
-                      glob(f'{koa_dir}/{args.inst}/stage/{utd}/**', recursive=True)
-                      if not os.path.isdir(rslt)]
 
-        ofile_list = [rslt for rslt in
-                       glob(f'{koa_dir}/{args.inst}/{utd}/**', recursive=True)
-                       if not os.path.isdir(rslt)]
+def utd_shards(utd, utd2, days):
+    """
+    Split a UT date range into shards of days.
+
+    :param utd: <str> the initial date, YYYY-MM-DD.
+    :param utd2: <str> the final date, YYYY-MM-DD (included).
+    :param days: <int> the days in each shard.
+    :return: <list<tuple>> the (utd, utd2) of each shard,  YYYY-MM-DD.
+    """
+    utd_dt = datetime.strptime(utd, '%Y-%m-%d')
+    utd_dt2 = datetime.strptime(utd2, '%Y-%m-%d')
 
-        sfiles += len(sfile_list)
-        ofiles += len(ofile_list)
+    shards = []
+    while utd_dt <= utd_dt2:
+        shard_end = min(utd_dt + timedelta(days=days - 1), utd_dt2)
+        shards.append((utd_dt.strftime('%Y-%m-%d'),
+                       shard_end.strftime('%Y-%m-%d')))
+        utd_dt = shard_end + timedelta(days=1)
 
-    return sfiles + ofiles
+    return shards
 
 
-def determine_storage(koaid, config, config_type, level=0, ofname=None):
+def walk_file_count(root_dir):
+    """
+    Count the files and bytes below a directory (descend into
+    sub-directories) with os.scandir,  one scan per directory.
+
+    :param root_dir: <str> the directory to count.
+    :return: <list<int>> [number of files, number of bytes],  None if the
+                         directory does not exist.
+    """
+    nfiles = 0
+    nbytes = 0
+    dirs = [root_dir]
+    while dirs:
+        dir_path = dirs.pop()
+        try:
+            with scrubber_metrics.timer('scrubber_scan_seconds', op='walk'), \
+                    os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        else:
+                            nfiles += 1
+                            nbytes += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            if dir_path == root_dir:
+                return None
+
+    return [nfiles, nbytes]
+
+
+def count_totals(counts):
+    """
+    Sum the counts of count_koa_files.
+
+    :param counts: <dict> directory: [number of files, number of bytes]
+    :return: <list<int>> [total files, total bytes]
+    """
+    return [sum(cnt[0] for cnt in counts.values()),
+            sum(cnt[1] for cnt in counts.values())]
+
+
+def count_dir_utd(count_dir):
+    """
+    :param count_dir: <str> a directory of count_koa_files.
+    :return: <str> the UT date (YYYYMMDD) of the directory,  None if none.
+    """
+    return next((part for part in count_dir.split('/')
+                 if len(part) == 8 and part.isdigit()), None)
+
+
+def utd_bytes(counts):
+    """
+    The bytes of the counts of count_koa_files for each UT date.
+
+    :param counts: <dict> directory: [number of files, number of bytes]
+    :return: <dict> UT date (YYYYMMDD): number of bytes
+    """
+    day_bytes = {}
+    for count_dir, cnt in counts.items():
+        utd = count_dir_utd(count_dir)
+        if utd:
+            day_bytes[utd] = day_bytes.get(utd, 0) + cnt[1]
+
+    return day_bytes
+
+
+def count_koa_files(args, koa_dir, levels=(0, 1, 2), stage=True,
+                    prev_counts=None):
+    """
+    Count the KOA files and bytes in the directories the run moves,  for
+    each UT date in the range:
+
+        /koadata/NIRES/20210223/lev0/
+        /koadata/NIRES/stage/20210223/s/sdata1500/nires9/2021feb23/
+
+    :param args: <obj> the command line arguments (inst, utd, utd2).
+    :param koa_dir: <str> the KOA root,  ie: /k1koadata
+    :param levels: <list<int>> the lev directories to count.
+    :param stage: <bool> count the stage directories.
+    :param prev_counts: <dict> the results of an earlier call,  only the
+                               directories found then are counted again.
+    :return: <dict> directory: [number of files, number of bytes]
+    """
+    if prev_counts is not None:
+        count_dirs = list(prev_counts)
+    else:
+        count_dirs = []
+        for utd in utd_range(args.utd, args.utd2):
+            if stage:
+                count_dirs.append(f'{koa_dir}/{args.inst}/stage/{utd}')
+            for level in levels:
+                count_dirs.append(f'{koa_dir}/{args.inst}/{utd}/lev{level}')
+
+    counts = {}
+    for count_dir in count_dirs:
+        cnt = walk_file_count(count_dir)
+        if cnt:
+            counts[count_dir] = cnt
+        elif prev_counts is not None:
+            counts[count_dir] = [0, 0]
+
+    return counts
+
+
+# the storage disk of an instrument placed on the overflow disk,  for the run
+_storage_disks = {}
+
+
+def set_storage_disk(inst, store_num=None):
+    """
+    Place the storage directories of an instrument on another storage disk
+    for the rest of the run,  ie: the overflow disk when its disk is full.
+
+    :param inst: <str> the instrument name
+    :param store_num: <str> the storage disk number,  None for the
+                            [storage_disk] of the instrument.
+    """
+    if store_num:
+        _storage_disks[inst.upper()] = store_num
+    else:
+        _storage_disks.pop(inst.upper(), None)
+
+
+def inst_storage_disk(inst, config):
+    """
+    :param inst: <str> the instrument name
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :return: <str> the storage disk number of the instrument for the run.
+    """
+    return _storage_disks.get(inst.upper()) or \
+        get_config_param(config, 'storage_disk', inst)
+
+
+def determine_storage(koaid, config, config_type, level=0, ofname=None,
+                      store_num=None):
     """
     Find the storage directory from the KOAID.
 
     :param koaid: <str> <inst>.utd.#####.## (ie: KB.20210116.57436.94)
+    :param store_num: <str> the storage disk number,  default is the disk of
+                            the instrument for the run.
     :return: <str> full path to storage directory (including lev0)
     """
     id_parts = koaid.split('.')
@@ -675,7 +878,7 @@ def determine_storage(koaid, config, config_type, level=0, ofname=None):
     utd = id_parts[1]
 
     storage_root = get_config_param(config, config_type, 'storage_root_rti')
-    store_num = get_config_param(config, 'storage_disk', inst)
+    store_num = store_num or inst_storage_disk(inst, config)
     koa_num = get_config_param(config, 'koa_disk', inst)
     koa_root = get_config_param(config, 'koa_disk', 'path_root')
 
@@ -699,67 +902,199 @@ def determine_storage(koaid, config, config_type, level=0, ofname=None):
     return storage_path
 
 
-def kpf_component_files(mv_path_local, mv_path_remote, log):
-    log.info(f'kpf_component_files: {mv_path_local} {mv_path_remote}')
-    hdu = fits.open(mv_path_local, ignore_missing_end=True)
-    hdr = hdu[0].header
-
-    files_to_remove = []
-    if 'GREENFN' in hdr:
-        log.info(f"GREEN filename: {hdr['GREENFN']}")
-        files_to_remove.append(hdr['GREENFN'])
-    if 'REDFN' in hdr:
-        log.info(f"RED filename: {hdr['REDFN']}")
-        files_to_remove.append(hdr['REDFN'])
-    if 'CA_HKFN' in hdr:
-        log.info(f"CA_HK filename: {hdr['CA_HKFN']}")
-        files_to_remove.append(hdr['CA_HKFN'])
-    if 'EXPMETERFN' in hdr:
-        log.info(f"Exposure Meter filename: {hdr['EXPMETERFN']}")
-        files_to_remove.append(hdr['EXPMETERFN'])
-
-    return files_to_remove
+class StorageCapacity:
+    """
+    The preflight of the storage disks.  Before the transfers of a run start,
+    the bytes to move are compared with the free space of the candidate
+    storage disks (the disk of the instrument and the overflow disk),  read
+    with one df.  The run is placed on the first disk it fits,  otherwise its
+    UT date range is cut to the dates that fit.  The bytes of a run are held
+    until it is released,  so the runs of an orchestrator are not placed on
+    the same free space.
+    """
+    def __init__(self, config, config_type, log, reserve=0, overflow=None):
+        """
+        :param config: <class 'configparser.ConfigParser'> the config file parser.
+        :param config_type: <str> either DEV or DEFAULT
+        :param log: <class 'logging.Logger'> the log
+        :param reserve: <int> the bytes left free on each storage disk.
+        :param overflow: <str> the storage disk number used when the disk of
+                               an instrument is full,  None for no overflow.
+        """
+        self.config = config
+        self.storage_root = get_config_param(config, config_type,
+                                             'storage_root_rti')
+        self.storage_mount = get_config_param(config, config_type,
+                                              'storage_mount',
+                                              default='/net/storageserver')
+        # df runs on the storage server when it is set,  over its ssh
+        # connection,  otherwise over the storage mount
+        self.user = get_config_param(config, config_type, 'user', default='')
+        self.server = get_config_param(config, config_type, 'store_server',
+                                       default='')
+        self.log = log
+        self.reserve = reserve
+        self.overflow = overflow
+        # run name: (inst, storage disk, bytes)
+        self.held = {}
+        self.lock = threading.Lock()
+
+    def volume(self, store_num):
+        """
+        :param store_num: <str> the storage disk number.
+        :return: <str> the storage disk over the storage mount.
+        """
+        return f"{self.storage_mount}/{self.storage_root.strip('/')}{store_num}"
+
+    def available(self, disks):
+        """
+        The free bytes of the storage disks,  less the reserve and the bytes
+        held by the runs.
+
+        :param disks: <list<str>> the storage disk numbers.
+        :return: <dict> storage disk: bytes available,  None if df failed.
+        """
+        if self.server:
+            paths = {disk: f'{self.storage_root}{disk}' for disk in disks}
+        else:
+            paths = {disk: self.volume(disk) for disk in disks}
+        try:
+            # df of a parent directory is the free space of another disk
+            missing = [path for path in paths.values()
+                       if not self.server and not os.path.isdir(path)]
+            if missing:
+                raise ValueError(f'no storage disk at: {", ".join(missing)}')
+            free = disk_free(sorted(set(paths.values())), self.user,
+                             self.server)
+        except (OSError, ValueError) as err:
+            self.log.warning(f'storage preflight skipped: {err}')
+            return None
 
+        available = {}
+        for disk, path in paths.items():
+            held = sum(nbytes for _, held_disk, nbytes in self.held.values()
+                       if held_disk == disk)
+            available[disk] = free[path].free - self.reserve - held
+            self.log.info(f'storage disk {disk}: {free[path].free} bytes free, '
+                          f'{held} held,  {available[disk]} available')
+
+        return available
+
+    def place(self, name, inst, day_bytes):
+        """
+        Place a run on a storage disk.
+
+        :param name: <str> the name of the run,  ie: k1_NIRES
+        :param inst: <str> the instrument name
+        :param day_bytes: <dict> UT date (YYYYMMDD): the bytes to move.
+        :return: <(str, str)> the storage disk and the last UT date that fits,
+                              (None, None) if the first date does not fit.
+        """
+        dates = sorted(day_bytes)
+        total = sum(day_bytes.values())
+        with self.lock:
+            # a run of the instrument in progress keeps its disk
+            disks = [disk for held_inst, disk, _ in self.held.values()
+                     if held_inst == inst][:1]
+            if not disks:
+                disks = [inst_storage_disk(inst, self.config),
+                         get_config_param(self.config, 'storage_disk', inst),
+                         self.overflow]
+                disks = list(dict.fromkeys(disk for disk in disks if disk))
+
+            available = self.available(disks)
+            if available is None:
+                return disks[0], dates[-1] if dates else None
+
+            for disk in disks:
+                if total <= available[disk]:
+                    self._hold(name, inst, disk, total)
+                    return disk, dates[-1] if dates else None
+
+            disk = max(disks, key=available.get)
+            nbytes = 0
+            last_utd = None
+            for utd in dates:
+                if nbytes + day_bytes[utd] > available[disk]:
+                    break
+                nbytes += day_bytes[utd]
+                last_utd = utd
+
+            if not last_utd:
+                self.log.error(f'{name}: {day_bytes[dates[0]]} bytes for '
+                               f'{dates[0]},  {available} bytes available')
+                return None, None
+
+            self.log.warning(f'{name}: {total} bytes to move,  {available} '
+                             f'bytes available,  the run ends at {last_utd}')
+            self._hold(name, inst, disk, nbytes)
+
+        return disk, last_utd
+
+    def _hold(self, name, inst, disk, nbytes):
+        self.held[name] = (inst, disk, nbytes)
+        if disk != get_config_param(self.config, 'storage_disk', inst):
+            self.log.warning(f'{name}: {inst} placed on the overflow storage '
+                             f'disk {disk}')
+            set_storage_disk(inst, disk)
+        else:
+            set_storage_disk(inst, None)
+
+    def release(self, name):
+        """
+        Release the bytes held by a run,  the overflow placement of the
+        instrument ends with its last run.
+
+        :param name: <str> the name of the run.
+        """
+        with self.lock:
+            inst = self.held.pop(name, (None,))[0]
+            if inst and all(held[0] != inst for held in self.held.values()):
+                set_storage_disk(inst, None)
+
+    def check(self, disk_bytes):
+        """
+        Check the bytes of a plan fit the storage disks.
+
+        :param disk_bytes: <dict> storage disk: bytes to move.
+        :return: <list<str>> the disks without the space,  empty if it fits.
+        """
+        disk_bytes = {disk: nbytes for disk, nbytes in disk_bytes.items()
+                      if disk and disk != 'None'}
+        with self.lock:
+            available = self.available(list(disk_bytes))
+        if not available:
+            return []
+
+        return [f'storage disk {disk}: {nbytes} bytes to move,  '
+                f'{available[disk]} bytes available'
+                for disk, nbytes in sorted(disk_bytes.items())
+                if nbytes > available[disk]]
+
+
+def create_capacity(config, config_type, log):
+    """
+    Create the storage preflight from the [storage_capacity] section of the
+    config file.
 
-def kpf_component_dirs(mv_path_local, mv_path_remote, log):
-    log.info(f'kpf_component_dirs: {mv_path_local} {mv_path_remote}')
-    try:
-        hdu = fits.open(mv_path_local, ignore_missing_end=True)
-        hdr = hdu[0].header
-    except FileNotFoundError:
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :param config_type: <str> either DEV or DEFAULT
+    :param log: <class 'logging.Logger'> the log
+    :return: <StorageCapacity> the preflight,  None if it is not enabled.
+    """
+    if not int(get_config_param(config, 'storage_capacity', 'preflight',
+                                default='0')):
         return None
 
-    if 'GREENFN' in hdr:
-        direct = get_kpf_compdir(hdr, 'GREENFN', 'Green', log)
-        if direct:
-            return direct
-    if 'REDFN' in hdr:
-        direct = get_kpf_compdir(hdr, 'REDFN', 'Red', log)
-        if direct:
-            return direct
-    if 'CA_HKFN' in hdr:
-        direct = get_kpf_compdir(hdr, 'CA_HKFN', 'CaHK', log)
-        if direct:
-            return direct
-    if 'EXPMETERFN' in hdr:
-        direct = get_kpf_compdir(hdr, 'EXPMETERFN', 'ExpMeter', log)
-        if direct:
-            return direct
-
-    return None
+    reserve_gb = float(get_config_param(config, 'storage_capacity',
+                                        'reserve_gb', default='0'))
+    overflow = get_config_param(config, 'storage_capacity', 'overflow',
+                                default='')
 
+    return StorageCapacity(config, config_type, log,
+                           reserve=int(reserve_gb * 1024 ** 3),
+                           overflow=overflow or None)
 
-def get_kpf_compdir(hdr, hdr_key, comp_name, log):
-    log.info(f"{comp_name} filename: {hdr[hdr_key]}")
-    filename = hdr[hdr_key]
-    try:
-        direct = filename.split(comp_name)[0]
-        log.info(f"{comp_name} file directory: {direct}")
-        return direct
-    except IndexError:
-        log.error(f"could not determine directory: {comp_name}, filename: {filename}")
-
-    return None
 
 def parse_range_uids(uids_str):
     uids = []
@@ -777,14 +1112,14 @@ def parse_range_uids(uids_str):
 
     return uids
 
-def run_cmd_as_user(uid, gid, cmd, log):
-    as_usr_cmd = ["sudo", "setpriv", f"--reuid={uid}", f"--regid={gid}", "--clear-groups", ] + cmd
-    if 'mosfire' in str(uid):
-        as_usr_cmd = ["sudo", "setpriv", f"--reuid={uid}", f"--regid={gid}", "--groups=mosgrp", ] + cmd
+def run_cmd_as_user(uid, gid, cmd, log, setpriv=True):
+    as_usr_cmd = scrubber_helper.setpriv_cmd(uid, gid) if setpriv else []
+    as_usr_cmd += cmd
 
     try:
         # switch users and remove the file
-        result = subprocess.run(as_usr_cmd, text=True, capture_output=True)
+        with scrubber_metrics.spawn(os.path.basename(cmd[0])):
+            result = subprocess.run(as_usr_cmd, text=True, capture_output=True)
         if result.returncode == 0:
             log.info(f"Success: {as_usr_cmd}, stdout: {result.stdout}")
         else:
@@ -797,3 +1132,406 @@ def run_cmd_as_user(uid, gid, cmd, log):
 
     return True
 
+
+def source_mount(file_path, root=''):
+    """
+    The mount point of a path,  used to group the work by source disk.
+
+    :param file_path: <str> ie: /k1koadata/NIRES/20210124/lev0
+    :param root: <str> the directory the mounts are in,  the koa_mount.
+    :return: <str> the first directory in the path below root,
+                   ie: /k1koadata
+    """
+    if not file_path:
+        return root or '/'
+
+    root = root.rstrip('/')
+    if root and file_path.startswith(root + '/'):
+        file_path = file_path[len(root):]
+
+    return root + '/' + file_path.strip('/').split('/')[0]
+
+
+def storage_disk_num(koaid, config):
+    """
+    The [storage_disk] number for the instrument of a koaid.
+
+    :param koaid: <str> <inst>.utd.#####.## (ie: KB.20210116.57436.94)
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :return: <str> the storage disk number,  or None if not determined.
+    """
+    prefix = koaid.split('.')[0] if koaid else None
+    try:
+        inst = config['inst_prefix'][prefix]
+        return _storage_disks.get(inst.upper()) or config['storage_disk'][inst]
+    except KeyError:
+        return None
+
+
+def create_executor(config, log):
+    """
+    Create the transfer executor from the [executor], [source_limit] and
+    [storage_limit] sections of the config file.  Without the sections the
+    executor runs the transfers serially.
+
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :param log: <class 'logging.Logger'> the log
+    :return: <TransferExecutor> the executor.
+    """
+    workers = int(get_config_param(config, 'executor', 'workers', default='1'))
+    adaptive = int(get_config_param(config, 'executor', 'adaptive',
+                                    default='0'))
+    congestion = float(get_config_param(config, 'executor', 'congestion',
+                                        default='2.0'))
+    bwlimit = int(get_config_param(config, 'executor', 'bwlimit', default='0'))
+
+    limits = {}
+    for section in ('source_limit', 'storage_limit'):
+        limits[section] = {}
+        if not config.has_section(section):
+            continue
+        # skip the keys inherited from the [DEFAULT] section
+        for key in set(config.options(section)) - set(config.defaults()):
+            limits[section][key] = int(config[section][key])
+
+    return TransferExecutor(workers, limits['source_limit'],
+                            limits['storage_limit'], log, adaptive=adaptive,
+                            congestion=congestion, bwlimit=bwlimit)
+
+
+def transfer_backends(config):
+    """
+    The transfer backend for each source mount from the [transfer_backend]
+    section of the config file,  rsync or native.
+
+    :param config: <class 'configparser.ConfigParser'> the config file parser.
+    :return: <dict> source mount: backend,  the 'default' key applies to the
+                    other mounts.
+    """
+    backends = {'default': 'rsync'}
+    if config.has_section('transfer_backend'):
+        # skip the keys inherited from the [DEFAULT] section
+        for key in set(config.options('transfer_backend')) - set(config.defaults()):
+            backends[key] = config['transfer_backend'][key].strip().lower()
+
+    return backends
+
+
+class AdaptiveLimit:
+    """
+    An AIMD limit on the transfers running at once to one storage disk.
+    The time per byte of each transfer is compared to the best seen for the
+    disk,  a transfer slower than congestion times the best halves the
+    limit,  otherwise the limit grows by 1 / limit (about one more transfer
+    for each round of transfers).
+    """
+    def __init__(self, max_limit, congestion=2.0, decrease=0.5,
+                 min_bytes=1 << 20):
+        """
+        :param max_limit: <int> the most transfers at once.
+        :param congestion: <float> the slow down from the best time per
+                                   byte treated as congestion.
+        :param decrease: <float> the limit is multiplied by decrease on
+                                 congestion or a failed transfer.
+        :param min_bytes: <int> smaller transfers do not change the limit.
+        """
+        self.max_limit = max(1, max_limit)
+        self.limit = float(self.max_limit)
+        self.congestion = congestion
+        self.decrease = decrease
+        self.min_bytes = min_bytes
+        self.running = 0
+        self.best = None
+        self.stats = {'tasks': 0, 'bytes': 0, 'seconds': 0.0,
+                      'min_limit': self.max_limit, 'decreases': 0}
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.running >= int(self.limit):
+                self._cond.wait()
+            self.running += 1
+
+    def release(self, nbytes, seconds, success=True):
+        """
+        Free the slot of a transfer and adjust the limit.
+
+        :param nbytes: <int> the bytes transferred.
+        :param seconds: <float> the time of the transfer.
+        :param success: <bool> False if the transfer failed.
+        """
+        with self._cond:
+            self.running -= 1
+            self.stats['tasks'] += 1
+            self.stats['bytes'] += nbytes
+            self.stats['seconds'] += seconds
+
+            if not success:
+                self._decrease()
+            elif nbytes >= self.min_bytes and seconds > 0:
+                per_byte = seconds / nbytes
+                if self.best is None or per_byte < self.best:
+                    self.best = per_byte
+                if per_byte > self.congestion * self.best:
+                    self._decrease()
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self._cond.notify_all()
+
+    def _decrease(self):
+        self.limit = max(1.0, self.limit * self.decrease)
+        self.stats['decreases'] += 1
+        self.stats['min_limit'] = min(self.stats['min_limit'], int(self.limit))
+
+
+class TransferExecutor:
+    """
+    Run transfer tasks in a pool of threads.  The number of tasks running
+    at once is limited for each source mount and each storage disk.  The
+    results are returned in the order of the tasks,  so the totals match a
+    serial run.
+    """
+    def __init__(self, workers=1, source_limits=None, storage_limits=None,
+                 log=None, adaptive=False, congestion=2.0, bwlimit=0):
+        """
+        :param workers: <int> the number of threads,  1 runs serially.
+        :param source_limits: <dict> source mount: max tasks,  the 'default'
+                                     key applies to the other mounts.
+        :param storage_limits: <dict> storage disk: max tasks,  the 'default'
+                                      key applies to the other disks.
+        :param log: <class 'logging.Logger'> the log
+        :param adaptive: <bool> adjust the tasks at once for each storage disk
+                                (AIMD),  the storage limit is the maximum.
+        :param congestion: <float> the slow down treated as congestion.
+        :param bwlimit: <int> the KB/s of all the transfers,  0 for no cap.
+        """
+        self.workers = max(1, workers)
+        self.limits = {'source': source_limits or {},
+                       'storage': storage_limits or {}}
+        self.log = log
+        self.adaptive = adaptive
+        self.congestion = congestion
+        self.bwlimit = bwlimit
+        self.running = 0
+        # the tasks running at once for all the maps of a shared executor
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._semaphores = {}
+        self._adaptive = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _max_tasks(self, kind, key):
+        limits = self.limits[kind]
+
+        return max(1, int(limits.get(str(key).lower(),
+                                     limits.get('default', self.workers))))
+
+    def _semaphore(self, kind, key):
+        """
+        The semaphore limiting the tasks for one source mount or storage disk.
+
+        :param kind: <str> 'source' or 'storage'
+        :param key: <str> the source mount or storage disk number
+        :return: <threading.BoundedSemaphore> the semaphore for the key.
+        """
+        with self._lock:
+            if (kind, key) not in self._semaphores:
+                self._semaphores[(kind, key)] = threading.BoundedSemaphore(
+                    self._max_tasks(kind, key))
+
+            return self._semaphores[(kind, key)]
+
+    def _adaptive_limit(self, key):
+        """
+        :param key: <str> the storage disk number
+        :return: <AdaptiveLimit> the adaptive limit for the storage disk.
+        """
+        with self._lock:
+            if key not in self._adaptive:
+                self._adaptive[key] = AdaptiveLimit(
+                    self._max_tasks('storage', key), self.congestion)
+
+            return self._adaptive[key]
+
+    def add_bytes(self, nbytes):
+        """
+        Add to the bytes moved by the task running in this thread,  used to
+        measure the throughput for the adaptive limits.
+
+        :param nbytes: <int> the bytes moved.
+        """
+        self._local.nbytes = getattr(self._local, 'nbytes', 0) + nbytes
+
+    def task_bwlimit(self):
+        """
+        The KB/s of a transfer,  a fixed share of the bwlimit for each
+        worker.  At most workers transfers run at once,  so the transfers
+        stay under the bwlimit as tasks start and end.
+
+        :return: <int> the KB/s,  None if there is no cap.
+        """
+        if not self.bwlimit:
+            return None
+
+        return max(1, self.bwlimit // self.workers)
+
+    def _run_task(self, func, task):
+        """
+        Run one task when both its source and storage have a free slot.  The
+        semaphores are always taken in the same order to avoid a deadlock,
+        the worker slot is taken last so a task waiting for a busy mount
+        does not hold a slot needed by the tasks of other mounts.
+
+        :param func: <func> the function to run.
+        :param task: <tuple> source key, storage key, the args for func.
+        :return: the return value of func,  0 if it raised an exception.
+        """
+        source_key, storage_key, func_args = task
+        with self._semaphore('source', source_key):
+            if not self.adaptive:
+                with self._semaphore('storage', storage_key), self._slots:
+                    return self._call(func, func_args)
+
+            limit = self._adaptive_limit(storage_key)
+            limit.acquire()
+            self._slots.acquire()
+            self._local.nbytes = 0
+            start = time.time()
+            ret_val = 0
+            try:
+                ret_val = self._call(func, func_args)
+            finally:
+                self._slots.release()
+                limit.release(self._local.nbytes, time.time() - start,
+                              success=bool(ret_val))
+
+            return ret_val
+
+    def _call(self, func, func_args):
+        with self._lock:
+            self.running += 1
+        try:
+            return func(*func_args)
+        except Exception as err:
+            if self.log:
+                self.log.error(f'Error in transfer task {func_args}: {err}')
+            return 0
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def report(self):
+        """
+        The limits used for the transfers,  for the run report.
+
+        :return: <list<str>> a line for each storage disk.
+        """
+        lines = []
+        if self.bwlimit:
+            lines.append(f'bandwidth cap: {self.bwlimit} KB/s')
+
+        for key, limit in sorted(self._adaptive.items(), key=lambda item: str(item[0])):
+            stats = limit.stats
+            rate = stats['bytes'] / stats['seconds'] / 1e6 if stats['seconds'] else 0
+            lines.append(f"storage disk {key}: limit {int(limit.limit)} of "
+                         f"{limit.max_limit} (min {stats['min_limit']}, "
+                         f"{stats['decreases']} decreases), {stats['tasks']} "
+                         f"transfers, {rate:.1f} MB/s")
+
+        return lines
+
+    def map(self, func, tasks):
+        """
+        Run func for each task.  The tasks are read as they are needed,  at
+        most two per worker are waiting at once,  so tasks can be a
+        generator over the query results.
+
+        :param func: <func> the function to run.
+        :param tasks: <iterable<tuple>> source key, storage key, the args
+                                        for func.
+        :return: yields the results of func in the order of the tasks.
+        """
+        if self.workers == 1:
+            for task in tasks:
+                yield self._run_task(func, task)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = deque()
+            for task in tasks:
+                futures.append(pool.submit(self._run_task, func, task))
+                if len(futures) >= 2 * self.workers:
+                    yield futures.popleft().result()
+
+            while futures:
+                yield futures.popleft().result()
+
+
+def hash_file(file_path, algorithm='blake2b', chunk_size=8 << 20):
+    """
+    Hash the content of a file,  read memory-mapped so the chunks are
+    passed to the hash without a copy.  The hashes release the GIL,  so
+    the files can be hashed in a pool of threads.
+
+    :param file_path: <str> the path to the file.
+    :param algorithm: <str> the hash algorithm (see file_hasher).
+    :param chunk_size: <int> the bytes hashed at once.
+    :return: <str> the hex digest.
+    """
+    hasher = file_hasher(algorithm)
+    with open(file_path, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    for pos in range(0, size, chunk_size):
+                        with view[pos:pos + chunk_size] as chunk:
+                            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def verify_transfers(pairs, log, algorithm='blake2b', workers=4,
+                     src_hashes=None):
+    """
+    Compare the hash of each source file to the hash of its copy at
+    storage.  The files are hashed in a pool of threads.
+
+    :param pairs: <list<tuple>> (source path, storage path) of each file.
+    :param log: <class 'logging.Logger'> the log
+    :param algorithm: <str> the hash algorithm (see file_hasher).
+    :param workers: <int> the number of files hashed at once.
+    :param src_hashes: <dict> source path: hash,  the hashes taken while
+                              the files were copied,  these sources are not
+                              read again.
+    :return: <set> the source paths that match their copy at storage.
+    """
+    verified = set()
+    if not pairs:
+        return verified
+
+    src_hashes = src_hashes or {}
+
+    def hash_pair(pair):
+        src_path, store_path = pair
+        try:
+            if os.path.getsize(src_path) != os.path.getsize(store_path):
+                return False
+            src_hash = src_hashes.get(src_path) or hash_file(src_path,
+                                                             algorithm)
+            return src_hash == hash_file(store_path, algorithm)
+        except OSError as err:
+            log.warning(f'could not hash {src_path} or {store_path}: {err}')
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pairs)))) as pool:
+        for pair, match in zip(pairs, pool.map(hash_pair, pairs)):
+            if match:
+                verified.add(pair[0])
+            else:
+                log.warning(f'hash does not match: {pair[0]} {pair[1]}')
+
+    log.info(f'verified {len(verified)} of {len(pairs)} files ({algorithm})')
+
+    return verified